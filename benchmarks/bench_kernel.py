@@ -0,0 +1,352 @@
+"""Measures the kernel's latency and throughput, and writes the results as JSON so
+that they can be compared between releases.
+
+By default the Wasm interpreter is replaced by `fake_wasm.py`, which mimics its REPL,
+so that the benchmarks can run anywhere and measure only the kernel's own overhead.
+The benchmarks are:
+
+* `cold_start`: starting a kernel until it's ready, and until its first cell is done
+* `restart`: replacing the kernel's interpreter (WasmKernel._start_wasm), with and
+  without a spare interpreter
+* `cell_latency`: WasmREPLWrapper.run_command for cells of increasing line counts,
+  line by line and framed
+* `throughput`: collecting large outputs, in MB/s (fake_wasm.py only)
+* `execute_overhead`: an execute_request's round-trip through the kernel, compared to
+  running the same cell with run_command
+
+    python benchmarks/bench_kernel.py [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from wasm_spec_kernel import __version__  # noqa: E402
+from wasm_spec_kernel.startup import spawn_wasm  # noqa: E402
+
+
+FAKE_WASM = os.path.join(HERE, "fake_wasm.py")
+
+BENCH_MODULE = (
+    "(module $Bench\n"
+    '  (func (export "get") (result i32) (i32.const 4))\n'
+    '  (func (export "lines") (param i32)))'
+)
+BENCH_CELL = '(invoke $Bench "get")'
+
+LINE_COUNTS = [1, 10, 100, 1000]
+OUTPUT_SIZES = [1, 4]  # MB
+
+
+def summarize(times, unit="s"):
+    return {
+        "unit": unit,
+        "median": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+        "runs": len(times),
+    }
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class KernelSpec:
+    """A kernelspec for the benchmarked interpreter, in a temporary directory"""
+
+    def __init__(self, interpreter, env):
+        from jupyter_client.kernelspec import KernelSpecManager  # type: ignore
+
+        self.dir = tempfile.mkdtemp(prefix="bench_kernel_")
+        kernel_dir = os.path.join(self.dir, "bench_wasm")
+        os.makedirs(kernel_dir)
+        with open(os.path.join(kernel_dir, "kernel.json"), "w") as f:
+            json.dump(
+                {
+                    "argv": [
+                        sys.executable,
+                        "-m",
+                        "wasm_spec_kernel",
+                        "-f",
+                        "{connection_file}",
+                    ],
+                    "display_name": "Benchmark Wasm",
+                    "env": {"WASM_INTERPRETER": interpreter, **env},
+                },
+                f,
+            )
+        self.manager = KernelSpecManager(kernel_dirs=[self.dir])
+
+    def start(self):
+        from jupyter_client import KernelManager  # type: ignore
+
+        km = KernelManager(kernel_name="bench_wasm", kernel_spec_manager=self.manager)
+        km.start_kernel(cwd=os.path.join(HERE, ".."))
+        kc = km.client()
+        kc.start_channels()
+        return km, kc
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def execute(kc, code, timeout=60):
+    """Execute a cell and wait until the kernel is idle again"""
+    msg_id = kc.execute(code)
+    status = None
+    while True:
+        reply = kc.get_shell_msg(timeout=timeout)
+        if reply["parent_header"].get("msg_id") == msg_id:
+            status = reply["content"]["status"]
+            break
+    while True:
+        msg = kc.get_iopub_msg(timeout=timeout)
+        if (
+            msg["parent_header"].get("msg_id") == msg_id
+            and msg["msg_type"] == "status"
+            and msg["content"]["execution_state"] == "idle"
+        ):
+            break
+    if status != "ok":
+        raise RuntimeError("the benchmark cell failed: %s" % code)
+
+
+def bench_cold_start(args, spec):
+    ready = []
+    first_cell = []
+    for _ in range(args.repeat_kernel):
+        start = time.perf_counter()
+        km, kc = spec.start()
+        try:
+            kc.wait_for_ready(timeout=60)
+            ready.append(time.perf_counter() - start)
+            execute(kc, BENCH_MODULE)
+            first_cell.append(time.perf_counter() - start)
+        finally:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+    return {"ready": summarize(ready), "first_cell": summarize(first_cell)}
+
+
+def bench_restart(args, spec):
+    from wasm_spec_kernel.kernel import WasmKernel
+
+    results = {}
+    for name, spares in (("with_spare", "1"), ("without_spare", "0")):
+        os.environ["WASM_KERNEL_SPARES"] = spares
+        kernel = WasmKernel()
+        try:
+            wasmwrapper = kernel._starting.result(timeout=60)
+            kernel._starting = None
+            kernel.wasmwrapper, kernel.child = wasmwrapper, wasmwrapper.child
+            times = []
+            for _ in range(args.repeat):
+                # let the spare start, so that only taking it over is measured
+                time.sleep(args.spare_wait if spares != "0" else 0)
+                start = time.perf_counter()
+                kernel._start_wasm(kill_existing=True)
+                times.append(time.perf_counter() - start)
+            results[name] = summarize(times)
+        finally:
+            kernel.do_shutdown(False)
+            del os.environ["WASM_KERNEL_SPARES"]
+    return results
+
+
+def bench_cell_latency(args, spec):
+    repl = spawn_wasm(args.interpreter)
+    try:
+        repl.run_command(BENCH_MODULE)
+        results = {}
+        for framed in (False, True):
+            for lines in LINE_COUNTS:
+                cell = "\n".join([BENCH_CELL] * lines)
+                times = measure(
+                    lambda: repl.run_command(cell, timeout=None, framed=framed),
+                    args.repeat,
+                )
+                results[
+                    "%s_%d_lines" % ("framed" if framed else "lines", lines)
+                ] = summarize(times)
+        return results
+    finally:
+        repl.child.terminate(force=True)
+
+
+def bench_throughput(args, spec):
+    if args.interpreter != FAKE_WASM:
+        return None
+    repl = spawn_wasm(args.interpreter)
+    try:
+        repl.run_command(BENCH_MODULE)
+        results = {}
+        for streamed in (False, True):
+            on_output = (lambda text: None) if streamed else None
+            for mb in OUTPUT_SIZES:
+                # fake_wasm.py prints `N : i32` for each line, 10 bytes on average
+                size = 0
+                cell = '(invoke $Bench "lines" (i32.const %d))' % (mb * 2 ** 20 // 10)
+
+                def run():
+                    nonlocal size
+                    output = repl.run_command(
+                        cell, timeout=None, framed=True, on_output=on_output
+                    )
+                    size = len(output) if output is not None else mb * 2 ** 20
+
+                times = measure(run, max(args.repeat // 2, 1))
+                rates = [size / 2 ** 20 / t for t in times]
+                key = "%s_%dMB" % ("streamed" if streamed else "collected", mb)
+                results[key] = summarize(rates, "MB/s")
+        return results
+    finally:
+        repl.child.terminate(force=True)
+
+
+def bench_execute_overhead(args, spec):
+    repl = spawn_wasm(args.interpreter)
+    try:
+        repl.run_command(BENCH_MODULE)
+        direct = measure(lambda: repl.run_command(BENCH_CELL), args.repeat_execute)
+    finally:
+        repl.child.terminate(force=True)
+    km, kc = spec.start()
+    try:
+        kc.wait_for_ready(timeout=60)
+        execute(kc, BENCH_MODULE)
+        kernel = measure(lambda: execute(kc, BENCH_CELL), args.repeat_execute)
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+    overhead = statistics.median(kernel) - statistics.median(direct)
+    return {
+        "run_command": summarize(direct),
+        "execute_request": summarize(kernel),
+        "overhead": {"unit": "s", "median": overhead},
+    }
+
+
+BENCHMARKS = {
+    "cold_start": bench_cold_start,
+    "restart": bench_restart,
+    "cell_latency": bench_cell_latency,
+    "throughput": bench_throughput,
+    "execute_overhead": bench_execute_overhead,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print how each metric changed since `baseline`, and return the metrics which
+    got worse by more than `tolerance` (a ratio)
+    """
+    regressions = []
+    print("%-40s %12s %12s %8s" % ("metric", "baseline", "current", "ratio"))
+    for bench, cases in sorted(results["benchmarks"].items()):
+        old_cases = baseline.get("benchmarks", {}).get(bench) or {}
+        for case, metric in sorted((cases or {}).items()):
+            old = old_cases.get(case)
+            if old is None or old["unit"] != metric["unit"] or not old["median"]:
+                continue
+            ratio = metric["median"] / old["median"]
+            # times should go down, rates up
+            worse = ratio if metric["unit"] == "s" else 1 / ratio if ratio else 0
+            name = "%s.%s" % (bench, case)
+            print(
+                "%-40s %12.4g %12.4g %7.2fx%s"
+                % (
+                    name,
+                    old["median"],
+                    metric["median"],
+                    ratio,
+                    " !" if worse > tolerance else "",
+                )
+            )
+            if worse > tolerance:
+                regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--interpreter",
+        default=FAKE_WASM,
+        help="the Wasm interpreter to benchmark against (default: fake_wasm.py)",
+    )
+    parser.add_argument(
+        "--only",
+        default=",".join(BENCHMARKS),
+        help="comma separated benchmarks to run (default: all)",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="compare the results to those in this JSON file"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="how many times worse a metric may get before --compare fails",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="run each benchmark only a few times, as a smoke test",
+    )
+    args = parser.parse_args()
+    args.interpreter = os.path.abspath(args.interpreter)
+    args.repeat = 2 if args.quick else 10
+    args.repeat_kernel = 1 if args.quick else 5
+    args.repeat_execute = 5 if args.quick else 100
+    args.spare_wait = 0.5
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_kernel_cache_")
+    env = {"WASM_KERNEL_CACHE_DIR": cache_dir}
+    os.environ.update(env, WASM_INTERPRETER=args.interpreter)
+    spec = KernelSpec(args.interpreter, env)
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "interpreter": os.path.basename(args.interpreter),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "benchmarks": {},
+    }
+    try:
+        for name in args.only.split(","):
+            print("running %s..." % name, file=sys.stderr)
+            results["benchmarks"][name] = BENCHMARKS[name](args, spec)
+    finally:
+        spec.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("regressed: %s" % ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Measures how long WasmREPLWrapper.run_command takes to collect large outputs.
+
+The Wasm interpreter is replaced by a tiny REPL which answers each line of input (a
+number of bytes) with that much output, so that only the wrapper's reading and prompt
+matching is measured. The time per MB should stay roughly constant as the output
+grows.
+
+    python benchmarks/bench_output.py [--sizes 1,2,4,8] [--streamed]
+"""
+import argparse
+import os
+import sys
+import time
+
+import pexpect  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from wasm_spec_kernel.wasm_replwrap import WasmREPLWrapper  # noqa: E402
+
+
+# Prints "> " and then, for each line of input, that many bytes of output in lines
+# which look like the interpreter's (indented, so they resemble continuation prompts)
+FAKE_REPL = r"""
+import sys
+line = "  export func \"getNum\" : [] -> [i32]\n"
+out = sys.stdout
+out.write("> ")
+out.flush()
+for request in sys.stdin:
+    size = int(request)
+    out.write(line * (size // len(line)))
+    out.write("> ")
+    out.flush()
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default="1,2,4,8",
+        help="comma separated output sizes to measure, in MB",
+    )
+    parser.add_argument(
+        "--streamed",
+        action="store_true",
+        help="pass the output to an on_output callback, as the kernel does",
+    )
+    args = parser.parse_args()
+
+    child = pexpect.spawn(
+        sys.executable, ["-c", FAKE_REPL], echo=False, encoding="utf-8"
+    )
+    repl = WasmREPLWrapper(child)
+    on_output = (lambda text: None) if args.streamed else None
+    print("%8s %10s %10s" % ("MB", "seconds", "s/MB"))
+    for mb in (float(size) for size in args.sizes.split(",")):
+        start = time.perf_counter()
+        repl.run_command(str(int(mb * 2 ** 20)), timeout=None, on_output=on_output)
+        elapsed = time.perf_counter() - start
+        print("%8g %10.3f %10.3f" % (mb, elapsed, elapsed / mb))
+    child.terminate(force=True)
+
+
+if __name__ == "__main__":
+    main()
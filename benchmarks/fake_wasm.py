@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""A stand-in for the Wasm reference interpreter's REPL, for benchmarking the kernel on
+machines which don't have an OCaml build of `wasm`.
+
+It prints the same prompts (`> `, and `  ` while a form is incomplete) and the same
+kinds of output as the interpreter: module listings, invocation results, failed
+assertions and errors with their source locations, and `input` of script files (which
+can also be run non-interactively by passing them as arguments, or with `-e`). Like
+the interpreter's, scripts stop at their first error, and only print module signatures
+with `-s`. Wasm code isn't validated or executed. Instead, an invocation returns the constants at the
+start of the function's body (or zeros), and a few export names are scriptable:
+
+* `"lines"` prints as many lines of output as its first argument, e.g.
+  `(invoke "lines" (i32.const 1000))`
+* `"loop"` spins forever, until the process is interrupted
+
+Delays can be added with environment variables (in seconds):
+
+* `FAKE_WASM_STARTUP_DELAY`: before the first prompt
+* `FAKE_WASM_COMMAND_DELAY`: before each command is answered
+
+    WASM_INTERPRETER=benchmarks/fake_wasm.py jupyter console --kernel wasm_spec
+"""
+import os
+import re
+import sys
+import time
+
+
+BANNER = "wasm 2.0 reference interpreter (fake_wasm.py)"
+
+token_pat = re.compile(
+    r"""\s+|;;[^\n]*|\(;.*?;\)|"(?:[^"\\]|\\.)*"|[()]|[^\s()";]+""", re.DOTALL
+)
+
+
+class ScriptError(Exception):
+    def __init__(self, category, message, region=None):
+        super().__init__(message)
+        self.category = category
+        self.message = message
+        self.region = region
+
+
+def parse_forms(text, first_line=1):
+    """Parse the complete top-level forms at the start of `text` into nested lists
+    of atoms. Returns a list of each form and its region in the source (e.g.
+    `2.1-2.65`), and the offset of the unparsed rest of the text.
+    """
+    forms = []
+    stack = []
+    line = first_line
+    line_start = 0
+    form_start = None
+    pos = 0
+    end = 0
+    while pos < len(text):
+        if text.startswith("(;", pos) and text.find(";)", pos + 2) < 0:
+            break
+        m = token_pat.match(text, pos)
+        if m is None:
+            if text.startswith('"', pos):
+                break
+            m = re.compile(r"\S+").match(text, pos)
+        token = m.group(0)
+        start = "%d.%d" % (line, pos - line_start + 1)
+        pos = m.end()
+        if token == "(":
+            if not stack:
+                form_start = start
+            stack.append([])
+        elif token == ")" and stack:
+            form = stack.pop()
+            if stack:
+                stack[-1].append(form)
+            else:
+                forms.append(
+                    (form, "%s-%d.%d" % (form_start, line, pos - line_start + 1))
+                )
+                end = pos
+        elif not token[0].isspace() and not token.startswith(";"):
+            if not stack:
+                region = "%s-%d.%d" % (start, line, pos - line_start + 1)
+                raise ScriptError("syntax error", "unexpected token", region)
+            stack[-1].append(token)
+        newlines = token.count("\n")
+        if newlines:
+            line += newlines
+            line_start = m.start() + token.rindex("\n") + 1
+    return forms, end
+
+
+def const_value(form):
+    """The value of a `(t.const v)` form"""
+    if isinstance(form, list) and len(form) == 2 and str(form[0]).endswith(".const"):
+        return form[0].split(".")[0], form[1]
+    raise ScriptError("syntax error", "unexpected token")
+
+
+def format_values(values):
+    if len(values) == 1:
+        return "%s : %s" % (values[0][1], values[0][0])
+    return "[%s] : [%s]" % (
+        " ".join(value for _, value in values),
+        " ".join(t for t, _ in values),
+    )
+
+
+class FakeInterpreter:
+    def __init__(self, out, print_sig=True):
+        self.out = out
+        # whether module signatures are printed, which the interpreter only does in
+        # its REPL, or with `-s`
+        self.print_sig = print_sig
+        self.command_delay = float(os.environ.get("FAKE_WASM_COMMAND_DELAY", "0"))
+        self.modules = {}
+        self.last_module = None
+        self.source = "stdin"
+        self.errors = 0
+
+    def run(self, form, region):
+        """Run a command, returning whether it succeeded"""
+        if self.command_delay:
+            time.sleep(self.command_delay)
+        try:
+            self.command(form)
+        except ScriptError as e:
+            self.error(e, region)
+            return False
+        return True
+
+    def error(self, e, region):
+        self.errors += 1
+        self.out.write(
+            "%s:%s: %s: %s\n" % (self.source, e.region or region, e.category, e.message)
+        )
+
+    def command(self, form):
+        head = form[0] if form else None
+        if head == "module":
+            self.define_module(form)
+        elif head == "register":
+            self.modules[form[1]] = self.find_module(form[2] if len(form) > 2 else None)
+        elif head == "invoke":
+            values = self.invoke(form)
+            if values:
+                self.out.write(format_values(values) + "\n")
+        elif head == "assert_return":
+            values = self.invoke(form[1])
+            expected = [const_value(arg) for arg in form[2:]]
+            if values != expected:
+                self.out.write("Result: %s\n" % format_values(values))
+                self.out.write("Expect: %s\n" % format_values(expected))
+                raise ScriptError("assertion failure", "wrong return values")
+        elif head == "input":
+            self.input(form[1].strip('"'))
+        elif isinstance(head, str) and head.startswith("assert_"):
+            pass
+        else:
+            raise ScriptError("syntax error", "unexpected token")
+
+    def define_module(self, form):
+        name = form[1] if len(form) > 1 and str(form[1]).startswith("$") else None
+        exports = {}
+        listing = ["module %s :" % name if name else "module :"]
+        for field in form[1:]:
+            if not isinstance(field, list) or field[0] != "func":
+                continue
+            export_names = [
+                part[1].strip('"')
+                for part in field
+                if isinstance(part, list) and part[0] == "export"
+            ]
+            params = [
+                t
+                for part in field
+                if isinstance(part, list) and part[0] == "param"
+                for t in part[1:]
+                if not t.startswith("$")
+            ]
+            results = [
+                t
+                for part in field
+                if isinstance(part, list) and part[0] == "result"
+                for t in part[1:]
+            ]
+            consts = [
+                const_value(part)
+                for part in field
+                if isinstance(part, list) and str(part[0]).endswith(".const")
+            ]
+            for export_name in export_names:
+                exports[export_name] = (results, consts)
+                listing.append(
+                    '  export func "%s" : [%s] -> [%s]'
+                    % (export_name, " ".join(params), " ".join(results))
+                )
+        module = {"exports": exports}
+        if name:
+            self.modules[name] = module
+        self.last_module = module
+        if self.print_sig:
+            self.out.write("\n".join(listing) + "\n")
+
+    def find_module(self, name):
+        module = self.last_module if name is None else self.modules.get(name)
+        if module is None:
+            raise ScriptError("unknown module", name or "no module defined")
+        return module
+
+    def invoke(self, form):
+        if not form or form[0] != "invoke":
+            raise ScriptError("syntax error", "unexpected token")
+        args = form[1:]
+        name = args.pop(0) if args and args[0].startswith("$") else None
+        module = self.find_module(name)
+        export_name = args.pop(0).strip('"') if args else ""
+        if export_name not in module["exports"]:
+            raise ScriptError("unknown export", '"%s"' % export_name)
+        args = [const_value(arg) for arg in args]
+        if export_name == "loop":
+            while True:
+                pass
+        if export_name == "lines":
+            count = int(args[0][1], 0) if args else 0
+            self.out.writelines("%d : i32\n" % i for i in range(count))
+            return []
+        results, consts = module["exports"][export_name]
+        if [t for t, _ in consts] == results:
+            return consts
+        return [(t, "0") for t in results]
+
+    def input(self, path):
+        """Run a script file, stopping at its first error like the interpreter does.
+        Returns whether the whole script succeeded.
+        """
+        try:
+            with open(path) as f:
+                text = f.read()
+        except OSError:
+            raise ScriptError("i/o error", "%s: No such file or directory" % path)
+        return self.run_script(text, path)
+
+    def run_script(self, text, source):
+        source, self.source = self.source, source
+        try:
+            forms, end = parse_forms(text)
+            for form in forms:
+                if not self.run(*form):
+                    return False
+            if text[end:].strip():
+                raise ScriptError("syntax error", "unexpected end of input", "1.1-1.1")
+        except ScriptError as e:
+            self.error(e, None)
+            return False
+        finally:
+            self.source = source
+        return True
+
+
+def repl(interpreter):
+    out = interpreter.out
+    pending = ""
+    out.write("> ")
+    out.flush()
+    # the line which the pending input starts on
+    first_line = 1
+    # how much of the pending input has been tokenized, and its nesting depth, so
+    # that it's only parsed once a top-level form may be complete (parsing it after
+    # every line would be quadratic in the size of a form)
+    scanned = 0
+    depth = 0
+    for line in sys.stdin:
+        pending += line
+        ready = False
+        while scanned < len(pending) and not ready:
+            m = token_pat.match(pending, scanned)
+            if pending.startswith("(;", scanned) and pending.find(";)", scanned) < 0:
+                break
+            if m is None:
+                if pending.startswith('"', scanned):
+                    break
+                ready = True
+                break
+            token = m.group(0)
+            scanned = m.end()
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+                ready = depth <= 0
+            elif depth == 0 and not token[0].isspace() and not token.startswith(";"):
+                ready = True
+        if not ready:
+            out.write("  " if pending.strip() else "> ")
+            out.flush()
+            continue
+        scanned = depth = 0
+        try:
+            forms, end = parse_forms(pending, first_line)
+        except ScriptError as e:
+            interpreter.error(e, None)
+            forms, end = [], len(pending)
+        for form in forms:
+            interpreter.run(*form)
+        first_line += pending[:end].count("\n")
+        pending = pending[end:]
+        if not pending.strip():
+            first_line += pending.count("\n")
+            pending = ""
+        out.write("  " if pending else "> ")
+        out.flush()
+    out.write("\n")
+
+
+def main(argv):
+    # scripts (given with `-e`) and files are run in order, and the interpreter exits
+    # at the first one which fails
+    scripts = []
+    print_sig = False
+    args = iter(argv)
+    for arg in args:
+        if arg == "-v":
+            print(BANNER)
+        elif arg == "-e":
+            scripts.append((next(args, ""), None))
+        elif arg == "-s":
+            print_sig = True
+        elif arg == "-w":
+            next(args, None)
+        elif arg.endswith((".wat", ".wast")):
+            scripts.append((None, arg))
+        else:
+            print("fake_wasm.py: unsupported option %s" % arg, file=sys.stderr)
+            return 1
+    if scripts:
+        interpreter = FakeInterpreter(sys.stdout, print_sig)
+        for script, path in scripts:
+            try:
+                if path is None:
+                    ok = interpreter.run_script(script, "stdin")
+                else:
+                    ok = interpreter.input(path)
+            except ScriptError as e:
+                interpreter.error(e, None)
+                ok = False
+            if not ok:
+                return 1
+        return 0
+    time.sleep(float(os.environ.get("FAKE_WASM_STARTUP_DELAY", "0")))
+    repl(FakeInterpreter(sys.stdout))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+"""Runs many kernels on this host at once, to find where their latency or memory use
+stops scaling.
+
+For each number of kernels in `--kernels`, that many kernels are started at the same
+time, and each one executes `--cells` cells picked at random from a mix of cell kinds
+(see CELLS and `--mix`). The execute latency (p50 and p99), startup time, and memory
+use (RSS of each kernel and its interpreters, read from /proc so Linux only) are
+reported for each step, and written as JSON with `--output`.
+
+By default the Wasm interpreter is replaced by `fake_wasm.py`, see bench_kernel.py.
+
+    python benchmarks/load_test.py --kernels 1,2,4,8,16 --mix invoke=8,module=1,output=1
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from bench_kernel import BENCH_MODULE, FAKE_WASM, KernelSpec, execute
+
+# The kinds of cell which a mix can contain
+CELLS = {
+    "invoke": '(invoke $Bench "get")',
+    "assertion": '(assert_return (invoke $Bench "get") (i32.const 4))',
+    "module": (
+        "(module $Load\n"
+        '  (func (export "add") (param i32 i32) (result i32)\n'
+        "    (i32.add (local.get 0) (local.get 1))))"
+    ),
+    "output": '(invoke $Bench "lines" (i32.const 1000))',
+    "error": '(invoke $Missing "get")',
+}
+
+
+def percentile(values, q):
+    """The nearest-rank percentile `q` (0-100) of `values`"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(round(q / 100 * len(values))) - 1, 0)]
+
+
+def process_rss(pid):
+    """The resident memory of a process and its descendants, in bytes"""
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open("/proc/%d/statm" % pid) as f:
+                total += int(f.read().split()[1]) * page_size
+            for tid in os.listdir("/proc/%d/task" % pid):
+                with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in CELLS:
+            raise SystemExit(
+                "unknown cell kind `%s`, choose from: %s" % (name, ", ".join(CELLS))
+            )
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class LoadKernel:
+    """One kernel of the load test, which is driven by its own thread"""
+
+    def __init__(self, spec, weights, cells, seed):
+        self.spec = spec
+        self.weights = weights
+        self.cells = cells
+        self.random = random.Random(seed)
+        self.startup = None
+        self.latencies = []
+        self.failures = 0
+        self.rss = None
+        self.error = None
+        self.km = self.kc = None
+
+    def start(self):
+        start = time.perf_counter()
+        self.km, self.kc = self.spec.start()
+        self.kc.wait_for_ready(timeout=120)
+        execute(self.kc, BENCH_MODULE, timeout=120)
+        self.startup = time.perf_counter() - start
+
+    def drive(self):
+        kinds = list(self.weights)
+        weights = [self.weights[kind] for kind in kinds]
+        for _ in range(self.cells):
+            kind = self.random.choices(kinds, weights)[0]
+            start = time.perf_counter()
+            try:
+                execute(self.kc, CELLS[kind], timeout=120)
+            except RuntimeError:
+                # a cell which fails is still a complete round-trip
+                if kind != "error":
+                    self.failures += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def run(self, started):
+        try:
+            self.start()
+        except Exception as e:
+            self.error = "%s: %s" % (type(e).__name__, e)
+        # cells aren't executed until every kernel has started (or failed to), so
+        # that startup and execution are measured separately
+        try:
+            started.wait(timeout=300)
+        except threading.BrokenBarrierError:
+            pass
+        if self.error is not None:
+            return
+        try:
+            self.drive()
+            self.rss = process_rss(self.km.kernel.pid)
+        except Exception as e:
+            self.error = "%s: %s" % (type(e).__name__, e)
+
+    def shutdown(self):
+        if self.kc is not None:
+            self.kc.stop_channels()
+        if self.km is not None:
+            try:
+                self.km.shutdown_kernel(now=True)
+            except Exception:
+                pass
+
+
+def run_step(args, spec, weights, count):
+    kernels = [
+        LoadKernel(spec, weights, args.cells, seed=args.seed + i) for i in range(count)
+    ]
+    started = threading.Barrier(count + 1)
+    threads = [
+        threading.Thread(target=kernel.run, args=(started,)) for kernel in kernels
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        started.wait(timeout=300)
+    except threading.BrokenBarrierError:
+        pass
+    drive_start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - drive_start
+    for kernel in kernels:
+        kernel.shutdown()
+
+    latencies = [t for kernel in kernels for t in kernel.latencies]
+    startups = [kernel.startup for kernel in kernels if kernel.startup is not None]
+    rss = [kernel.rss for kernel in kernels if kernel.rss is not None]
+    return {
+        "kernels": count,
+        "errors": [kernel.error for kernel in kernels if kernel.error],
+        "failed_cells": sum(kernel.failures for kernel in kernels),
+        "cells": len(latencies),
+        "cells_per_second": len(latencies) / elapsed if elapsed else None,
+        "startup": {
+            "p50": percentile(startups, 50),
+            "p99": percentile(startups, 99),
+            "total": drive_start - start,
+        },
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "rss_mb": {
+            "mean": statistics.mean(rss) / 2 ** 20 if rss else None,
+            "max": max(rss) / 2 ** 20 if rss else None,
+            "total": sum(rss) / 2 ** 20 if rss else None,
+        },
+    }
+
+
+def _format(value, scale=1, spec="%.1f"):
+    return "-" if value is None else spec % (value * scale)
+
+
+def print_step(step):
+    print(
+        "%7d %9s %9s %9s %9s %9s %9s %9s %s"
+        % (
+            step["kernels"],
+            _format(step["startup"]["p50"], 1000, "%.0f"),
+            _format(step["startup"]["p99"], 1000, "%.0f"),
+            _format(step["latency"]["p50"], 1000),
+            _format(step["latency"]["p99"], 1000),
+            _format(step["cells_per_second"]),
+            _format(step["rss_mb"]["mean"]),
+            _format(step["rss_mb"]["total"]),
+            "%d errors" % len(step["errors"]) if step["errors"] else "",
+        ),
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--kernels",
+        default="1,2,4,8",
+        help="comma separated numbers of concurrent kernels to step through",
+    )
+    parser.add_argument(
+        "--cells", type=int, default=50, help="how many cells each kernel executes"
+    )
+    parser.add_argument(
+        "--mix",
+        default="invoke=8,assertion=4,module=2,output=1,error=1",
+        help="the cell kinds to execute and their weights, from: %s" % ", ".join(CELLS),
+    )
+    parser.add_argument(
+        "--interpreter",
+        default=FAKE_WASM,
+        help="the Wasm interpreter to use (default: fake_wasm.py)",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="an environment variable for the kernels, e.g. a kernel option",
+    )
+    parser.add_argument(
+        "--max-p99",
+        type=float,
+        help="stop once the p99 execute latency goes over this many seconds",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    cache_dir = tempfile.mkdtemp(prefix="load_test_cache_")
+    env = {"WASM_KERNEL_CACHE_DIR": cache_dir}
+    env.update(item.split("=", 1) for item in args.env)
+    spec = KernelSpec(os.path.abspath(args.interpreter), env)
+    results = {"mix": weights, "cells": args.cells, "steps": []}
+    print(
+        "%7s %9s %9s %9s %9s %9s %9s %9s"
+        % (
+            "kernels",
+            "start50",
+            "start99",
+            "exec50",
+            "exec99",
+            "cells/s",
+            "rss/k",
+            "rss",
+        )
+    )
+    print(
+        "%7s %9s %9s %9s %9s %9s %9s %9s" % ("", "ms", "ms", "ms", "ms", "", "MB", "MB")
+    )
+    try:
+        for count in (int(n) for n in args.kernels.split(",")):
+            step = run_step(args, spec, weights, count)
+            results["steps"].append(step)
+            print_step(step)
+            for error in step["errors"]:
+                print("  error: %s" % error, file=sys.stderr)
+            if args.max_p99 is not None and (
+                step["latency"]["p99"] is None or step["latency"]["p99"] > args.max_p99
+            ):
+                print("p99 latency is over %ss, stopping" % args.max_p99)
+                break
+    finally:
+        spec.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
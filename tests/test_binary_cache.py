@@ -0,0 +1,84 @@
+import subprocess
+
+import pytest
+
+from wasm_spec_kernel.binary_cache import BinaryModuleCache, binary_module
+from wasm_spec_kernel.startup import spawn_wasm
+
+MODULE = """\
+(module $Big
+  (func (export "getNum") (result i32) (i32.const 4))
+)"""
+ENCODED = b'\x00asm\x01\x00\x00\x00"\\'
+
+
+def new_cache(test_wasm_path, tmp_path, monkeypatch):
+    cache = BinaryModuleCache(test_wasm_path, str(tmp_path / "modules"), 50)
+    monkeypatch.setattr(cache, "_encode", lambda module_text: ENCODED)
+    return cache
+
+
+def test_binary_module():
+    assert binary_module("$M", ENCODED, width=4) == (
+        '(module $M binary\n  "\\00asm"\n  "\\01\\00\\00\\00"\n  "\\22\\5c")'
+    )
+    assert binary_module("", b"\x00") == '(module binary\n  "\\00")'
+
+
+def test_caches_large_modules(test_wasm_path, tmp_path, monkeypatch):
+    cache = new_cache(test_wasm_path, tmp_path, monkeypatch)
+    assert cache.lookup(MODULE) is None
+    cache.add(MODULE).join()
+    assert cache.lookup(MODULE) == binary_module("$Big", ENCODED)
+    assert cache.add(MODULE) is None
+    # the encoding is kept on disk for other kernels
+    other = new_cache(test_wasm_path, tmp_path, monkeypatch)
+    assert other.lookup(MODULE) == binary_module("$Big", ENCODED)
+
+
+def test_only_caches_single_text_modules(test_wasm_path, tmp_path, monkeypatch):
+    cache = new_cache(test_wasm_path, tmp_path, monkeypatch)
+    for code in [
+        "(module $Small)",
+        MODULE + "\n(invoke $Big " + '"getNum")',
+        '(module $Binary binary "\\00asm\\01\\00\\00\\00")',
+        '(assert_return (invoke $Big "getNum") (i32.const 4))',
+    ]:
+        thread = cache.add(code)
+        if thread is not None:
+            thread.join()
+        assert cache.lookup(code) is None
+
+
+def converts_modules(wasm_path, tmp_path):
+    """Whether the interpreter can convert text modules to binary, which the stand-in
+    for it in the benchmarks can't
+    """
+    (tmp_path / "empty.wat").write_text("(module)")
+    result = subprocess.run(
+        [wasm_path, "-d", str(tmp_path / "empty.wat"), "-o", str(tmp_path / "e.wasm")],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0 and (tmp_path / "e.wasm").exists()
+
+
+def test_interpreter_encodes_modules(test_wasm_path, tmp_path):
+    """Modules should be encoded by the interpreter, which should define the same
+    module from the cached encoding
+    """
+    if not converts_modules(test_wasm_path, tmp_path):
+        pytest.skip("the interpreter can't convert modules to binary")
+    cache = BinaryModuleCache(test_wasm_path, str(tmp_path / "modules"), 50)
+    cache.add(MODULE).join()
+    command = cache.lookup(MODULE)
+    assert command.startswith("(module $Big binary\n")
+    wasmwrapper = spawn_wasm(test_wasm_path)
+    try:
+        assert wasmwrapper.run_command(command, framed=True) == (
+            'module $Big :\n  export func "getNum" : [] -> [i32]'
+        )
+        assert wasmwrapper.run_command('(invoke $Big "getNum")') == "4 : i32"
+    finally:
+        wasmwrapper.child.terminate(force=True)
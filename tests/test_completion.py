@@ -0,0 +1,57 @@
+import time
+
+from wasm_spec_kernel.completion import PrefixTrie, SymbolIndex
+
+
+def test_prefix_trie():
+    trie = PrefixTrie(["i32.add", "i32.and", "i64.add"])
+    assert trie.complete("i32.a") == ("i32.add", "i32.and")
+    assert trie.complete("f32") == ()
+    trie.add("i32.abs")
+    assert trie.complete("i32.a") == ("i32.abs", "i32.add", "i32.and")
+    assert len(trie) == 4 and "i64.add" in trie
+
+
+def test_complete_keywords():
+    reply = SymbolIndex().complete("(module (func (i32.ad", 21)
+    assert reply["matches"] == ["i32.add"]
+    assert (reply["cursor_start"], reply["cursor_end"]) == (15, 21)
+
+
+def test_complete_session_symbols():
+    index = SymbolIndex()
+    index.add_code('(module $Adder (func $add (export "add")))')
+    index.add_output('module $Other :\r\n  export func "addAll" : [] -> []\r\n')
+    code = "(invoke $"
+    assert index.complete(code, len(code))["matches"] == ["$Adder", "$Other", "$add"]
+    code = '(invoke $Other "ad'
+    assert index.complete(code, len(code))["matches"] == ['"add"', '"addAll"']
+    # identifiers from the cell being edited are offered too
+    code = "(module $Local)\n(invoke $Lo"
+    assert index.complete(code, len(code))["matches"] == ["$Local"]
+
+
+def test_long_output_line():
+    """A long line of output which arrives in pieces should only be kept up to the
+    index's line limit, and the lines after it should still be indexed
+    """
+    index = SymbolIndex()
+    for _ in range(64):
+        index.add_output("0 " * 32 * 1024)
+        assert len(index._partial_output) <= index.max_line
+    index.add_output(' : [i32]\nmodule $After :\n  export func "after" : [] -> []\n')
+    index.end_output()
+    assert index.complete("$Af", 3)["matches"] == ["$After"]
+    assert index.complete('"af', 3)["matches"] == ['"after"']
+
+
+def test_complete_latency():
+    index = SymbolIndex()
+    for i in range(500):
+        index.add_code('(module $M%d (func $f%d (export "f%d")))' % (i, i, i))
+    code = "(module $M1 (func $f1))\n" * 50 + "(invoke $M"
+    index.complete(code, len(code))
+    start = time.perf_counter()
+    for _ in range(100):
+        index.complete(code, len(code))
+    assert (time.perf_counter() - start) / 100 < 0.001
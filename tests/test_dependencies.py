@@ -0,0 +1,58 @@
+from wasm_spec_kernel.dependencies import DependencyGraph
+
+
+MODULE_A = """(module $A (func (export "getNum") (result i32) (i32.const 4)))"""
+
+
+def test_symbols(tmp_path):
+    graph = DependencyGraph()
+    script = tmp_path / "imports.wast"
+    script.write_text(
+        """(module $C (import "b" "f" (func)))
+(invoke $C "run")"""
+    )
+    graph.add(
+        MODULE_A
+        + """
+(register "a" $A)
+(module $B (import "a" "getNum" (func (result i32))) ;; (invoke $X "f")
+  (func (export "f")))
+(register "b")
+(assert_return (invoke $B "f"))
+(module (func (export "g")))
+(invoke "g")
+(input "%s")"""
+        % script,
+        1,
+    )
+    assert [(set(form.defines), set(form.references)) for form in graph.forms] == [
+        ({"$A"}, set()),
+        ({'"a"'}, {"$A"}),
+        ({"$B"}, {'"a"'}),
+        ({'"b"'}, {"$B"}),
+        (set(), {"$B"}),
+        ({"module:1"}, set()),
+        (set(), {"module:1"}),
+        ({"$C"}, {'"b"'}),
+    ]
+
+
+def test_affected():
+    graph = DependencyGraph()
+    graph.add(MODULE_A, 1)
+    graph.add("""(register "a" $A)""", 2)
+    graph.add("""(module $B (import "a" "getNum" (func (result i32))))""", 3)
+    graph.add("""(module $Other)\n(assert_return (invoke $B "f"))""", 4)
+    graph.add("""(invoke $Other "f")""", 5)
+    # cell 1 is edited and executed again
+    graph.add(MODULE_A.replace("4", "3"), 6)
+
+    names, end = graph.last_cell_change()
+    assert (names, end) == ({"$A"}, 6)
+    affected = graph.affected(names, end)
+    assert [form.cell for form in affected] == [2, 3, 4]
+    assert affected[2].code == """(assert_return (invoke $B "f"))"""
+
+    # once the affected forms are run again, the earlier runs are superseded
+    graph.add("\n".join(form.code for form in affected), 7)
+    assert [form.cell for form in graph.affected({'"a"'})] == [7, 7]
@@ -8,12 +8,19 @@ import time
 from traitlets.config.loader import Config  # type: ignore
 from jupyter_client import KernelManager  # type: ignore
 from jupyter_core import paths  # type: ignore
-from subprocess import PIPE
+from subprocess import PIPE, Popen
 
 TIMEOUT = 30
+# How long a kernel may take to start and execute its first cell
+STARTUP_LIMIT = 10
 TEST_KERNEL_NAME = "test_wasm"
 
 
+# A cell which runs until it's interrupted (LOOP_MODULE has to be executed first)
+LOOP_MODULE = """(module $Looper (func (export "loop") (loop (br 0))))"""
+LOOP_CELL = """(invoke $Looper "loop")"""
+
+
 def execute_ok(kc, cmd):
     """run code on the kernel and check that the response was 'ok'
 
@@ -103,7 +110,49 @@ class TestKernel:
         return KernelManager(config=km_config)
 
     @pytest.fixture
-    def install_kernel(self, test_wasm_path):
+    def kernel_env(self, request, tmp_path):
+        """Extra environment variables for the test kernel, which can be selected by
+        indirectly parametrizing this fixture.
+        """
+        env = {"WASM_KERNEL_CACHE_DIR": str(tmp_path / "cache")}
+        if getattr(request, "param", None) == "prelude":
+            prelude = tmp_path / "prelude.wat"
+            prelude.write_text(
+                """(module $Prelude (func (export "getNum") (result i32) (i32.const 4)))"""
+            )
+            env["WASM_KERNEL_PRELUDE"] = str(prelude)
+            env["WASM_KERNEL_SPARES"] = "2"
+        elif getattr(request, "param", None) == "shadow":
+            env["WASM_KERNEL_SHADOW"] = "1"
+        elif getattr(request, "param", None) == "pool":
+            socket_path = str(tmp_path / "pool.sock")
+            daemon = Popen(
+                [sys.executable, "-m", "wasm_spec_kernel.pool", "--socket", socket_path]
+                + ["--interpreter", request.getfixturevalue("test_wasm_path")]
+            )
+            request.addfinalizer(daemon.terminate)
+            while not os.path.exists(socket_path):
+                time.sleep(0.05)
+            env["WASM_KERNEL_POOL_SOCKET"] = socket_path
+        elif getattr(request, "param", None) == "results":
+            env["WASM_KERNEL_RESULTS"] = "1"
+        elif getattr(request, "param", None) == "metrics":
+            env["WASM_KERNEL_METRICS"] = "1"
+            env["WASM_KERNEL_METRICS_DIR"] = str(tmp_path / "metrics")
+        elif getattr(request, "param", None) == "limits":
+            env["WASM_KERNEL_CELL_TIMEOUT"] = "1"
+            env["WASM_KERNEL_CPU_LIMIT"] = "0.5"
+        elif getattr(request, "param", None) == "output_limit":
+            env["WASM_KERNEL_OUTPUT_LIMIT"] = "200"
+        elif getattr(request, "param", None) == "standalone":
+            env["WASM_KERNEL_STANDALONE_MIN_FORMS"] = "3"
+        elif getattr(request, "param", None) == "result_cache":
+            env["WASM_KERNEL_RESULT_CACHE"] = "1"
+            env["WASM_KERNEL_METRICS"] = "1"
+        return env
+
+    @pytest.fixture
+    def install_kernel(self, test_wasm_path, kernel_env):
         """Install the test kernel to Jupyter.
 
         Adapted from https://github.com/jupyter/jupyter_client/blob/284914b/jupyter_client/tests/test_kernelmanager.py#L56
@@ -122,7 +171,7 @@ class TestKernel:
                             "{connection_file}",
                         ],
                         "display_name": "Test Wasm",
-                        "env": {"WASM_INTERPRETER": test_wasm_path},
+                        "env": {"WASM_INTERPRETER": test_wasm_path, **kernel_env},
                     }
                 )
             )
@@ -198,6 +247,39 @@ class TestKernel:
         assert kc.is_alive()
         assert km.context.closed is False
 
+    def test_kernel_info(self, install_kernel, start_kernel, kernel_env):
+        km, kc = start_kernel
+        kc.kernel_info()
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert "wasm" in reply["content"]["banner"]
+        # the probe is cached so that later kernels don't have to spawn the interpreter
+        # (once the kernel has probed the proposals in the background)
+        path = os.path.join(kernel_env["WASM_KERNEL_CACHE_DIR"], "probe.json")
+        deadline = time.monotonic() + TIMEOUT
+        while not os.path.exists(path):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    def test_startup_time(self, install_kernel):
+        start = time.monotonic()
+        km = KernelManager(kernel_name=TEST_KERNEL_NAME)
+        km.start_kernel()
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=60)
+            ready = time.monotonic() - start
+            execute_ok(kc, "(module $first)")
+            first_cell = time.monotonic() - start
+        finally:
+            kc.stop_channels()
+            km.shutdown_kernel()
+        print(
+            "kernel ready after %.3fs, first cell done after %.3fs"
+            % (ready, first_cell)
+        )
+        assert first_cell < STARTUP_LIMIT
+
     def test_execute(self, install_kernel, start_kernel):
         """
         Test adapted from https://github.com/jupyter/jupyter_client/blob/284914b/jupyter_client/tests/test_kernelmanager.py#L170
@@ -223,8 +305,9 @@ class TestKernel:
         km, kc = start_kernel
         # check that kernel is running
         execute_ok(kc, "(module $valid)")
+        execute_ok(kc, LOOP_MODULE)
         # start a job on the kernel to be interrupted
-        kc.execute("(module $incomplete")
+        kc.execute(LOOP_CELL)
         # wait for the command to be running before sending an interrupt
         time.sleep(0.1)
         km.interrupt_kernel()
@@ -232,3 +315,370 @@ class TestKernel:
         assert reply["content"]["status"] == "abort"
         # check that subsequent commands work
         execute_ok(kc, "(module $valid)")
+
+    def test_is_complete(self, install_kernel, start_kernel):
+        km, kc = start_kernel
+        for code, status in [
+            ("(module $complete)", "complete"),
+            ("(module $incomplete\n  (func", "incomplete"),
+            ("(module $invalid))", "invalid"),
+        ]:
+            kc.is_complete(code)
+            reply = kc.get_shell_msg(TIMEOUT)
+            assert reply["content"]["status"] == status
+            if status == "incomplete":
+                assert reply["content"]["indent"] == "    "
+
+    def test_complete(self, install_kernel, start_kernel):
+        km, kc = start_kernel
+        execute_ok(
+            kc,
+            """(module $Completed (func (export "getNum") (result i32) (i32.const 4)))""",
+        )
+        for code, match in [
+            ("(invoke $Comp", "$Completed"),
+            ('(invoke $Completed "get', '"getNum"'),
+            ("(assert_ret", "assert_return"),
+        ]:
+            kc.complete(code)
+            reply = kc.get_shell_msg(TIMEOUT)
+            assert reply["content"]["matches"] == [match]
+
+    def test_load_magics(self, install_kernel, start_kernel, tmp_path):
+        km, kc = start_kernel
+        script = tmp_path / "script.wast"
+        script.write_text(
+            """(module $Loaded (func (export "getNum") (result i32) (i32.const 4)))"""
+        )
+        execute_ok(kc, "%%load_wast %s" % (tmp_path / "*.wast"))
+        stdout, stderr = assemble_output(kc.iopub_channel)
+        assert "module $Loaded :" in stdout
+        execute_ok(kc, """(assert_return (invoke $Loaded "getNum") (i32.const 4))""")
+        kc.execute("%%load_wat %s" % (tmp_path / "*.wat"), stop_on_error=False)
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "error"
+        assert reply["content"]["ename"] == "magic error"
+
+    @pytest.mark.parametrize("kernel_env", ["output_limit"], indirect=True)
+    def test_output_limit(self, install_kernel, start_kernel):
+        """Output beyond the limit should be saved to disk, and paged with a magic"""
+        km, kc = start_kernel
+        exports = "\n".join(
+            '(func (export "f%d") (result i32) (i32.const %d))' % (i, i)
+            for i in range(100)
+        )
+        execute_ok(kc, "(module $Big %s)" % exports)
+        stdout, stderr = assemble_output(kc.iopub_channel)
+        assert stdout.startswith("module $Big :\n")
+        assert "omitted" in stdout and "%page_output 1" in stdout
+        assert stdout.endswith('export func "f99" : [] -> [i32]')
+        assert len(stdout) < 1000
+        content = execute_ok(kc, "%page_output")
+        page = content["payload"][0]["data"]["text/plain"]
+        assert page.startswith("module $Big :\n")
+        assert "%page_output 1 " in page
+        content = execute_ok(kc, "%page_output 1 100")
+        page = content["payload"][0]["data"]["text/plain"]
+        assert (
+            page
+            == '  export func "f98" : [] -> [i32]\n  export func "f99" : [] -> [i32]'
+        )
+
+    @pytest.mark.parametrize("kernel_env", ["results"], indirect=True)
+    def test_results_display(self, install_kernel, start_kernel):
+        """Parsed results should be sent as an application/json display"""
+        km, kc = start_kernel
+        kc.execute(
+            """(module $M (func (export "getNum") (result i32) (i32.const 4)))
+(invoke $M "getNum")
+(assert_return (invoke $M "getNum") (i32.const 3))""",
+            stop_on_error=False,
+        )
+        kc.get_shell_msg(TIMEOUT)
+        displays = []
+        while True:
+            msg = kc.iopub_channel.get_msg(timeout=TIMEOUT)
+            if msg["msg_type"] == "display_data":
+                displays.append(msg["content"]["data"])
+            elif msg["msg_type"] == "status":
+                if msg["content"]["execution_state"] == "idle":
+                    break
+        [data] = displays
+        results = data["application/json"]
+        assert [result["kind"] for result in results["results"]] == [
+            "module",
+            "values",
+            "error",
+        ]
+        assert results["results"][0]["exports"] == [
+            {
+                "kind": "func",
+                "name": "getNum",
+                "type": "[] -> [i32]",
+                "params": [],
+                "results": ["i32"],
+            }
+        ]
+        assert results["results"][2]["expect"] == [{"type": "i32", "value": "3"}]
+        assert results["assertions"] == {"total": 1, "failed": 1}
+
+    @pytest.mark.parametrize("kernel_env", ["metrics"], indirect=True)
+    def test_metrics(self, install_kernel, start_kernel, kernel_env):
+        """Cells' timings should be sent in their reply's metadata, written to the
+        metrics file, and shown by %kernel_stats
+        """
+        km, kc = start_kernel
+        request_id = kc.execute(LOOP_MODULE)
+        while True:
+            reply = kc.get_shell_msg(TIMEOUT)
+            if reply["parent_header"]["msg_id"] == request_id:
+                break
+        metrics = reply["metadata"]["wasm_spec_kernel"]["metrics"]
+        assert metrics["duration"] > 0
+        assert "pty_write" in metrics["spans"]
+        assert "pty_wait" in metrics["spans"]
+
+        [metrics_file] = os.listdir(kernel_env["WASM_KERNEL_METRICS_DIR"])
+        with open(
+            os.path.join(kernel_env["WASM_KERNEL_METRICS_DIR"], metrics_file)
+        ) as f:
+            assert "wasm_kernel_cells_total" in f.read()
+
+        execute_ok(kc, "%kernel_stats")
+        displays = []
+        while True:
+            msg = kc.iopub_channel.get_msg(timeout=TIMEOUT)
+            if msg["msg_type"] == "display_data":
+                displays.append(msg["content"]["data"])
+            elif msg["msg_type"] == "status":
+                if msg["content"]["execution_state"] == "idle" and displays:
+                    break
+        [data] = displays
+        assert data["application/json"]["cells"] >= 1
+        assert "pty_wait" in data["text/plain"]
+
+    @pytest.mark.parametrize("kernel_env", ["result_cache"], indirect=True)
+    def test_result_cache(self, install_kernel, start_kernel):
+        """Cells executed again in a new kernel should be replayed from the cache,
+        without starting an interpreter until a cell isn't in the cache
+        """
+        cells = [
+            """(module $Cached (func (export "getNum") (result i32) (i32.const 4)))""",
+            """(invoke $Cached "getNum")""",
+        ]
+
+        def execute(kc, cell):
+            request_id = kc.execute(cell)
+            while True:
+                reply = kc.get_shell_msg(TIMEOUT)
+                if reply["parent_header"]["msg_id"] == request_id:
+                    break
+            assert reply["content"]["status"] == "ok"
+            stdout, _ = assemble_output(kc.iopub_channel)
+            return stdout, reply["metadata"]["wasm_spec_kernel"]["metrics"]
+
+        km, kc = start_kernel
+        first = [execute(kc, cell) for cell in cells]
+        assert "interpreter" in first[-1][1]
+
+        km2 = KernelManager(kernel_name=TEST_KERNEL_NAME)
+        km2.start_kernel()
+        kc2 = km2.client()
+        kc2.start_channels()
+        try:
+            kc2.wait_for_ready(timeout=60)
+            for cell, (stdout, _) in zip(cells, first):
+                cached_stdout, metrics = execute(kc2, cell)
+                assert cached_stdout == stdout
+                assert "interpreter" not in metrics
+            # the interpreter is started for a new cell, with the cached cells' state
+            execute(kc2, """(assert_return (invoke $Cached "getNum") (i32.const 4))""")
+        finally:
+            kc2.stop_channels()
+            km2.shutdown_kernel()
+
+    @pytest.mark.parametrize("kernel_env", ["standalone"], indirect=True)
+    def test_standalone(self, install_kernel, start_kernel):
+        """Cells marked with %%standalone, and big self-contained cells, should be run
+        as scripts outside of the session, with their output in order
+        """
+        km, kc = start_kernel
+        execute_ok(
+            kc,
+            "%%standalone\n"
+            """(module $Alone (func (export "get") (result i32) (i32.const 4)))\n"""
+            """(assert_return (invoke $Alone "get") (i32.const 4))\n"""
+            """(module (func (export "get") (result i32) (i32.const 5)))\n"""
+            """(invoke "get")""",
+        )
+        stdout, _ = assemble_output(kc.iopub_channel)
+        assert stdout.index("module $Alone :") < stdout.index("5 : i32")
+        kc.execute("""(invoke $Alone "get")""", stop_on_error=False)
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["ename"] == "unknown module"
+        assemble_output(kc.iopub_channel)
+
+        kc.execute(
+            """(module (func (export "get") (result i32) (i32.const 4)))\n"""
+            """(assert_return (invoke "get") (i32.const 4))\n"""
+            """(assert_return (invoke "get") (i32.const 5))\n"""
+            """(assert_return (invoke "get") (i32.const 4))""",
+            stop_on_error=False,
+        )
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["ename"] == "assertion failure"
+        assert reply["content"]["traceback"][0].startswith("standalone.wast:3.")
+        # unlike the REPL, the script stops at its first error
+        stdout, _ = assemble_output(kc.iopub_channel)
+        assert "[1 form after line 3 weren't run" in stdout
+
+        # cells which aren't valid are rejected without restarting the session
+        execute_ok(
+            kc, """(module $Kept (func (export "get") (result i32) (i32.const 6)))"""
+        )
+        assemble_output(kc.iopub_channel)
+        for code in ["%%standalone\n1 + 1", "%%standalone\n(module))"]:
+            kc.execute(code, stop_on_error=False)
+            reply = kc.get_shell_msg(TIMEOUT)
+            assert reply["content"]["ename"] == "magic error"
+            stdout, _ = assemble_output(kc.iopub_channel)
+            assert "Replayed" not in stdout
+        execute_ok(kc, """(invoke $Kept "get")""")
+        stdout, _ = assemble_output(kc.iopub_channel)
+        assert "6 : i32" in stdout
+
+    def test_parallel_invoke(self, install_kernel, start_kernel):
+        """%%parallel_invoke should invoke an export with each tuple of arguments in
+        replicas of the session, and return the results in order
+        """
+        km, kc = start_kernel
+        execute_ok(
+            kc,
+            """(module $Sweep (func (export "zero") (param i32) (result i32)"""
+            """ (i32.const 0)))""",
+        )
+        assemble_output(kc.iopub_channel)
+        execute_ok(
+            kc,
+            "%%parallel_invoke -j 2 $Sweep zero\n"
+            + "\n".join("(i32.const %d)" % value for value in [0, 1, 2, 3]),
+        )
+        displays = []
+        while True:
+            msg = kc.iopub_channel.get_msg(timeout=TIMEOUT)
+            if msg["msg_type"] == "display_data":
+                displays.append(msg["content"]["data"])
+            elif msg["msg_type"] == "status":
+                if msg["content"]["execution_state"] == "idle" and displays:
+                    break
+        [data] = displays
+        results = data["application/json"]["results"]
+        assert [result["args"] for result in results] == [
+            "(i32.const %d)" % value for value in [0, 1, 2, 3]
+        ]
+        assert all(
+            result["values"] == [{"type": "i32", "value": "0"}] for result in results
+        )
+        assert "(i32.const 3) -> 0 : i32" in data["text/plain"]
+        execute_ok(kc, """(invoke $Sweep "zero" (i32.const 0))""")
+
+    @pytest.mark.parametrize("kernel_env", ["limits"], indirect=True)
+    def test_cell_limits(self, install_kernel, start_kernel):
+        """Cells which go over a limit should be stopped, and the session should be
+        restored into a new interpreter
+        """
+        km, kc = start_kernel
+        execute_ok(kc, LOOP_MODULE)
+        execute_ok(
+            kc, """(module $Kept (func (export "getNum") (result i32) (i32.const 4)))"""
+        )
+        start = time.monotonic()
+        kc.execute(LOOP_CELL, stop_on_error=False)
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert time.monotonic() - start < 5
+        assert reply["content"]["status"] == "error"
+        assert reply["content"]["ename"] == "limit exceeded"
+        assert "limit of" in reply["content"]["evalue"]
+        execute_ok(kc, """(assert_return (invoke $Kept "getNum") (i32.const 4))""")
+
+    def test_rerun_affected(self, install_kernel, start_kernel):
+        """%rerun_affected should re-run only the forms which depend on a change"""
+        km, kc = start_kernel
+        module = """(module $A (func (export "getNum") (result i32) (i32.const %d)))"""
+        for cell in [
+            module % 4,
+            """(register "a" $A)""",
+            """(assert_return (invoke $A "getNum") (i32.const 4))""",
+            """(module $Other (func (export "f")))""",
+            module % 3,
+        ]:
+            execute_ok(kc, cell)
+            assemble_output(kc.iopub_channel)
+
+        execute_ok(kc, "%rerun_affected -n")
+        stdout, _ = assemble_output(kc.iopub_channel)
+        assert stdout.startswith("2 forms from cells [2], [3] depend on $A:")
+        assert "$Other" not in stdout
+
+        kc.execute("%rerun_affected", stop_on_error=False)
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "error"
+        assert reply["content"]["ename"] == "assertion failure"
+
+    def test_execute_incomplete(self, install_kernel, start_kernel):
+        """Incomplete cells shouldn't be sent to the interpreter"""
+        km, kc = start_kernel
+        kc.execute("(module $incomplete", stop_on_error=False)
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "error"
+        assert reply["content"]["ename"] == "incomplete input"
+        execute_ok(kc, "(module $valid)")
+
+    @pytest.mark.parametrize("kernel_env", ["prelude"], indirect=True)
+    def test_prelude(self, install_kernel, start_kernel):
+        """The prelude should be loaded at start up and again after a restart"""
+        km, kc = start_kernel
+        execute_ok(kc, """(assert_return (invoke $Prelude "getNum") (i32.const 4))""")
+        execute_ok(kc, LOOP_MODULE)
+        kc.execute(LOOP_CELL)
+        time.sleep(0.1)
+        km.interrupt_kernel()
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "abort"
+        execute_ok(kc, """(assert_return (invoke $Prelude "getNum") (i32.const 4))""")
+
+    @pytest.mark.parametrize("kernel_env", ["journal", "shadow", "pool"], indirect=True)
+    def test_journal_replay(self, install_kernel, start_kernel):
+        """Successfully executed cells should be restored after a restart, either by
+        replaying the journal or by switching to the shadow interpreter
+        """
+        km, kc = start_kernel
+        execute_ok(
+            kc,
+            """(module $Kept (func (export "getNum") (result i32) (i32.const 4)))""",
+        )
+        execute_ok(kc, LOOP_MODULE)
+        kc.execute(LOOP_CELL)
+        time.sleep(0.1)
+        km.interrupt_kernel()
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "abort"
+        execute_ok(kc, """(assert_return (invoke $Kept "getNum") (i32.const 4))""")
+
+    def test_control_while_executing(self, install_kernel, start_kernel):
+        """The control channel should be answered while a cell is running, and the
+        cell should still be interruptible
+        """
+        km, kc = start_kernel
+        execute_ok(kc, LOOP_MODULE)
+        kc.execute(LOOP_CELL)
+        time.sleep(0.1)
+        msg = kc.session.msg("kernel_info_request")
+        kc.control_channel.send(msg)
+        reply = kc.get_control_msg(timeout=TIMEOUT)
+        assert reply["parent_header"]["msg_id"] == msg["header"]["msg_id"]
+        assert reply["content"]["status"] == "ok"
+        km.interrupt_kernel()
+        reply = kc.get_shell_msg(TIMEOUT)
+        assert reply["content"]["status"] == "abort"
+        execute_ok(kc, "(module $valid)")
@@ -0,0 +1,63 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from wasm_spec_kernel.limits import LimitExceeded, run_limited
+from wasm_spec_kernel.startup import spawn_wasm
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_run_limited_returns_result():
+    async def cell():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert run(run_limited(cell(), timeout=5)) == "done"
+
+
+def test_run_limited_timeout():
+    cancelled = []
+
+    async def cell():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def limited():
+        with pytest.raises(LimitExceeded, match="time limit of 0.2s"):
+            await run_limited(cell(), timeout=0.2)
+        await asyncio.sleep(0)
+
+    run(limited())
+    assert cancelled == [True]
+
+
+def test_run_limited_cpu_limit():
+    spinner = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+    try:
+        with pytest.raises(LimitExceeded, match="CPU time limit of 0.3s"):
+            run(run_limited(asyncio.sleep(10), cpu_limit=0.3, pid=spinner.pid))
+    finally:
+        spinner.kill()
+        spinner.wait()
+
+
+def test_memory_limit(test_wasm_path):
+    wasmwrapper = spawn_wasm(test_wasm_path, memory_limit=2 ** 30)
+    try:
+        with open("/proc/%d/limits" % wasmwrapper.child.pid) as f:
+            limits = f.read()
+        assert "Max address space         1073741824" in limits
+    finally:
+        wasmwrapper.child.terminate(force=True)
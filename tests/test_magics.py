@@ -0,0 +1,60 @@
+import pytest
+
+from wasm_spec_kernel.magics import (
+    Magic,
+    MagicError,
+    expand_paths,
+    load_command,
+    parallel_invoke_args,
+    parse_magic,
+)
+
+
+def test_parse_magic():
+    assert parse_magic("(module)") is None
+    assert parse_magic("%load_wat a.wat b.wat ") == Magic("load_wat", "a.wat b.wat")
+    assert parse_magic("%%cell arg\n(module)") == Magic("cell", "arg", "(module)")
+    with pytest.raises(MagicError):
+        parse_magic("%load_wat a.wat\n(module)")
+
+
+def test_expand_paths(tmp_path):
+    for name in ["b.wat", "a.wat", "c.wast", "with space.wat"]:
+        (tmp_path / name).write_text("(module)")
+    assert expand_paths(str(tmp_path / "*.wat"), (".wat",)) == [
+        str(tmp_path / name) for name in ["a.wat", "b.wat", "with space.wat"]
+    ]
+    assert expand_paths("'%s'" % (tmp_path / "with space.wat"), (".wat",)) == [
+        str(tmp_path / "with space.wat")
+    ]
+    with pytest.raises(MagicError):
+        expand_paths(str(tmp_path / "*.wasm"), (".wasm",))
+    with pytest.raises(MagicError):
+        expand_paths(str(tmp_path / "missing.wat"), (".wat",))
+
+
+def test_load_command():
+    assert load_command(["/a.wat", '/b"c.wast']) == (
+        '(input "/a.wat")\n(input "/b\\"c.wast")'
+    )
+
+
+def test_parallel_invoke_args():
+    assert parallel_invoke_args(
+        '-j 4 $M "add"', "(i32.const 1) (i32.const 2)\n;; comment\n\n(i32.const 3)"
+    ) == ("$M", "add", 4, ["(i32.const 1) (i32.const 2)", "(i32.const 3)"])
+    assert parallel_invoke_args("f", "(i32.const 1)") == (
+        None,
+        "f",
+        None,
+        ["(i32.const 1)"],
+    )
+    for args, body in [
+        ("", "(i32.const 1)"),
+        ("-j 0 f", "(i32.const 1)"),
+        ("$M f g", "(i32.const 1)"),
+        ("f", "(i32.const 1"),
+        ("f", ""),
+    ]:
+        with pytest.raises(MagicError):
+            parallel_invoke_args(args, body)
@@ -0,0 +1,60 @@
+import os
+
+from wasm_spec_kernel.metrics import KernelStats, Spans, process_stats
+
+
+def test_spans():
+    spans = Spans()
+    spans.add("publish", 0.5)
+    spans.timed("publish", lambda: None)()
+    assert spans.totals["publish"] >= 0.5
+    assert list(spans.totals) == ["publish"]
+
+
+def test_process_stats():
+    stats = process_stats(os.getpid())
+    if stats is None:
+        return  # no /proc
+    assert stats["rss"] > 0
+    assert stats["cpu"] > 0
+    assert process_stats(2 ** 22 + 1) is None
+
+
+def test_kernel_stats(tmp_path):
+    stats = KernelStats(str(tmp_path))
+    spans = Spans()
+    spans.add("pty_wait", 0.02)
+    stats.add_cell(
+        0.03, spans, "ok", {"rss": 4096, "cpu": 1.0}, {"rss": 8192, "cpu": 1.25}
+    )
+    stats.add_cell(2.0, Spans(), "error")
+
+    assert stats.last_cell == {"duration": 2.0, "spans": {}}
+    summary = stats.summary()
+    assert (summary["cells"], summary["errors"]) == (2, 1)
+    assert summary["stages"] == {"pty_wait": 0.02}
+    assert summary["interpreter"] == {"rss": 8192, "cpu": 1.25}
+
+    [path] = tmp_path.iterdir()
+    text = path.read_text()
+    pid = os.getpid()
+    assert 'wasm_kernel_cells_total{pid="%d"} 2' % pid in text
+    assert (
+        'wasm_kernel_stage_seconds_total{pid="%d",stage="pty_wait"} 0.02' % pid in text
+    )
+    assert (
+        'wasm_kernel_cell_duration_seconds_bucket{pid="%d",le="0.05"} 1' % pid in text
+    )
+    assert (
+        'wasm_kernel_cell_duration_seconds_bucket{pid="%d",le="+Inf"} 2' % pid in text
+    )
+    assert "wasm_kernel_interpreter_resident_memory_bytes" in text
+
+    stats.remove()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cell_interpreter_cpu():
+    stats = KernelStats()
+    stats.add_cell(0.1, Spans(), "ok", {"rss": 0, "cpu": 1.0}, {"rss": 10, "cpu": 1.5})
+    assert stats.last_cell["interpreter"] == {"rss": 10, "cpu": 0.5}
@@ -0,0 +1,81 @@
+from wasm_spec_kernel.output import CoalescedStream, OutputBudget, read_page
+
+
+def test_coalesces_small_writes():
+    sent = []
+    stream = CoalescedStream(sent.append, max_size=10, max_delay=60)
+    for text in ["abc", "def", "ghij", "k"]:
+        stream.write(text)
+    assert sent == ["abcdefghij"]
+    stream.close()
+    assert sent == ["abcdefghij", "k"]
+
+
+def test_flushes_after_delay():
+    sent = []
+    stream = CoalescedStream(sent.append, max_size=1024, max_delay=0)
+    stream.write("abc")
+    assert sent == ["abc"]
+
+
+def test_finds_error_split_across_writes():
+    stream = CoalescedStream(lambda text: None)
+    stream.write("module $A :\r\nstdin:2.1-2.")
+    stream.write("65: assertion failure: wrong ")
+    assert stream.error is None
+    stream.write("return values\r\nmodule $B :")
+    stream.close()
+    assert stream.error.groups() == (
+        "2.1-2.65",
+        "assertion failure",
+        "wrong return values",
+    )
+
+
+def test_long_line_split_across_writes():
+    """A long line which arrives in many writes should only be kept up to the stream's
+    line limit, which still holds the start of an error
+    """
+    stream = CoalescedStream(lambda text: None)
+    stream.max_line = 100
+    stream.write("stdin:1.1-1.2: syntax error: ")
+    for _ in range(1000):
+        stream.write("x" * 50)
+        assert len(stream._partial_line) <= 100
+    stream.write("\n")
+    assert stream.error.group(2) == "syntax error"
+    assert stream.error.group(3) == "x" * 71
+
+
+def test_output_budget_within_limit(tmp_path):
+    sent = []
+    budget = OutputBudget(sent.append, 10, str(tmp_path))
+    budget("abc\n")
+    budget("def\n")
+    assert budget.close() is None
+    assert sent == ["abc\n", "def\n"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_output_budget_spills(tmp_path):
+    sent = []
+    budget = OutputBudget(sent.append, 10, str(tmp_path), tail_size=12)
+    output = "".join("line %d\n" % i for i in range(1000))
+    for i in range(0, len(output), 100):
+        budget(output[i : i + 100])
+    assert "".join(sent) == output[:10]
+    path = budget.close(", see the page")
+    with open(path) as f:
+        assert f.read() == output
+    note, tail = sent[-2:]
+    assert note.startswith("\n[... ")
+    assert note.endswith(", see the page ...]\n")
+    assert "%d characters (998 lines) omitted" % (len(output) - 10 - 9) in note
+    assert tail == "line 999\n"
+
+
+def test_read_page(tmp_path):
+    path = tmp_path / "output.txt"
+    path.write_text("".join("line %d\n" % i for i in range(1, 11)))
+    assert read_page(str(path), 1, 14) == ("line 1\nline 2\n", 3)
+    assert read_page(str(path), 9, 100) == ("line 9\nline 10\n", None)
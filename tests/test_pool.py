@@ -0,0 +1,134 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from wasm_spec_kernel.metrics import process_stats
+from wasm_spec_kernel.pool import PoolError, PooledREPL, _request, pool_stats
+
+
+MODULE = """(module $Pooled (func (export "getNum") (result i32) (i32.const 4)))"""
+INVOKE = """(invoke $Pooled "getNum")"""
+
+
+@pytest.fixture
+def pool(test_wasm_path, tmp_path):
+    """Start a pool daemon, which reaps sessions after a second of idleness"""
+    socket_path = str(tmp_path / "pool.sock")
+    daemon = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "wasm_spec_kernel.pool",
+            "--socket",
+            socket_path,
+            "--interpreter",
+            test_wasm_path,
+            "--idle-timeout",
+            "1",
+            "--max-processes",
+            "3",
+            "--warm",
+            "1",
+        ]
+    )
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    yield socket_path
+    daemon.terminate()
+    daemon.wait(10)
+
+
+def test_run_command(pool):
+    repl = PooledREPL(pool)
+    assert repl.run_command(MODULE) == (
+        'module $Pooled :\n  export func "getNum" : [] -> [i32]'
+    )
+    chunks = []
+    assert repl.run_command(INVOKE, on_output=chunks.append) is None
+    assert "".join(chunks) == "4 : i32"
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(repl.run_command_async(INVOKE)) == "4 : i32"
+    finally:
+        loop.close()
+    with pytest.raises(ValueError):
+        repl.run_command("(module $incomplete")
+    assert repl.child.isalive()
+    repl.child.terminate(force=True)
+    assert not repl.child.isalive()
+    with pytest.raises(PoolError):
+        repl.run_command(INVOKE)
+
+
+def test_idle_sessions_are_reaped_and_restored(pool):
+    repl = PooledREPL(pool)
+    repl.run_command(MODULE)
+    time.sleep(2.5)
+    assert pool_stats(pool)["active"] == 0
+    # the session's journal is replayed into a new interpreter
+    assert repl.run_command(INVOKE) == "4 : i32"
+    assert pool_stats(pool)["active"] == 1
+
+
+def test_process_cap(pool):
+    first = PooledREPL(pool)
+    first.run_command(MODULE)
+    others = [PooledREPL(pool) for _ in range(3)]
+    # the least recently used session made room for the others
+    assert pool_stats(pool)["processes"] <= 3
+    assert first.run_command(INVOKE) == "4 : i32"
+    for repl in others:
+        repl.release()
+    first.release()
+
+
+def test_cancel_terminates_interpreter(pool):
+    repl = PooledREPL(pool)
+    repl.run_command(MODULE)
+    repl.run_command("""(module $Looper (func (export "loop") (loop (br 0))))""")
+
+    async def cancel():
+        run = asyncio.ensure_future(
+            repl.run_command_async("""(invoke $Looper "loop")""", timeout=None)
+        )
+        await asyncio.sleep(0.5)
+        run.cancel()
+        # let the cancelled request disconnect from the daemon
+        with pytest.raises(asyncio.CancelledError):
+            await run
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(cancel())
+    finally:
+        loop.close()
+    # the session's next command gets a new interpreter, with its journal replayed
+    assert repl.run_command(INVOKE) == "4 : i32"
+
+
+def test_pid(pool):
+    repl = PooledREPL(pool)
+    repl.run_command(MODULE)
+    pid = repl.child.pid
+    assert process_stats(pid) is not None
+    time.sleep(2.5)
+    # a reaped session's interpreter is restored when its pid is looked up
+    assert repl.child.pid not in (None, pid)
+    assert repl.run_command(INVOKE) == "4 : i32"
+    repl.release()
+    assert repl.child.pid is None
+
+
+def test_invalid_session_id(pool, tmp_path):
+    outside = tmp_path / "outside.json"
+    outside.write_text("{}")
+    for op in ("release", "run"):
+        with pytest.raises(PoolError):
+            _request(pool, {"op": op, "session": "../outside", "command": INVOKE})
+    assert outside.exists()
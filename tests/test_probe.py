@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import pytest
+
+from wasm_spec_kernel import probe
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setenv("WASM_KERNEL_CACHE_DIR", str(path))
+    return path
+
+
+def test_probe_interpreter(test_wasm_path, cache_dir):
+    result = probe.probe_interpreter(test_wasm_path)
+    assert result["version"] is not None
+    assert result["version"] in result["banner"]
+    assert set(result["proposals"]) <= set(probe.PROPOSAL_PROBES)
+    assert (cache_dir / probe.PROBE_CACHE_FILE).exists()
+
+
+def test_probe_is_cached(test_wasm_path, cache_dir, tmp_path, monkeypatch):
+    interpreter = str(tmp_path / "wasm")
+    shutil.copy2(test_wasm_path, interpreter)
+    result = probe.probe_interpreter(interpreter)
+
+    def fail(interpreter_path, on_banner=None):
+        raise AssertionError("the interpreter shouldn't be probed again")
+
+    monkeypatch.setattr(probe, "run_probe", fail)
+    assert probe.probe_interpreter(interpreter) == result
+
+    # a modified binary must be probed again
+    stat = os.stat(interpreter)
+    os.utime(interpreter, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with pytest.raises(AssertionError):
+        probe.probe_interpreter(interpreter)
+
+
+def test_probe_reports_banner_first(test_wasm_path, cache_dir):
+    partial = []
+    result = probe.probe_interpreter(test_wasm_path, on_banner=partial.append)
+    assert partial == [{"banner": result["banner"], "version": result["version"]}]
+    # a cached probe is complete
+    assert probe.probe_interpreter(test_wasm_path, on_banner=partial.append) == result
+    assert len(partial) == 1
+
+
+def test_install_seed(test_wasm_path, cache_dir, tmp_path, monkeypatch):
+    interpreter = str(tmp_path / "wasm")
+    shutil.copy2(test_wasm_path, interpreter)
+    seeded = {"banner": "wasm 1.0", "version": "1.0", "proposals": []}
+    monkeypatch.setenv("WASM_KERNEL_PROBE", probe.install_seed(interpreter, seeded))
+
+    def fail(interpreter_path, on_banner=None):
+        raise AssertionError("the interpreter shouldn't be probed")
+
+    monkeypatch.setattr(probe, "run_probe", fail)
+    assert probe.probe_interpreter(interpreter) == seeded
+    assert (cache_dir / probe.PROBE_CACHE_FILE).exists()
+
+    # the seed is ignored once the binary changes
+    (cache_dir / probe.PROBE_CACHE_FILE).unlink()
+    stat = os.stat(interpreter)
+    os.utime(interpreter, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with pytest.raises(AssertionError):
+        probe.probe_interpreter(interpreter)
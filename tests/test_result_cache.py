@@ -0,0 +1,42 @@
+import os
+
+from wasm_spec_kernel.result_cache import ResultCache
+
+
+def test_history(tmp_path):
+    prelude = tmp_path / "prelude.wat"
+    prelude.write_text("(module)")
+    wasm = str(tmp_path / "wasm")
+    open(wasm, "w").close()
+    history = ResultCache.initial_history(wasm, [str(prelude)], ["1.0"])
+    assert history == ResultCache.initial_history(wasm, [str(prelude)], ["1.0"])
+    assert history != ResultCache.initial_history(wasm, [str(prelude)], ["2.0"])
+    prelude.write_text("(module $Changed)")
+    assert history != ResultCache.initial_history(wasm, [str(prelude)], ["1.0"])
+
+    after = ResultCache.advance(history, "(module)")
+    assert after != history
+    assert ResultCache.key(history, "(module)") != ResultCache.key(after, "(module)")
+
+
+def test_get_put(tmp_path):
+    cache = ResultCache(str(tmp_path / "results"), 2 ** 20)
+    assert cache.get("missing") is None
+    result = {"reply": {"status": "ok"}, "messages": [["stream", {"text": "1\n"}]]}
+    cache.put("key", result)
+    assert cache.get("key") == result
+
+
+def test_evict(tmp_path):
+    directory = tmp_path / "results"
+    cache = ResultCache(str(directory), 250)
+    result = {"text": "x" * 100}
+    cache.put("first", result)
+    cache.put("second", result)
+    # make "first" the most recently used
+    os.utime(str(directory / "second.json"), (0, 0))
+    cache.get("first")
+    cache.put("third", result)
+    assert cache.get("second") is None
+    assert cache.get("first") == result
+    assert cache.get("third") == result
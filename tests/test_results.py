@@ -0,0 +1,93 @@
+from wasm_spec_kernel.results import ResultParser, assertion_count, parse_values
+
+
+def test_parses_modules_values_and_errors():
+    parser = ResultParser()
+    output = """module $A :
+  import func "env" "log" : [i32] -> []
+  export func "getNum" : [] -> [i32]
+  export global "g" : mut i64
+4 : i32
+[1 2] : [i32 i64]
+Result: 4 : i32
+Expect: 3 : i32
+stdin:5.1-5.65: assertion failure: wrong return values
+stdin:6.1-6.2: syntax error: unexpected token
+something else"""
+    # the output may be split anywhere
+    for i in range(0, len(output), 7):
+        parser.feed(output[i : i + 7])
+    parser.close()
+    module, value, values, failure, error, other = parser.results
+    assert module == {
+        "kind": "module",
+        "name": "$A",
+        "imports": [
+            {
+                "kind": "func",
+                "module": "env",
+                "name": "log",
+                "type": "[i32] -> []",
+                "params": ["i32"],
+                "results": [],
+            }
+        ],
+        "exports": [
+            {
+                "kind": "func",
+                "name": "getNum",
+                "type": "[] -> [i32]",
+                "params": [],
+                "results": ["i32"],
+            },
+            {"kind": "global", "name": "g", "type": "mut i64"},
+        ],
+    }
+    assert value["values"] == [{"type": "i32", "value": "4"}]
+    assert values["values"] == [
+        {"type": "i32", "value": "1"},
+        {"type": "i64", "value": "2"},
+    ]
+    assert failure["type"] == "assertion failure"
+    assert failure["result"] == [{"type": "i32", "value": "4"}]
+    assert failure["expect"] == [{"type": "i32", "value": "3"}]
+    assert error["location"] == "6.1-6.2"
+    assert "result" not in error
+    assert other == {"kind": "output", "text": "something else"}
+    summary = parser.summary(assertions=2)
+    assert summary["data"]["application/json"]["errors"] == 2
+    assert summary["data"]["application/json"]["assertions"] == {
+        "total": 2,
+        "failed": 1,
+    }
+    assert summary["data"]["text/plain"] == "[modules: 1, values: 2, errors: 2]"
+
+
+def test_v128_values_are_kept_whole():
+    assert parse_values("i32x4 0 0 0 0", "v128") == [
+        {"type": "v128", "value": "i32x4 0 0 0 0"}
+    ]
+
+
+def test_assertion_count():
+    code = """(module)
+;; (assert_trap)
+(assert_return (invoke "f"))
+( assert_trap (invoke "g") "unreachable")"""
+    assert assertion_count(code) == 2
+
+
+def test_long_unterminated_line():
+    """A multi-MB line which arrives in chunks without a newline should only be kept up
+    to the parser's line limit, and parsing should go on after it
+    """
+    parser = ResultParser()
+    parser.feed("[")
+    for _ in range(64):
+        parser.feed("0 " * 32 * 1024)
+        assert len(parser._partial_line) <= parser.max_line
+    parser.feed("] : [i32]\n4 : i32\n")
+    parser.close()
+    [output, values] = parser.results
+    assert output == {"kind": "output", "text": ("[" + "0 " * 64 * 1024)[:65536]}
+    assert values == {"kind": "values", "values": [{"type": "i32", "value": "4"}]}
@@ -0,0 +1,88 @@
+import json
+import xml.etree.ElementTree as ET
+
+from wasm_spec_kernel.run import main
+
+
+SCRIPT = """(module $A (func (export "get") (result i32) (i32.const 4)))
+(module $Looper (func (export "loop") (loop (br 0))))
+;; a comment between forms
+(assert_return (invoke $A "get") (i32.const 5))
+(invoke $Looper "loop")
+(assert_return (invoke $A "get") (i32.const 4))
+"""
+
+
+def code_cell(source):
+    return {
+        "cell_type": "code",
+        "execution_count": None,
+        "metadata": {},
+        "outputs": [],
+        "source": source,
+    }
+
+
+def test_run(tmp_path, test_wasm_path):
+    script = tmp_path / "script.wast"
+    script.write_text(SCRIPT)
+    (tmp_path / "m.wat").write_text(
+        """(module $M (func (export "one") (result i32) (i32.const 1)))"""
+    )
+    notebook = tmp_path / "notebook.ipynb"
+    notebook.write_text(
+        json.dumps(
+            {
+                "cells": [
+                    {"cell_type": "markdown", "metadata": {}, "source": "# Title"},
+                    code_cell(["%load_wat m.wat"]),
+                    code_cell(['(invoke $M "one")']),
+                    code_cell(["%kernel_stats"]),
+                ],
+                "metadata": {},
+                "nbformat": 4,
+                "nbformat_minor": 4,
+            }
+        )
+    )
+    junit = tmp_path / "report.xml"
+    summary = tmp_path / "summary.json"
+    status = main(
+        [str(script), str(notebook), "--interpreter", test_wasm_path]
+        + ["--timeout", "1", "--junit", str(junit), "--json", str(summary)]
+    )
+    assert status == 1
+
+    with open(str(summary)) as f:
+        script_result, notebook_result = json.load(f)["files"]
+    assert [case["name"] for case in script_result["cases"]] == [
+        "line 1",
+        "line 2",
+        "line 4",
+        "line 5",
+        "line 6",
+    ]
+    # the session is restored after the form which timed out
+    assert [case["status"] for case in script_result["cases"]] == [
+        "ok",
+        "ok",
+        "failure",
+        "error",
+        "ok",
+    ]
+    assert script_result["cases"][2]["errors"][0]["type"] == "assertion failure"
+    assert [case["status"] for case in notebook_result["cases"]] == [
+        "ok",
+        "ok",
+        "skipped",
+    ]
+
+    cells = json.loads(notebook.read_text())["cells"]
+    assert cells[2]["execution_count"] == 2
+    assert "1 : i32" in cells[2]["outputs"][0]["text"]
+
+    suites = ET.parse(str(junit)).getroot()
+    assert suites[0].get("tests") == "5"
+    assert suites[0].get("failures") == "1"
+    assert suites[0].get("errors") == "1"
+    assert suites[1].get("skipped") == "1"
@@ -0,0 +1,51 @@
+from wasm_spec_kernel.standalone import _batches, _script, _skipped_note, analyze
+
+
+def test_analyze():
+    analysis = analyze(
+        """(module (func (export "a") (result i32) (i32.const 3)))
+(assert_return (invoke "a") (i32.const 3))
+(module $B (func (export "b") (result i32) (i32.const 1)))
+(register "b" $B)
+(module (import "b" "b" (func)))
+(module (import "spectest" "print" (func)))
+(invoke "x")"""
+    )
+    assert analysis.self_contained
+    assert analysis.defines == {"$B", '"b"'}
+    assert analysis.forms == 7
+    assert [[line for line, _ in segment] for segment in analysis.segments] == [
+        [1, 2],
+        [3, 4, 5],
+        [6, 7],
+    ]
+
+    assert analyze("(module") is None
+    assert not analyze('(invoke $A "a")').self_contained
+    # without a module name, invocations use the session's last module
+    assert not analyze('(invoke "a")').self_contained
+    assert analyze('(module $A)\n(invoke $A "a")').self_contained
+
+
+def test_batches():
+    segments = [[(1, "a"), (2, "b")], [(3, "c")], [(4, "d")], [(5, "e"), (6, "f")]]
+    assert _batches(segments, 2) == [
+        [(1, "a"), (2, "b"), (3, "c")],
+        [(4, "d"), (5, "e"), (6, "f")],
+    ]
+    assert len(_batches(segments, 8)) == 4
+    assert _batches(segments, 1) == [[item for s in segments for item in s]]
+
+
+def test_script():
+    assert _script([(2, "(module\n)"), (5, "(invoke)")]) == "\n(module\n)\n\n(invoke)\n"
+
+
+def test_skipped_note():
+    forms = [(1, "(module)"), (2, "(assert_return)"), (4, "(invoke)")]
+    output = "standalone.wast:2.1-2.20: assertion failure: wrong return values\n"
+    assert _skipped_note(forms, output).startswith("[1 form after line 2 weren't run")
+    assert _skipped_note(forms, output.replace(":2.1-2.", ":4.1-4.")) is None
+    assert _skipped_note(forms, "") is None
+    # errors in the prelude aren't the script's
+    assert _skipped_note(forms, output.replace("standalone", "prelude")) is None
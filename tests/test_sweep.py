@@ -0,0 +1,75 @@
+import asyncio
+import signal
+
+from wasm_spec_kernel.startup import spawn_wasm
+from wasm_spec_kernel.sweep import (
+    format_result,
+    invoke_command,
+    parse_result,
+    run_sweep,
+)
+
+
+SWEEP_MODULE = (
+    """(module $Sweep (func (export "zero") (param i32) (result i32) (i32.const 0)))"""
+)
+
+
+def test_invoke_command():
+    assert invoke_command("$M", "add", "(i32.const 1) (i32.const 2)") == (
+        '(invoke $M "add" (i32.const 1) (i32.const 2))'
+    )
+    assert invoke_command(None, 'a"b', "") == '(invoke "a\\"b")'
+
+
+def test_parse_result():
+    result = parse_result("[1 2] : [i32 i64]\n")
+    assert result == {
+        "values": [{"type": "i32", "value": "1"}, {"type": "i64", "value": "2"}]
+    }
+    assert format_result(result) == "[1 2] : [i32 i64]"
+    assert parse_result("") == {"values": []}
+    result = parse_result('stdin:1.1-1.9: unknown export: "f"\n')
+    assert result == {"error": {"type": "unknown export", "details": '"f"'}}
+    assert format_result(result) == 'unknown export: "f"'
+    assert parse_result(None)["error"]["type"] == "crash"
+
+
+def test_run_sweep(test_wasm_path):
+    spawned = []
+    values = [0, 1, 0, 0, 0]
+    commands = [
+        invoke_command("$Sweep", "zero", "(i32.const %d)" % value) for value in values
+    ]
+
+    def spawn_replica():
+        wasmwrapper = spawn_wasm(test_wasm_path)
+        wasmwrapper.run_command(SWEEP_MODULE, timeout=None, framed=True)
+        run_command_async = wasmwrapper.run_command_async
+
+        async def crashing_run_command_async(command, **kwargs):
+            # the interpreter exits before it answers the second command, every time
+            # it's run, as if it crashed on it
+            if command == commands[1]:
+                wasmwrapper.child.kill(signal.SIGKILL)
+                wasmwrapper.child.wait()
+            return await run_command_async(command, **kwargs)
+
+        wasmwrapper.run_command_async = crashing_run_command_async
+        spawned.append(wasmwrapper)
+        return wasmwrapper
+
+    outputs = asyncio.new_event_loop().run_until_complete(
+        run_sweep(spawn_replica, commands, 2)
+    )
+    # the invocation which crashed its replica is retried once in a new one, and the
+    # rest of its shard runs in another
+    assert [parse_result(output) for output in outputs] == [
+        {"values": [{"type": "i32", "value": "0"}]},
+        parse_result(None),
+        {"values": [{"type": "i32", "value": "0"}]},
+        {"values": [{"type": "i32", "value": "0"}]},
+        {"values": [{"type": "i32", "value": "0"}]},
+    ]
+    assert len(spawned) == 4
+    assert not any(wasmwrapper.child.isalive() for wasmwrapper in spawned)
@@ -0,0 +1,45 @@
+import pytest
+
+from wasm_spec_kernel.syntax import CompletenessChecker, scan_line
+
+
+@pytest.mark.parametrize(
+    "code,status,indent",
+    [
+        ("", "complete", None),
+        ("(module $complete)", "complete", None),
+        ("(module $a)\n(module $b)\n", "complete", None),
+        ("(module $incomplete", "incomplete", "  "),
+        ("(module $incomplete\n  (func", "incomplete", "    "),
+        ('(module $string "(")', "complete", None),
+        ('(module $escaped "\\"(")', "complete", None),
+        ("(module $line_comment ;; )\n", "incomplete", "  "),
+        ("(module (; ) ;) $block_comment)", "complete", None),
+        ("(; (; nested ;)", "incomplete", ""),
+        ("(; (; nested ;) ;)", "complete", None),
+        ("(module $extra_close))", "invalid", None),
+        ('(module $unterminated "string\n)', "invalid", None),
+        ("1 + 1", "invalid", None),
+    ],
+)
+def test_check(code, status, indent):
+    reply = CompletenessChecker().check(code)
+    assert reply["status"] == status
+    assert reply.get("indent") == indent
+
+
+def test_invalid_line_resets_depth():
+    """The interpreter discards open forms along with a line that has an error"""
+    state = scan_line("(module (func 1 ))))")
+    assert state.invalid and not state.open
+    assert scan_line("(module", state).open
+
+
+def test_checker_reuses_unchanged_lines():
+    checker = CompletenessChecker()
+    code = "(module $m\n  (func $f)"
+    assert checker.check(code)["status"] == "incomplete"
+    assert checker.check(code + "\n)")["status"] == "complete"
+    assert checker.check(code + "\n)\n)")["status"] == "invalid"
+    # a changed line invalidates the state of the lines after it
+    assert checker.check("(module $m)\n  (func $f)")["status"] == "complete"
@@ -24,29 +24,28 @@ def new_repl():
     [
         ("(module $empty)", "module $empty :"),
         ("(module $newline\n)", "module $newline :"),
-        ("(module $incomplete_newline\n", ""),
         (
             """(module $Export1 (func $getNum (export "getNum") (result i32) (i32.const 4)))""",
-            """module $Export1 :\r\n  export func "getNum" : [] -> [i32]""",
+            """module $Export1 :\n  export func "getNum" : [] -> [i32]""",
         ),
         (
             """(module $Export1TrailingLF (func $getNum (export "getNum") (result i32) (i32.const 4)))\n""",
-            """module $Export1TrailingLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $Export1TrailingLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """(module $Export1TrailingLFLF (func $getNum (export "getNum") (result i32) (i32.const 4)))\n\n""",
-            """module $Export1TrailingLFLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $Export1TrailingLFLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """(module $Export1TrailingCRLF (func $getNum (export "getNum") (result i32) (i32.const 4)))\r\n""",
-            """module $Export1TrailingCRLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $Export1TrailingCRLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
 (module $MLExport1
   (func $getNum (export "getNum") (result i32) (i32.const 4))
 )""",
-            """module $MLExport1 :\r\n  export func "getNum" : [] -> [i32]""",
+            """module $MLExport1 :\n  export func "getNum" : [] -> [i32]""",
         ),
         (
             """\
@@ -54,7 +53,7 @@ def new_repl():
   (func $getNum (export "getNum") (result i32) (i32.const 4))
 )
 """,
-            """module $MLExport1TrailingLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $MLExport1TrailingLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
@@ -64,21 +63,21 @@ def new_repl():
 )
 
 """,
-            """module $MLExport1TrailingLFLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $MLExport1TrailingLFLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """
 (module $MLExport1LeadingLF
   (func $getNum (export "getNum") (result i32) (i32.const 4))
 )""",
-            """module $MLExport1LeadingLF :\r\n  export func "getNum" : [] -> [i32]""",
+            """module $MLExport1LeadingLF :\n  export func "getNum" : [] -> [i32]""",
         ),
         (
             """\
 (module $MLExport1Commented
   (func $getNum (export "getNum") (result i32) (i32.const 4)) ;; a newline terminated comment
 )""",
-            """module $MLExport1Commented :\r\n  export func "getNum" : [] -> [i32]""",
+            """module $MLExport1Commented :\n  export func "getNum" : [] -> [i32]""",
         ),
         (
             """\
@@ -86,7 +85,7 @@ def new_repl():
   (func $getNum (export "getNum") (result i32) (i32.const 4))
 )
 (register "$MLExport1" $MLExport1_register)""",
-            """module $MLExport1_register :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $MLExport1_register :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
@@ -95,14 +94,14 @@ def new_repl():
 )
 (register "$MLExport1" $MLExport1_registerTrailingLF)
 """,
-            """module $MLExport1_registerTrailingLF :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $MLExport1_registerTrailingLF :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
 (module $Export1_assert (func $getNum (export "getNum") (result i32) (i32.const 4)))
 (assert_return (invoke $Export1_assert "getNum") (i32.const 4))
 """,
-            """module $Export1_assert :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $Export1_assert :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
@@ -111,7 +110,7 @@ def new_repl():
 )
 (assert_return (invoke $MLExport1Commented_assert "getNum") (i32.const 4))
 """,
-            """module $MLExport1Commented_assert :\r\n  export func "getNum" : [] -> [i32]\n""",
+            """module $MLExport1Commented_assert :\n  export func "getNum" : [] -> [i32]\n""",
         ),
         (
             """\
@@ -119,10 +118,10 @@ def new_repl():
 (assert_return (invoke $Export1_assertF "getNum") (i32.const 3))
 """,
             """\
-module $Export1_assertF :\r
+module $Export1_assertF :
   export func "getNum" : [] -> [i32]
-Result: 4 : i32\r
-Expect: 3 : i32\r
+Result: 4 : i32
+Expect: 3 : i32
 stdin:2.1-2.65: assertion failure: wrong return values
 """,
         ),
@@ -130,8 +129,155 @@ stdin:2.1-2.65: assertion failure: wrong return values
         ("\n", ""),
     ],
 )
-def test_run_command(new_repl, wasm_code, stdout):
+@pytest.mark.parametrize("framed", [False, True])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_run_command(new_repl, wasm_code, stdout, framed, streamed):
     """These parametrized tests are primarily focused on documenting how whitespace is
     being handled.
     """
-    assert new_repl.run_command(wasm_code) == stdout
+    if streamed:
+        chunks = []
+        assert (
+            new_repl.run_command(wasm_code, framed=framed, on_output=chunks.append)
+            is None
+        )
+        assert "".join(chunks) == stdout
+    else:
+        assert new_repl.run_command(wasm_code, framed=framed) == stdout
+
+
+@pytest.mark.parametrize(
+    "wasm_code", ["(module $incomplete", "(module $incomplete_newline\n", "(; (module)"]
+)
+@pytest.mark.parametrize("framed", [False, True])
+def test_run_command_incomplete(new_repl, wasm_code, framed):
+    """Incomplete commands should be rejected before they're sent to the REPL"""
+    with pytest.raises(ValueError):
+        new_repl.run_command(wasm_code, framed=framed)
+    assert new_repl.run_command("(module $next)", framed=framed) == "module $next :"
+
+
+def test_run_command_framed_stops_on_error(new_repl):
+    """Framed execution shouldn't send any more chunks once an error has been seen."""
+    new_repl.framed_chunk_size = 1
+    output = new_repl.run_command(
+        "(module $before)\n(not_a_command)\n(module $after)", framed=True
+    )
+    assert output.startswith("module $before :\n")
+    assert "syntax error" in output
+    assert "$after" not in output
+    # the REPL should be at a prompt, ready for the next command
+    assert new_repl.run_command("(module $next)", framed=True) == "module $next :"
+
+
+@pytest.mark.parametrize(
+    "framed, chunk_size, runs_after_error",
+    [(False, 4096, True), (True, 4096, True), (True, 1, False)],
+)
+def test_run_command_forms_after_error(new_repl, framed, chunk_size, runs_after_error):
+    """Line by line, the forms after a failing one still run. Framed, only those in
+    the same chunk as the failing form do.
+    """
+    new_repl.framed_chunk_size = chunk_size
+    output = new_repl.run_command(
+        """(module (func (export "get") (result i32) (i32.const 1)))\n"""
+        """(assert_return (invoke "get") (i32.const 2))\n"""
+        """(invoke "get")""",
+        framed=framed,
+    )
+    assert "assertion failure" in output
+    # the failed assertion prints `Result: 1 : i32` too
+    assert ("\n1 : i32" in output) == runs_after_error
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+@pytest.mark.parametrize("streamed", [False, True])
+def test_run_command_framed_large_form(new_repl, run_async, streamed):
+    """A form which is much larger than the pty's buffer should be written while the
+    REPL's prompts for its lines are read, instead of both sides blocking on a full pty.
+    """
+    import asyncio
+
+    code = "(module $large\n%s)" % ("(func)\n" * 20000)
+    chunks = []
+    kwargs = {"timeout": 60, "framed": True}
+    if streamed:
+        kwargs["on_output"] = chunks.append
+    if run_async:
+        loop = asyncio.new_event_loop()
+        try:
+            output = loop.run_until_complete(new_repl.run_command_async(code, **kwargs))
+        finally:
+            loop.close()
+    else:
+        output = new_repl.run_command(code, **kwargs)
+    if streamed:
+        output = "".join(chunks)
+    assert output.startswith("module $large :")
+    assert new_repl.run_command("(module $next)", framed=True) == "module $next :"
+
+
+# A REPL which answers each line of input (a number) with that many output lines
+LINES_REPL = r"""
+import sys
+sys.stdout.write("> ")
+sys.stdout.flush()
+for request in sys.stdin:
+    for i in range(int(request)):
+        sys.stdout.write("  line %d\n" % i)
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+"""
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_run_command_large_output(streamed):
+    """Large outputs should be collected intact (with plain newlines), and without
+    rescanning the output for prompts every time more of it arrives.
+    """
+    import sys
+    import time
+
+    repl = WasmREPLWrapper(
+        pexpect.spawn(sys.executable, ["-c", LINES_REPL], encoding="utf-8", echo=False)
+    )
+    count = 100000
+    start = time.monotonic()
+    if streamed:
+        chunks = []
+        repl.run_command(str(count), on_output=chunks.append)
+        output = "".join(chunks)
+    else:
+        output = repl.run_command(str(count))
+    assert time.monotonic() - start < 10
+    assert output == "\n".join("  line %d" % i for i in range(count))
+    assert repl.run_command("1") == "  line 0"
+
+
+# A REPL which answers each line of input (a number) with a line of that many "é"s
+LONG_LINE_REPL = r"""
+import sys
+sys.stdout.write("> ")
+sys.stdout.flush()
+for request in sys.stdin:
+    sys.stdout.write("\u00e9" * int(request) + "\n> ")
+    sys.stdout.flush()
+"""
+
+
+def test_run_command_long_line():
+    """A line of output which is much longer than the reader's buffer should be streamed
+    in pieces, without splitting any characters
+    """
+    import sys
+
+    repl = WasmREPLWrapper(
+        pexpect.spawn(
+            sys.executable, ["-c", LONG_LINE_REPL], encoding="utf-8", echo=False
+        )
+    )
+    chunks = []
+    repl.run_command("2000000", on_output=chunks.append)
+    assert "".join(chunks) == "\u00e9" * 2000000
+    assert max(len(chunk) for chunk in chunks) < 2000000
+    assert repl.run_command("3") == "\u00e9" * 3
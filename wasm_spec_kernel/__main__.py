@@ -1,3 +1,9 @@
+# The first interpreter is started before ipykernel is imported, since importing it
+# and setting up the kernel's sockets takes much longer than the interpreter does
+from .startup import prestart
+
+prestart()
+
 from ipykernel.kernelapp import IPKernelApp  # type: ignore
 from .kernel import WasmKernel
 
@@ -0,0 +1,168 @@
+"""A cache of the binary encodings of large modules, so that re-running a module (or
+replaying it after a restart) doesn't send its full text through the pty again, or
+make the interpreter parse it again.
+"""
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from .probe import interpreter_key
+from .syntax import split_forms
+
+
+logger = logging.getLogger(__name__)
+
+CONVERT_TIMEOUT = 60
+
+# The start of a module definition, with its optional name in group 1. Group 2 is empty
+# for text modules (as opposed to `binary` or `quote` modules).
+module_pat = re.compile(r'\(module(?:\s+(\$[^\s()";]+))?\s*([^\s()";]*)')
+
+# How each byte is written in a WAT string literal
+_byte_escapes = [
+    chr(b) if 0x20 <= b < 0x7F and b not in b'"\\' else "\\%02x" % b for b in range(256)
+]
+
+
+def binary_module(name, data, width=1024):
+    """Write the binary encoding of a module as a `(module binary ...)` command. The
+    data is split across several strings of `width` bytes, since lines written to a
+    pty are limited in length.
+    """
+    strings = [
+        '  "%s"' % "".join(map(_byte_escapes.__getitem__, data[i : i + width]))
+        for i in range(0, len(data), width)
+    ]
+    header = "(module %s binary" % name if name else "(module binary"
+    return "\n".join([header] + strings) + ")"
+
+
+class BinaryModuleCache:
+    """Holds the binary encodings of cells which define a single large module, keyed
+    by a hash of the cell's text and the interpreter's identity. Modules are encoded
+    by the interpreter's conversion mode (`wasm -d module.wat -o module.wasm`) in the
+    background, after they first execute successfully, and stored on disk.
+
+    :param interpreter_path: The interpreter which converts modules.
+    :param directory: Where the encoded modules are stored.
+    :param min_size: Cells shorter than this are never cached.
+    """
+
+    def __init__(self, interpreter_path, directory, min_size):
+        self._interpreter_path = interpreter_path
+        self._identity = interpreter_key(interpreter_path)
+        self._directory = directory
+        self._min_size = min_size
+        self._commands = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, code):
+        """Return a command which defines the cell's module from its binary encoding,
+        or None if the cell isn't cached
+        """
+        if len(code) < self._min_size:
+            return None
+        digest = self._digest(code)
+        with self._lock:
+            command = self._commands.get(digest)
+        if command is not None:
+            return command
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        name = self._module_name(code)
+        if name is None:
+            return None
+        command = binary_module(name, data)
+        with self._lock:
+            self._commands[digest] = command
+        return command
+
+    def add(self, code):
+        """Encode the cell's module in the background, if it should be cached (and
+        isn't already). Returns the thread which encodes it, if one was started.
+        """
+        if len(code) < self._min_size:
+            return None
+        digest = self._digest(code)
+        with self._lock:
+            if digest in self._commands or digest in self._pending:
+                return None
+            if os.path.exists(self._path(digest)):
+                return None
+            self._pending.add(digest)
+        thread = threading.Thread(
+            target=self._convert, args=(digest, code), daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _convert(self, digest, code):
+        try:
+            name = self._module_name(code)
+            if name is None:
+                return
+            data = self._encode(split_forms(code)[0])
+            if data is None:
+                return
+            os.makedirs(self._directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+            with self._lock:
+                self._commands[digest] = binary_module(name, data)
+            logger.debug("cached the binary encoding of module %s", digest)
+        except Exception:
+            logger.debug("unable to cache module %s", digest, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+    def _encode(self, module_text):
+        """Convert a text module to its binary encoding with the interpreter"""
+        with tempfile.TemporaryDirectory() as td:
+            wat_path = os.path.join(td, "module.wat")
+            wasm_path = os.path.join(td, "module.wasm")
+            with open(wat_path, "w") as f:
+                f.write(module_text)
+            result = subprocess.run(
+                [self._interpreter_path, "-d", wat_path, "-o", wasm_path],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=CONVERT_TIMEOUT,
+            )
+            if result.returncode != 0 or not os.path.exists(wasm_path):
+                logger.debug("unable to convert module: %s", result.stdout)
+                return None
+            with open(wasm_path, "rb") as f:
+                return f.read()
+
+    @staticmethod
+    def _module_name(code):
+        """Return the name of the cell's module ("" if it's anonymous), or None if the
+        cell isn't exactly one text module
+        """
+        forms = split_forms(code)
+        if forms is None or len(forms) != 1:
+            return None
+        m = module_pat.match(forms[0])
+        if m is None or m.group(2):
+            return None
+        return m.group(1) or ""
+
+    def _digest(self, code):
+        return hashlib.sha256(
+            ("%s\0%s" % (self._identity, code)).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self._directory, digest + ".wasm")
@@ -0,0 +1,228 @@
+"""Code completion for WAT/WAST, which never has to query the interpreter."""
+import re
+from typing import Dict, Optional
+
+
+def _wat_keywords():
+    """All of the WAT/WAST keywords and instructions that are offered as completions"""
+    # fmt: off
+    keywords = [
+        # module fields
+        "module", "func", "param", "result", "local", "global", "table", "memory",
+        "elem", "data", "start", "type", "import", "export", "mut", "offset", "item",
+        "declare", "funcref", "externref", "anyfunc", "i32", "i64", "f32", "f64",
+        "v128",
+        # control and parametric instructions
+        "block", "loop", "if", "then", "else", "end", "br", "br_if", "br_table",
+        "return", "call", "call_indirect", "return_call", "return_call_indirect",
+        "unreachable", "nop", "drop", "select",
+        # variable, table, memory and reference instructions
+        "local.get", "local.set", "local.tee", "global.get", "global.set",
+        "table.get", "table.set", "table.size", "table.grow", "table.fill",
+        "table.copy", "table.init", "elem.drop", "memory.size", "memory.grow",
+        "memory.fill", "memory.copy", "memory.init", "data.drop", "ref.null",
+        "ref.is_null", "ref.func",
+        # script commands
+        "register", "invoke", "get", "assert_return", "assert_trap",
+        "assert_exhaustion", "assert_malformed", "assert_invalid",
+        "assert_unlinkable", "input", "output", "script", "binary", "quote",
+        "nan:canonical", "nan:arithmetic",
+        # conversions
+        "i32.wrap_i64", "i64.extend_i32_s", "i64.extend_i32_u", "i32.extend8_s",
+        "i32.extend16_s", "i64.extend8_s", "i64.extend16_s", "i64.extend32_s",
+        "f32.demote_f64", "f64.promote_f32", "i32.reinterpret_f32",
+        "i64.reinterpret_f64", "f32.reinterpret_i32", "f64.reinterpret_i64",
+        "v128.const", "v128.load", "v128.store",
+    ]
+    # fmt: on
+    int_ops = (
+        "const clz ctz popcnt add sub mul div_s div_u rem_s rem_u and or xor shl "
+        "shr_s shr_u rotl rotr eqz eq ne lt_s lt_u gt_s gt_u le_s le_u ge_s ge_u "
+        "load store load8_s load8_u load16_s load16_u store8 store16"
+    ).split()
+    float_ops = (
+        "const abs neg ceil floor trunc nearest sqrt add sub mul div min max "
+        "copysign eq ne lt gt le ge load store"
+    ).split()
+    for t in ("i32", "i64"):
+        keywords += ["%s.%s" % (t, op) for op in int_ops]
+        for f in ("f32", "f64"):
+            for sign in ("s", "u"):
+                keywords.append("%s.trunc_%s_%s" % (t, f, sign))
+                keywords.append("%s.trunc_sat_%s_%s" % (t, f, sign))
+                keywords.append("%s.convert_%s_%s" % (f, t, sign))
+    keywords += ["i64.load32_s", "i64.load32_u", "i64.store32"]
+    for t in ("f32", "f64"):
+        keywords += ["%s.%s" % (t, op) for op in float_ops]
+    return keywords
+
+
+class PrefixTrie:
+    """A set of words which can be searched by prefix. The (sorted) words below each
+    node are cached the first time they're searched for, and the cache of every node
+    along a new word's path is cleared when it's added, so repeated searches only
+    have to walk the prefix.
+    """
+
+    class _Node:
+        __slots__ = ("children", "terminal", "words")
+
+        def __init__(self):
+            self.children: Dict[str, "PrefixTrie._Node"] = {}
+            self.terminal = False
+            self.words: Optional[tuple] = None
+
+    def __init__(self, words=()):
+        self._root = self._Node()
+        self._size = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, word):
+        node = self._find(word)
+        return node is not None and node.terminal
+
+    def add(self, word):
+        node = self._root
+        node.words = None
+        for c in word:
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = self._Node()
+            node = child
+            node.words = None
+        if not node.terminal:
+            node.terminal = True
+            self._size += 1
+
+    def complete(self, prefix):
+        """Return the words which start with `prefix`, in sorted order"""
+        node = self._find(prefix)
+        if node is None:
+            return ()
+        if node.words is None:
+            words = []
+            self._collect(node, prefix, words)
+            node.words = tuple(sorted(words))
+        return node.words
+
+    def _find(self, prefix):
+        node = self._root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        return node
+
+    def _collect(self, node, prefix, words):
+        if node.words is not None:
+            words.extend(node.words)
+            return
+        if node.terminal:
+            words.append(prefix)
+        for c, child in node.children.items():
+            self._collect(child, prefix + c, words)
+
+
+_keyword_trie = None
+
+
+def keyword_trie():
+    """The trie of WAT keywords and instructions, which is built the first time it's
+    needed
+    """
+    global _keyword_trie
+    if _keyword_trie is None:
+        _keyword_trie = PrefixTrie(_wat_keywords())
+    return _keyword_trie
+
+
+identifier_pat = re.compile(r'\$[^\s()";]+')
+export_pat = re.compile(r'\(export\s+"((?:[^"\\]|\\.)*)"')
+output_module_pat = re.compile(r"^module (\$[^\s()\";]+) :", re.MULTILINE)
+output_export_pat = re.compile(r'^\s*export \w+ "((?:[^"\\]|\\.)*)"', re.MULTILINE)
+
+# The token which is being completed: an identifier, a string (which might not be
+# closed yet), or a keyword
+_token_pat = re.compile(r'(\$[^\s()";]*|"(?:[^"\\]|\\.)*|[^\s()";$]+)$')
+
+
+class SymbolIndex:
+    """The `$identifiers` and exported names which have been defined in a session,
+    collected from executed cells and from the interpreter's output.
+    """
+
+    #: Lines of output which are split across pieces are only kept up to this length,
+    #: since the lines which are indexed are short
+    max_line = 4 * 1024
+
+    def __init__(self):
+        self.identifiers = PrefixTrie()
+        self.exports = PrefixTrie()
+        self._partial_output = ""
+
+    def add_code(self, code):
+        for identifier in identifier_pat.findall(code):
+            self.identifiers.add(identifier)
+        for name in export_pat.findall(code):
+            self.exports.add(name)
+
+    def add_output(self, text):
+        """Index the interpreter's output, which may be passed in pieces (lines are
+        only indexed once they're complete, or once `end_output` is called)
+        """
+        lines, newline, partial = text.rpartition("\n")
+        if not newline:
+            room = self.max_line - len(self._partial_output)
+            if room > 0:
+                self._partial_output += text[:room]
+            return
+        lines = self._partial_output + lines
+        self._partial_output = partial[: self.max_line]
+        for identifier in output_module_pat.findall(lines):
+            self.identifiers.add(identifier)
+        for name in output_export_pat.findall(lines):
+            self.exports.add(name)
+
+    def end_output(self):
+        if self._partial_output:
+            self.add_output("\n")
+
+    def complete(self, code, cursor_pos):
+        """Return the content of a complete_reply for the token before the cursor"""
+        # tokens (including strings) can't span lines
+        line_start = code.rfind("\n", 0, cursor_pos) + 1
+        m = _token_pat.search(code, line_start, cursor_pos)
+        if m is None:
+            return {
+                "matches": [],
+                "cursor_start": cursor_pos,
+                "cursor_end": cursor_pos,
+                "metadata": {},
+                "status": "ok",
+            }
+        token = m.group(1)
+        if token.startswith("$"):
+            matches = self.identifiers.complete(token)
+            # identifiers which are only defined in the cell being edited
+            local = {
+                identifier
+                for identifier in identifier_pat.findall(code)
+                if identifier.startswith(token) and identifier != token
+            }
+            if local:
+                matches = sorted(local.union(matches))
+        elif token.startswith('"'):
+            matches = ['"%s"' % name for name in self.exports.complete(token[1:])]
+        else:
+            matches = keyword_trie().complete(token)
+        return {
+            "matches": list(matches),
+            "cursor_start": m.start(1),
+            "cursor_end": cursor_pos,
+            "metadata": {},
+            "status": "ok",
+        }
@@ -1,6 +1,7 @@
-# The max int size for OCaml on 32-bit systems should be 2^31 (since 1 bit is
-# reserved by the runtime)
-LESS_THAN_OCAML_MAX_INT = str(2 ^ 30)
+# The max int size for OCaml on 32-bit systems is 2^30 - 1 (since 1 bit is reserved by
+# the runtime). This is used as the interpreter's line width, so that it never wraps
+# its output.
+LESS_THAN_OCAML_MAX_INT = str(2 ** 30 - 1)
 
 KERNEL_NAME = "wasm_spec"
 KERNEL_IMPLEMENTATION_NAME = KERNEL_NAME + "_kernel"
@@ -9,3 +10,22 @@ KERNEL_IMPLEMENTATION_NAME = KERNEL_NAME + "_kernel"
 ENV_LOG_FILE = "WASM_KERNEL_LOG_FILE"
 ENV_LOG_LEVEL = "WASM_KERNEL_LOG_LEVEL"
 ENV_WASM_INTERPRETER = "WASM_INTERPRETER"
+ENV_FRAMED = "WASM_KERNEL_FRAMED"
+ENV_SPARES = "WASM_KERNEL_SPARES"
+ENV_PRELUDE = "WASM_KERNEL_PRELUDE"
+ENV_JOURNAL = "WASM_KERNEL_JOURNAL"
+ENV_SHADOW = "WASM_KERNEL_SHADOW"
+ENV_CACHE_DIR = "WASM_KERNEL_CACHE_DIR"
+ENV_PROBE = "WASM_KERNEL_PROBE"
+ENV_BINARY_CACHE_MIN = "WASM_KERNEL_BINARY_CACHE_MIN"
+ENV_OUTPUT_LIMIT = "WASM_KERNEL_OUTPUT_LIMIT"
+ENV_RESULTS = "WASM_KERNEL_RESULTS"
+ENV_POOL_SOCKET = "WASM_KERNEL_POOL_SOCKET"
+ENV_METRICS = "WASM_KERNEL_METRICS"
+ENV_METRICS_DIR = "WASM_KERNEL_METRICS_DIR"
+ENV_CELL_TIMEOUT = "WASM_KERNEL_CELL_TIMEOUT"
+ENV_CPU_LIMIT = "WASM_KERNEL_CPU_LIMIT"
+ENV_MEMORY_LIMIT = "WASM_KERNEL_MEMORY_LIMIT"
+ENV_RESULT_CACHE = "WASM_KERNEL_RESULT_CACHE"
+ENV_RESULT_CACHE_SIZE = "WASM_KERNEL_RESULT_CACHE_SIZE"
+ENV_STANDALONE_MIN_FORMS = "WASM_KERNEL_STANDALONE_MIN_FORMS"
@@ -0,0 +1,143 @@
+"""Tracking of the module and registered instance names which each executed form
+defines and references, so that after a change only the forms which depend on it
+need to be run again (see %rerun_affected).
+
+Module names (`$A`) are defined by `module` forms, and referenced by `invoke`, `get`
+and `register`. Registered names (kept in quotes, e.g. `"a"`) are defined by
+`register` and referenced by imports. Anonymous modules get a name of their own
+(`module:N`), which `invoke`s and `register`s without a module name refer to. Files
+read with `input` (e.g. by %load_wat) are scanned for the names they define and
+reference.
+"""
+import re
+from typing import FrozenSet, NamedTuple
+
+from .syntax import split_forms
+
+
+_name = r"""(\$[^\s()";]+)"""
+_string = r'"((?:[^"\\]|\\.)*)"'
+
+comment_pat = re.compile(r";;[^\n]*|\(;.*?;\)", re.DOTALL)
+head_pat = re.compile(r"\(\s*([a-z_]+)")
+module_pat = re.compile(r"\(\s*module(?:\s+%s)?" % _name)
+register_pat = re.compile(r"\(\s*register\s+%s(?:\s+%s)?" % (_string, _name))
+input_pat = re.compile(r"\(\s*input(?:\s+%s)?\s+%s" % (_name, _string))
+reference_pat = re.compile(r"\(\s*(?:invoke|get)\s+(?:%s|\")" % _name)
+import_pat = re.compile(r"\(\s*import\s+%s" % _string)
+
+
+class Form(NamedTuple):
+    code: str
+    #: The execution count of the cell which the form was executed in
+    cell: int
+    defines: FrozenSet[str]
+    references: FrozenSet[str]
+
+
+class DependencyGraph:
+    """The forms which were executed successfully, in the order they were executed,
+    and the names which each of them defines and references
+    """
+
+    def __init__(self):
+        self.forms = []
+        self._anonymous_modules = 0
+        self._last_module = None
+
+    def add(self, code, cell):
+        """Add the forms of a cell which was executed successfully"""
+        for text in split_forms(code) or []:
+            defines, references = self._symbols(text)
+            self.forms.append(
+                Form(text, cell, frozenset(defines), frozenset(references))
+            )
+
+    def _symbols(self, text, read_files=True):
+        defines = set()
+        references = set()
+        text = comment_pat.sub(" ", text)
+        m = head_pat.match(text)
+        head = m.group(1) if m else None
+        if head == "module":
+            name = module_pat.match(text).group(1)
+            if name is None:
+                self._anonymous_modules += 1
+                name = "module:%d" % self._anonymous_modules
+            defines.add(name)
+            references.update('"%s"' % s for s in import_pat.findall(text))
+            self._last_module = name
+        elif head == "register":
+            m = register_pat.match(text)
+            if m is not None:
+                defines.add('"%s"' % m.group(1))
+                module = m.group(2) or self._last_module
+                if module is not None:
+                    references.add(module)
+        elif head == "input" and read_files:
+            m = input_pat.match(text)
+            try:
+                with open(m.group(2), errors="replace") as f:
+                    contents = f.read()
+            except (OSError, AttributeError):
+                contents = ""
+            for form in split_forms(contents) or []:
+                form_defines, form_references = self._symbols(form, False)
+                references.update(form_references - defines)
+                defines.update(form_defines)
+        else:
+            for name in reference_pat.findall(text):
+                if name:
+                    references.add(name)
+                elif self._last_module is not None:
+                    references.add(self._last_module)
+            references.update('"%s"' % s for s in import_pat.findall(text))
+        return defines, references
+
+    def _superseded(self):
+        """The indexes of forms which were executed again later, or whose names were
+        all defined again by a later form (eg. an earlier version of an edited cell)
+        """
+        superseded = set()
+        later_code = set()
+        later_defines = set()
+        for index in range(len(self.forms) - 1, -1, -1):
+            form = self.forms[index]
+            if form.code in later_code or (
+                form.defines and form.defines in later_defines
+            ):
+                superseded.add(index)
+            later_code.add(form.code)
+            if form.defines:
+                later_defines.add(form.defines)
+        return superseded
+
+    def affected(self, names, end=None):
+        """The forms executed before index `end` which depend on any of `names`,
+        directly or through the names defined by other affected forms, in the order
+        they were executed. Forms which were superseded are left out.
+        """
+        end = len(self.forms) if end is None else end
+        names = set(names)
+        superseded = self._superseded()
+        affected = []
+        for index, form in enumerate(self.forms[:end]):
+            if index not in superseded and form.references & names:
+                affected.append(form)
+                names |= form.defines
+        return affected
+
+    def last_cell_change(self):
+        """The names defined by the most recently executed cell, and the index of its
+        first form, or None if no cell was executed
+        """
+        if not self.forms:
+            return None
+        cell = self.forms[-1].cell
+        start = len(self.forms)
+        while start > 0 and self.forms[start - 1].cell == cell:
+            start -= 1
+        names = set()
+        for form in self.forms[start:]:
+            names |= form.defines
+        return names, start
@@ -1,20 +1,44 @@
 import json
 import os
+import shutil
+import subprocess
 import sys
 import argparse
 
 from jupyter_client.kernelspec import KernelSpecManager  # type: ignore
 from IPython.utils.tempdir import TemporaryDirectory  # type: ignore
 
+from .defs import ENV_PROBE
+from .probe import install_seed, probe_interpreter
 
-def gen_kernel_json(interpreter=None):
-    return {
+
+def probe_for_install(interpreter):
+    """Probe the interpreter so that its results are cached before any kernels start,
+    returning the value of WASM_KERNEL_PROBE for kernels to use if their cache is
+    empty, or None if it can't be probed (e.g. it isn't installed yet)
+    """
+    interpreter_path = shutil.which(interpreter) if interpreter else None
+    if interpreter_path is None:
+        print("Unable to find `%s`, skipping the interpreter probe" % interpreter)
+        return None
+    try:
+        return install_seed(interpreter_path, probe_interpreter(interpreter_path))
+    except (OSError, subprocess.SubprocessError) as e:
+        print("Unable to probe `%s`: %s" % (interpreter_path, e))
+        return None
+
+
+def gen_kernel_json(interpreter=None, probe=None):
+    kernel_json = {
         "argv": [sys.executable, "-m", "wasm_spec_kernel", "-f", "{connection_file}"],
         "display_name": "WebAssembly Reference Interpreter",
         "language": "wat",
         "codemirror_mode": "commonlisp",
         "env": {"WASM_INTERPRETER": interpreter},
     }
+    if probe is not None:
+        kernel_json["env"][ENV_PROBE] = probe
+    return kernel_json
 
 
 def install_my_kernel_spec(user=True, prefix=None, **kwargs):
@@ -70,7 +94,12 @@ def main(argv=None):
     elif args.user or not _is_root():
         user = True
 
-    install_my_kernel_spec(user=user, prefix=prefix, interpreter=args.interpreter)
+    install_my_kernel_spec(
+        user=user,
+        prefix=prefix,
+        interpreter=args.interpreter,
+        probe=probe_for_install(args.interpreter),
+    )
 
 
 if __name__ == "__main__":
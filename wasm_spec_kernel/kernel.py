@@ -1,31 +1,65 @@
 from . import __version__
 from .defs import (
+    ENV_BINARY_CACHE_MIN,
+    ENV_CELL_TIMEOUT,
+    ENV_CPU_LIMIT,
+    ENV_FRAMED,
+    ENV_JOURNAL,
     ENV_LOG_FILE,
     ENV_LOG_LEVEL,
-    ENV_WASM_INTERPRETER,
-    LESS_THAN_OCAML_MAX_INT,
+    ENV_METRICS,
+    ENV_METRICS_DIR,
+    ENV_OUTPUT_LIMIT,
+    ENV_RESULT_CACHE,
+    ENV_RESULT_CACHE_SIZE,
+    ENV_RESULTS,
+    ENV_SHADOW,
+    ENV_STANDALONE_MIN_FORMS,
+    ENV_SPARES,
     KERNEL_IMPLEMENTATION_NAME,
     KERNEL_NAME,
 )
 from ipykernel.kernelbase import Kernel  # type: ignore
+import asyncio
+import collections
 import os
 import logging
 import pexpect  # type: ignore
-from .wasm_replwrap import WasmREPLWrapper
+from .limits import LimitExceeded, run_limited
+from .metrics import KernelStats, Spans, process_stats
+from .output import CoalescedStream, OutputBudget, read_page
+from .completion import SymbolIndex
+from .dependencies import DependencyGraph
+from .magics import (
+    LOAD_EXTENSIONS,
+    MagicError,
+    expand_paths,
+    load_command,
+    page_output_args,
+    parallel_invoke_args,
+    parse_magic,
+    rerun_affected_args,
+)
+from .syntax import CompletenessChecker
+from .startup import (
+    StartingInterpreter,
+    find_interpreter,
+    memory_limit,
+    prelude_paths,
+    spawn_wasm,
+    start_interpreter,
+    take_prestarted,
+)
+from .wasm_replwrap import error_pat
 import shutil
-import re
 import signal
-from subprocess import check_output
 import sys
-import traceback
+import tempfile
+import threading
+import time
 from typing import Dict, Any
 
 
-version_pat = re.compile(r"wasm (\d+(\.\d+)+)")
-error_pat = re.compile(
-    r"stdin:(\d+.\d+-\d+.\d+): (.+?): (.+)"
-)  # 1=location, 2=type, 3=details
-
 log_level = int(os.environ.get(ENV_LOG_LEVEL, str(logging.WARNING)))
 log_params: Dict[str, Any] = {"level": log_level}
 log_path = os.environ.get(ENV_LOG_FILE)
@@ -34,38 +68,192 @@ if log_path is not None:
 logging.basicConfig(**log_params)
 logger = logging.getLogger(__name__)
 
+# How many cells' saved outputs are kept on disk for %page_output
+MAX_SAVED_OUTPUTS = 20
+
+
+def _terminate(child):
+    try:
+        child.terminate(force=True)
+    except Exception:
+        logger.debug("encountered an error while killing a wasm process", exc_info=True)
+
 
 class WasmKernel(Kernel):
     def __init__(self, **kwargs):
         Kernel.__init__(self, **kwargs)
-        env_interpreter = os.environ.get(ENV_WASM_INTERPRETER, "wasm")
-        self._interpreter_path = shutil.which(env_interpreter)
-        if self._interpreter_path is None:
-            raise Exception(
-                "Unable to find a `%s` executable in $PATH: %s"
-                % (env_interpreter, os.environ.get("PATH"))
+        self._interpreter_path = find_interpreter()
+        # The interpreter is probed in the background (unless its probe is cached), so
+        # that kernel_info requests only wait for its banner, if at all
+        self._probe_ready = threading.Event()
+        threading.Thread(target=self._run_probe, daemon=True).start()
+        # Framed execution sends whole cells at once instead of line by line, set
+        # WASM_KERNEL_FRAMED=0 to disable it
+        self._framed = os.environ.get(ENV_FRAMED, "1") != "0"
+        # Spare interpreters (WASM_KERNEL_SPARES, none by default since each one is
+        # another process) are started ahead of time so that restarts don't have to
+        # wait for a new process, and each one loads the prelude's files first (an
+        # interpreter pool daemon keeps its own pre-warmed interpreters instead)
+        self._num_spares = int(os.environ.get(ENV_SPARES, "0"))
+        self._prelude = prelude_paths()
+        # Cells which run for longer than WASM_KERNEL_CELL_TIMEOUT seconds, or whose
+        # interpreter uses more than WASM_KERNEL_CPU_LIMIT seconds of CPU time, are
+        # stopped and the session is restored into a new interpreter. The interpreter's
+        # address space is limited to WASM_KERNEL_MEMORY_LIMIT megabytes.
+        self._cell_timeout = float(os.environ.get(ENV_CELL_TIMEOUT, "0")) or None
+        self._cpu_limit = float(os.environ.get(ENV_CPU_LIMIT, "0")) or None
+        self._memory_limit = memory_limit()
+        # Self-contained cells with at least WASM_KERNEL_STANDALONE_MIN_FORMS forms
+        # (like cells marked with %%standalone) are run as scripts in new interpreters
+        # instead of in the session's interpreter
+        self._standalone_min_forms = int(os.environ.get(ENV_STANDALONE_MIN_FORMS, "0"))
+        self._spares = collections.deque()
+        self._spares_lock = threading.Lock()
+        self._spares_pending = 0
+        self._shutting_down = False
+        self._completeness = CompletenessChecker()
+        # Cells which define a single large module are re-sent in the module's binary
+        # encoding, set WASM_KERNEL_BINARY_CACHE_MIN to the smallest cell (in
+        # characters) which should be cached, or to 0 to disable the cache
+        binary_cache_min = int(os.environ.get(ENV_BINARY_CACHE_MIN, str(64 * 1024)))
+        if binary_cache_min > 0:
+            from .binary_cache import BinaryModuleCache
+            from .probe import cache_dir
+
+            self._binary_cache = BinaryModuleCache(
+                self._interpreter_path,
+                os.path.join(cache_dir(), "modules"),
+                binary_cache_min,
             )
-        self._start_wasm()
+        # Each cell's output is sent to the frontend up to WASM_KERNEL_OUTPUT_LIMIT
+        # characters, beyond which it's saved to disk (and can be paged through with
+        # %page_output) so that the kernel's memory use stays bounded, set it to 0 to
+        # send all of the output
+        self._output_limit = int(os.environ.get(ENV_OUTPUT_LIMIT, str(256 * 1024)))
+        self._saved_outputs = collections.OrderedDict()
+        if self._output_limit > 0:
+            self._output_dir = tempfile.mkdtemp(prefix="wasm_spec_kernel_output_")
+        # The interpreter's output can be parsed into structured results, which are
+        # sent as an application/json display after each cell, set
+        # WASM_KERNEL_RESULTS=1 to enable
+        self._send_results = os.environ.get(ENV_RESULTS, "0") != "0"
+        # Each cell is timed stage by stage (see metrics), and the totals are shown by
+        # %kernel_stats. Set WASM_KERNEL_METRICS=1 to add a cell's timings to the
+        # metadata of its execute reply, and WASM_KERNEL_METRICS_DIR to write the
+        # totals to a file in Prometheus' text format after every cell
+        self._reply_metrics = os.environ.get(ENV_METRICS, "0") != "0"
+        self._stats = KernelStats(os.environ.get(ENV_METRICS_DIR))
+        # Names defined in the session are indexed for completions
+        self._symbols = SymbolIndex()
+        for path in self._prelude:
+            try:
+                with open(path) as f:
+                    self._symbols.add_code(f.read())
+            except OSError:
+                pass
+        # The names which each successfully executed form defines and references are
+        # tracked, so that %rerun_affected can re-run only the forms affected by a change
+        self._dependencies = DependencyGraph()
+        # Successfully executed cells are journaled so that they can be replayed
+        # into a new interpreter after a restart, set WASM_KERNEL_JOURNAL=0 to disable
+        self._journal = [] if os.environ.get(ENV_JOURNAL, "1") != "0" else None
+        # Cells' results can be cached on disk (keyed by the interpreter, the session's
+        # history, and the cell) so that re-running an unchanged notebook replays them
+        # instead, set WASM_KERNEL_RESULT_CACHE=1 to enable. The interpreter is then
+        # only started once a cell misses the cache, and the journal brings it up to
+        # date with the cells which hit it.
+        if os.environ.get(ENV_RESULT_CACHE, "0") != "0":
+            if self._journal is None:
+                logger.warning("the result cache requires the journal, ignoring")
+            else:
+                from .probe import cache_dir
+                from .result_cache import ResultCache
+
+                self._result_cache = ResultCache(
+                    os.path.join(cache_dir(), "results"),
+                    int(os.environ.get(ENV_RESULT_CACHE_SIZE, "64")) * 2 ** 20,
+                )
+                self._history = ResultCache.initial_history(
+                    self._interpreter_path,
+                    self._prelude,
+                    (__version__, self._framed, self._output_limit, self._send_results),
+                )
+        # The interpreter starts in the background (usually before the kernel is even
+        # created, see __main__) so that the kernel can answer messages straight away,
+        # and the first cell waits for it if it isn't ready yet
+        if self._result_cache is None:
+            self._starting = take_prestarted() or StartingInterpreter(self._spawn_wasm)
+        # A standby interpreter mirrors the session (using the journal), so that it
+        # can replace the interpreter immediately, set WASM_KERNEL_SHADOW=1 to enable
+        if os.environ.get(ENV_SHADOW, "0") != "0":
+            if self._journal is None:
+                logger.warning("the shadow interpreter requires the journal, ignoring")
+            elif self._result_cache is not None:
+                # started along with the interpreter
+                self._shadow_pending = True
+            else:
+                from .shadow import ShadowInterpreter
+
+                self._shadow = ShadowInterpreter(self._spawn_wasm)
 
     implementation = KERNEL_IMPLEMENTATION_NAME
     implementation_version = __version__
 
-    _banner = None
+    _binary_cache = None
+    _output_dir = None
+    _probe = None
+    _framed = True
+    _journal = None
+    _loop = None
+    _running = None
+    _shadow = None
+    _shadow_pending = False
+    _result_cache = None
+    _history = None
+    _recorded = None
+    _spans = None
+    _standalone_checked = (None, False)
+    _starting = None
     _interpreter_path = None
     child = None
+    wasmwrapper = None
+
+    @property
+    def probe(self):
+        """The interpreter's banner, version, and supported proposals (which are
+        cached on disk, so that kernel_info requests don't spawn an interpreter).
+        Until the proposals have been probed, there's no "proposals" entry.
+        """
+        self._probe_ready.wait()
+        if self._probe is None:
+            return {
+                "banner": "%s (unable to determine its version)"
+                % self._interpreter_path,
+                "version": None,
+            }
+        return self._probe
+
+    def _run_probe(self):
+        from .probe import probe_interpreter
+
+        def on_banner(result):
+            self._probe = result
+            self._probe_ready.set()
+
+        try:
+            self._probe = probe_interpreter(self._interpreter_path, on_banner=on_banner)
+        except Exception:
+            logger.exception("unable to probe the wasm interpreter")
+        finally:
+            self._probe_ready.set()
 
     @property
     def banner(self):
-        if self._banner is None:
-            self._banner = check_output(
-                [self._interpreter_path, "-v", "-e", ""]
-            ).decode("utf-8")
-        return self._banner
+        return self.probe["banner"]
 
     @property
     def language_version(self):
-        m = version_pat.search(self.banner)
-        return m.group(1)
+        return self.probe["version"]
 
     language_info = {
         "name": KERNEL_NAME,
@@ -82,63 +270,434 @@ class WasmKernel(Kernel):
         )
         if kill_existing and self.child is not None:
             logger.debug("killing existing wasm process")
+            # pexpect waits for the process to exit, which takes at least 100ms, so
+            # that's done in the background while the new interpreter is swapped in
+            threading.Thread(target=_terminate, args=(self.child,), daemon=True).start()
+        self.wasmwrapper = self._take_spare()
+        if self.wasmwrapper is None:
+            logger.debug("no spare wasm process available, starting one")
+            self.wasmwrapper = self._spawn_wasm()
+        self.child = self.wasmwrapper.child
+        self._refill_spares()
+
+    def _spawn_wasm(self):
+        """Start a new wasm interpreter, load the prelude into it and wait until it's
+        ready for input. This is safe to call from background threads.
+        """
+        return start_interpreter(
+            self._interpreter_path, self._prelude, self._memory_limit
+        )
+
+    async def _wait_for_wasm(self):
+        """Wait for the interpreter started alongside the kernel, if it isn't ready yet,
+        or start it if the kernel started without one (see WASM_KERNEL_RESULT_CACHE)
+        """
+        if self.wasmwrapper is None and self._starting is None:
+            await self._start_lazily()
+            return
+        starting = self._starting
+        if starting is None:
+            return
+        wasmwrapper = await asyncio.get_event_loop().run_in_executor(
+            None, starting.result
+        )
+        self._starting = None
+        self.wasmwrapper = wasmwrapper
+        self.child = wasmwrapper.child
+        self._refill_spares()
+
+    async def _start_lazily(self):
+        """Start the interpreter for the first cell which misses the result cache, and
+        replay the cells which hit the cache into it. Like the interpreter started
+        alongside the kernel, it starts in the background, and the replay waits using
+        the event loop, so that interrupts and control messages are handled meanwhile.
+        """
+        logger.debug("starting the wasm process for the first cell not in the cache")
+        self._starting = StartingInterpreter(self._spawn_wasm)
+        await self._wait_for_wasm()
+        if self._shadow_pending:
+            from .shadow import ShadowInterpreter
+
+            self._shadow = ShadowInterpreter(self._spawn_wasm, self._journal)
+            self._shadow_pending = False
+        if not self._journal:
+            return
+        logger.debug("replaying %d journaled cells", len(self._journal))
+        start = time.monotonic()
+        try:
+            output = await self.wasmwrapper.run_command_async(
+                self._journal_command(), timeout=None, framed=True
+            )
+        except asyncio.CancelledError:
+            # the cell restarts the interpreter and replays the journal again
+            raise
+        except Exception as e:
+            self._replay_failed(e)
+            return
+        self._report_replay(output, time.monotonic() - start, announce=False)
+
+    def _take_spare(self):
+        """Remove and return a spare wasm interpreter from the pool, if one is ready"""
+        with self._spares_lock:
+            while self._spares:
+                wasmwrapper = self._spares.popleft()
+                if wasmwrapper.child.isalive():
+                    logger.debug("using spare wasm process")
+                    return wasmwrapper
+                _terminate(wasmwrapper.child)
+        return None
+
+    def _refill_spares(self):
+        """Start spare wasm interpreters in the background until the pool is full"""
+        with self._spares_lock:
+            missing = self._num_spares - len(self._spares) - self._spares_pending
+            self._spares_pending += max(missing, 0)
+        for _ in range(missing):
+            threading.Thread(target=self._add_spare, daemon=True).start()
+
+    def _add_spare(self):
+        try:
+            wasmwrapper = self._spawn_wasm()
+        except Exception:
+            logger.exception("unable to start a spare wasm process")
+            wasmwrapper = None
+        with self._spares_lock:
+            self._spares_pending -= 1
+            if wasmwrapper is not None and not self._shutting_down:
+                self._spares.append(wasmwrapper)
+                return
+        if wasmwrapper is not None:
+            _terminate(wasmwrapper.child)
+
+    def _recover(self, kill_existing=False):
+        """Replace an interpreter which was interrupted or crashed, and restore the
+        session's state in the new interpreter. The shadow interpreter is promoted if
+        there is one, otherwise the journal is replayed into a new interpreter.
+        """
+        if self._shutting_down:
+            return
+        self._stats.restarts += 1
+        if self._starting is not None:
+            # the initial interpreter never became ready (e.g. it was interrupted)
+            self._starting.discard()
+            self._starting = None
+        if self._shadow is not None:
+            logger.debug("promoting shadow interpreter")
             try:
-                self.child.terminate(force=True)
-            except Exception:
-                logger.debug(
-                    "encountered an error while killing existing wasm process",
-                    exc_info=True,
+                wasmwrapper = self._shadow.promote()
+            except KeyboardInterrupt:
+                self._shadow.close()
+                wasmwrapper = None
+            if wasmwrapper is not None:
+                if kill_existing and self.child is not None:
+                    _terminate(self.child)
+                self.wasmwrapper = wasmwrapper
+                self.child = wasmwrapper.child
+                self._send_status(
+                    "Switched to the standby interpreter, which mirrors %d cells\n"
+                    % len(self._journal)
                 )
-        # Signal handlers are inherited by forked processes, and we can't easily
-        # reset it from the subprocess. Since kernelapp ignores SIGINT except in
-        # message handlers, we need to temporarily reset the SIGINT handler here
-        # so that wasm is interruptible.
-        sig = signal.signal(signal.SIGINT, signal.SIG_DFL)
+            else:
+                self._start_wasm(kill_existing=kill_existing)
+                self._restore_session()
+            from .shadow import ShadowInterpreter
+
+            self._shadow = ShadowInterpreter(self._spawn_wasm, self._journal)
+        else:
+            self._start_wasm(kill_existing=kill_existing)
+            self._restore_session()
+
+    def _restore_session(self, announce=True):
+        """Rebuild the interpreter's state after a restart by replaying the journal of
+        successfully executed cells as a single framed submission. The replay's output
+        is suppressed, and only a summary is reported to the frontend (unless
+        `announce` is false, in which case only errors are reported).
+        """
+        if not self._journal:
+            return
+        logger.debug("replaying %d journaled cells", len(self._journal))
+        start = time.monotonic()
         try:
-            logger.info("using wasm interpreter at `%s`" % self._interpreter_path)
-            # Use `-w 10000` to increase output width from 80 to something much larger so that
-            # text wrapping is handled by the jupyter frontend instead of the wasm interpreter
-            self.child = pexpect.spawn(
-                self._interpreter_path,
-                ["-w", LESS_THAN_OCAML_MAX_INT],
-                echo=False,
-                encoding="utf-8",
-                codec_errors="replace",
+            output = self.wasmwrapper.run_command(
+                self._journal_command(), timeout=None, framed=True
             )
-            self.wasmwrapper = WasmREPLWrapper(self.child)
-        finally:
-            signal.signal(signal.SIGINT, sig)
+        except (KeyboardInterrupt, Exception) as e:
+            self._replay_failed(e)
+            return
+        self._report_replay(output, time.monotonic() - start, announce)
 
-        # NOTE: use the following line to run any prep operation on the Wasm interpreter
-        # self.wasmwrapper.run_command(image_setup_cmd)
+    def _journal_command(self):
+        """The command which replays the journal, as a single framed submission"""
+        return "\n".join(self._cached_command(code) for code in self._journal)
+
+    def _replay_failed(self, e):
+        logger.debug("error raised while replaying the journal", exc_info=True)
+        self._start_wasm(kill_existing=True)
+        self._journal = []
+        self._send_status(
+            "Unable to replay the session journal (%s), the interpreter's state was reset\n"
+            % (type(e).__name__)
+        )
+
+    def _report_replay(self, output, elapsed, announce):
+        wasm_error = error_pat.search(output)
+        if wasm_error:
+            self._send_status(
+                "Replayed %d cells from the session journal in %.2fs, but an error occurred: %s\n"
+                % (len(self._journal), elapsed, wasm_error.group(0))
+            )
+        elif announce:
+            self._send_status(
+                "Replayed %d cells from the session journal in %.2fs\n"
+                % (len(self._journal), elapsed)
+            )
+
+    def _send_status(self, text):
+        self.send_response(
+            self.iopub_socket, "stream", {"name": "stderr", "text": text}
+        )
+
+    def do_shutdown(self, restart):
+        with self._spares_lock:
+            self._shutting_down = True
+            spares, self._spares = list(self._spares), collections.deque()
+        for wasmwrapper in spares:
+            _terminate(wasmwrapper.child)
+        if self._starting is not None:
+            self._starting.discard()
+        if self._shadow is not None:
+            self._shadow.close()
+        if self.child is not None:
+            _terminate(self.child)
+        if self._output_dir is not None:
+            shutil.rmtree(self._output_dir, ignore_errors=True)
+        self._stats.remove()
+        return {"status": "ok", "restart": restart}
 
     def do_execute(
         self, code, silent, store_history=True, user_expressions=None, allow_stdin=False
     ):
+        # Cells are executed by a coroutine so that the event loop (and with it the
+        # control channel) isn't blocked while the interpreter works. A future is
+        # returned instead of the coroutine itself, since ipykernel<6 only waits on
+        # futures while newer versions await anything awaitable.
+        return asyncio.ensure_future(self._do_execute(code, silent))
+
+    async def _do_execute(self, code, silent):
+        previous_sigint = signal.signal(signal.SIGINT, self._handle_sigint)
+        self._spans = Spans()
+        start = time.perf_counter()
+        pid, before = self._interpreter_stats()
+        try:
+            if self._result_cache is not None:
+                reply = await self._execute_with_cache(code, silent)
+            else:
+                reply = await self._execute_cell(code, silent)
+        finally:
+            signal.signal(signal.SIGINT, previous_sigint)
+        duration = time.perf_counter() - start
+        after_pid, after = self._interpreter_stats()
+        self._stats.add_cell(
+            duration,
+            self._spans,
+            reply["status"],
+            before if after_pid == pid else None,
+            after,
+        )
+        return reply
+
+    async def _execute_with_cache(self, code, silent):
+        """Execute a cell, or replay its result from the result cache if the interpreter
+        hasn't been started yet and the cell was executed with the same history before
+        """
+        code = code.rstrip()
+        if self._history is None:
+            return await self._execute_cell(code, silent)
+        try:
+            magic = parse_magic(code)
+        except MagicError:
+            magic = None
+        if magic is not None:
+            # magics aren't cached, and those which run interpreter commands (eg. ones
+            # which read files, whose contents aren't part of the history) end caching
+            # for the rest of the session
+            if magic.name in LOAD_EXTENSIONS or magic.name == "rerun_affected":
+                self._history = None
+            return await self._execute_cell(code, silent)
+        if self._is_standalone(code):
+            # standalone cells don't change the session
+            return await self._execute_cell(code, silent)
+        key = self._result_cache.key(self._history, code)
+        if self.wasmwrapper is None and self._starting is None:
+            cached = self._result_cache.get(key)
+            # cells which failed may have done part of their work, which the journal
+            # can't replay, so they're always run
+            if cached is not None and cached["reply"]["status"] == "ok":
+                logger.debug("replaying the cell's result from the cache")
+                self._history = self._result_cache.advance(self._history, code)
+                return self._replay_result(code, cached, silent)
+        restarts = self._stats.restarts
+        self._recorded = []
+        try:
+            reply = await self._execute_cell(code, silent)
+        except BaseException:
+            self._history = None
+            raise
+        finally:
+            recorded, self._recorded = self._recorded, None
+        if self._stats.restarts != restarts:
+            # whatever the cell did in the interpreter was lost
+            self._history = None
+            return reply
+        self._history = self._result_cache.advance(self._history, code)
+        # results whose output went over the output limit refer to a saved file, which
+        # may not exist later
+        if not silent and self.execution_count not in self._saved_outputs:
+            self._result_cache.put(key, {"reply": reply, "messages": recorded})
+        return reply
+
+    def _replay_result(self, code, cached, silent):
+        """Send the messages which a cell sent when its result was cached, and update
+        the session's state as if the cell had been executed
+        """
+        for msg_type, content in cached["messages"]:
+            if msg_type == "stream":
+                self._symbols.add_output(content["text"])
+            if not silent:
+                self.send_response(self.iopub_socket, msg_type, content)
+        self._symbols.end_output()
+        self._symbols.add_code(code)
+        self._dependencies.add(code, self.execution_count)
+        self._journal.append(code)
+        return dict(cached["reply"], execution_count=self.execution_count)
+
+    def send_response(self, stream, msg_or_type, content=None, *args, **kwargs):
+        # the messages which a cell sends are recorded for the result cache
+        if self._recorded is not None and stream is self.iopub_socket:
+            self._recorded.append([msg_or_type, content])
+        return super().send_response(stream, msg_or_type, content, *args, **kwargs)
+
+    def _interpreter_stats(self):
+        """The pid of the interpreter (which may be owned by the interpreter pool) and
+        its :func:`process_stats`, if it's running
+        """
+        pid = getattr(self.child, "pid", None)
+        if pid is None:
+            return None, None
+        return pid, process_stats(pid)
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        metadata = super().finish_metadata(parent, metadata, reply_content)
+        if self._reply_metrics and self._stats.last_cell is not None:
+            metadata[KERNEL_IMPLEMENTATION_NAME] = {"metrics": self._stats.last_cell}
+        return metadata
+
+    async def _execute_cell(self, code, silent):
         logger.debug("do_execute received: ```%s```", code)
         code = code.rstrip()
         logger.debug("do_execute will run: ```%s```", code)
 
         self.silent = silent
         if not code:
-            return {
-                "status": "ok",
-                "execution_count": self.execution_count,
-                "payload": [],
-                "user_expressions": {},
-            }
+            return self._ok_reply()
 
+        # Magics are translated into the command which they run, or are handled by the
+        # kernel itself, in which case they return the cell's reply
+        start = time.perf_counter()
+        standalone = False
+        sweep = None
         try:
-            output = self.wasmwrapper.run_command(code, timeout=None)
-            logger.debug("response from run_command: ```%s```" % output)
+            magic = parse_magic(code)
+            if magic is not None and magic.name == "standalone":
+                code = self._magic_standalone(magic)
+                standalone = True
+            elif magic is not None and magic.name == "parallel_invoke":
+                sweep = self._magic_parallel_invoke(magic)
+            elif magic is not None:
+                code = self._run_magic(magic)
+            else:
+                standalone = self._is_standalone(code)
+        except MagicError as e:
+            return self._error_reply("magic error", str(e))
+        finally:
+            self._spans.add("magic", time.perf_counter() - start)
+        if sweep is not None:
+            return await self._run_sweep(*sweep)
+        if isinstance(code, dict):
+            return code
+
+        # Cells which leave a form open would leave the interpreter waiting for more
+        # input, so they're rejected without being sent
+        start = time.perf_counter()
+        incomplete = self._completeness.scan(code).open
+        self._spans.add("syntax_check", time.perf_counter() - start)
+        if incomplete:
+            return self._error_reply(
+                "incomplete input",
+                "a form or block comment isn't closed",
+                "Incomplete input: a form or block comment isn't closed, so the "
+                "cell wasn't executed",
+            )
+
+        # Output is forwarded to the frontend while the cell runs, up to the output limit
+        forward_output = self._spans.timed("publish", self._forward_output)
+        budget = None
+        if self._output_limit > 0:
+            budget = OutputBudget(forward_output, self._output_limit, self._output_dir)
+        stream = CoalescedStream(budget or forward_output, spans=self._spans)
+        results = None
+        if self._send_results:
+            from .results import ResultParser
+
+            results = ResultParser()
+        restarted = False
+        try:
+            self._loop = asyncio.get_event_loop()
+            self._running = asyncio.ensure_future(
+                self._run_cell(code, stream, results, standalone)
+            )
+            try:
+                await self._running
+            finally:
+                self._running = None
 
         except pexpect.EOF:
             logger.debug("pexpect.EOF raised during run_command")
-            output = self.wasmwrapper.child.before + "Restarting Wasm"
-            self._start_wasm()
+            if self.wasmwrapper is not None:
+                stream.write(self.wasmwrapper.before)
+            if self._memory_limit is not None:
+                stream.write(
+                    "The interpreter exited, it may have gone over its memory limit "
+                    "of %d MB\n" % (self._memory_limit // 2 ** 20)
+                )
+            stream.write("Restarting Wasm")
+            stream.flush()
+            self._recover()
+            restarted = True
+
+        except LimitExceeded as e:
+            logger.debug("the cell exceeded %s", e)
+            self._finish_output(stream, budget)
+            error_content = {
+                "ename": "limit exceeded",
+                "evalue": "the cell exceeded %s" % e,
+                "traceback": [
+                    "Restarting Wasm because the cell exceeded %s, the session will "
+                    "be restored" % e
+                ],
+            }
+            if standalone:
+                error_content["traceback"] = ["The cell exceeded %s" % e]
+            self.send_response(self.iopub_socket, "error", error_content)
+            if not standalone:
+                self._recover(kill_existing=True)
+            error_content["execution_count"] = self.execution_count
+            error_content["status"] = "error"
+            return error_content
 
-        except KeyboardInterrupt:
-            logger.debug("KeyboardInterrupt raised during run_command")
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.debug("run_command was interrupted")
+            self._finish_output(stream, budget)
             # TODO if the wasm interpreter ever support SIGINT or some other interrupt mechanism,
             # use that instead so that the entire interpreter's state doesn't have to be thrown
             # out when a single execution is aborted.
@@ -148,14 +707,22 @@ class WasmKernel(Kernel):
                 {
                     "ename": "interrupt",
                     "evalue": "",
-                    "traceback": ["Restarting Wasm because execution was aborted"],
+                    "traceback": [
+                        "Execution was aborted"
+                        if standalone
+                        else "Restarting Wasm because execution was aborted"
+                    ],
                 },
             )
-            self._start_wasm(kill_existing=True)
+            if not standalone:
+                self._recover(kill_existing=True)
             return {"status": "abort", "execution_count": self.execution_count}
 
         except Exception:
             logger.exception("unknown error raised during run_command", exc_info=True)
+            self._finish_output(stream, budget)
+            import traceback
+
             exc_type, exc_value, exc_traceback = sys.exc_info()
             error_content = {
                 "ename": "unknown",
@@ -167,36 +734,428 @@ class WasmKernel(Kernel):
             }
             self.send_response(self.iopub_socket, "error", error_content)
 
-            self._start_wasm(kill_existing=True)
+            self._recover(kill_existing=True)
 
             error_content["execution_count"] = self.execution_count
             error_content["status"] = "error"
             return error_content
 
-        wasm_error = error_pat.search(output)
+        self._finish_output(stream, budget)
+        self._symbols.end_output()
+        if results is not None:
+            self._send_results_display(code, results)
+        wasm_error = stream.error
         if wasm_error:
             location, errtype, details = wasm_error.groups()
-            error_content = {"ename": errtype, "evalue": details, "traceback": [output]}
+            error_content = {
+                "ename": errtype,
+                "evalue": details,
+                "traceback": [wasm_error.group(0)],
+            }
             self.send_response(self.iopub_socket, "error", error_content)
 
             error_content["execution_count"] = self.execution_count
             error_content["status"] = "error"
             return error_content
 
+        elif standalone:
+            # nothing which the cell defined is kept in the session
+            return self._ok_reply()
+
         else:
-            if not self.silent:
-                self.send_response(
-                    self.iopub_socket, "stream", {"name": "stdout", "text": output}
-                )
-            return {
-                "status": "ok",
-                "execution_count": self.execution_count,
-                "payload": [],
-                "user_expressions": {},
-            }
+            self._symbols.add_code(code)
+            self._dependencies.add(code, self.execution_count)
+            if self._binary_cache is not None:
+                self._binary_cache.add(code)
+            if self._journal is not None and not restarted:
+                self._journal.append(code)
+                if self._shadow is not None:
+                    self._shadow.submit(code)
+            return self._ok_reply()
+
+    async def _run_cell(self, code, stream, results=None, standalone=False):
+        feed_results = None
+        if results is not None:
+            feed_results = self._spans.timed("results", results.feed)
+
+        def on_output(text):
+            if feed_results is not None:
+                feed_results(text)
+            stream.write(text)
+
+        if standalone:
+            from .standalone import analyze, run_standalone
+
+            await run_limited(
+                run_standalone(
+                    self._interpreter_path,
+                    self._prelude,
+                    analyze(code).segments,
+                    on_output,
+                    memory_limit=self._memory_limit,
+                ),
+                self._cell_timeout,
+            )
+            return
+
+        await self._wait_for_wasm()
+        self.wasmwrapper.spans = self._spans
+        await run_limited(
+            self.wasmwrapper.run_command_async(
+                self._cached_command(code),
+                timeout=None,
+                framed=self._framed,
+                on_output=on_output,
+            ),
+            self._cell_timeout,
+            self._cpu_limit,
+            getattr(self.child, "pid", None),
+        )
+
+    def _send_results_display(self, code, results):
+        """Send the results parsed from a cell's output as an application/json display"""
+        from .results import assertion_count
+
+        results.close()
+        if not self.silent:
+            self.send_response(
+                self.iopub_socket,
+                "display_data",
+                results.summary(assertion_count(code)),
+            )
+
+    def _finish_output(self, stream, budget):
+        """Send the rest of a cell's output, and keep track of where it was saved if
+        it went over the output limit
+        """
+        stream.close()
+        if budget is None:
+            return
+        path = budget.close(
+            ", run `%%page_output %d` to page through it" % self.execution_count
+        )
+        if path is not None:
+            self._saved_outputs[self.execution_count] = path
+            while len(self._saved_outputs) > MAX_SAVED_OUTPUTS:
+                _, old_path = self._saved_outputs.popitem(last=False)
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def _cached_command(self, code):
+        """The command which runs a cell, which is the binary encoding of the cell's
+        module if it's in the binary cache
+        """
+        if self._binary_cache is not None:
+            command = self._binary_cache.lookup(code)
+            if command is not None:
+                logger.debug("sending the cell's module in its binary encoding")
+                return command
+        return code
+
+    def _ok_reply(self, payload=()):
+        return {
+            "status": "ok",
+            "execution_count": self.execution_count,
+            "payload": list(payload),
+            "user_expressions": {},
+        }
+
+    def _error_reply(self, ename, evalue, message=None):
+        """Report an error which occurred before the cell was sent to the interpreter"""
+        error_content = {
+            "ename": ename,
+            "evalue": evalue,
+            "traceback": [message or "%s: %s" % (ename, evalue)],
+        }
+        self.send_response(self.iopub_socket, "error", error_content)
+        error_content["execution_count"] = self.execution_count
+        error_content["status"] = "error"
+        return error_content
+
+    def _run_magic(self, magic):
+        """Run a magic, returning the command which should be sent to the interpreter,
+        or the cell's reply if the magic doesn't involve the interpreter
+        """
+        if magic.name in LOAD_EXTENSIONS and magic.body is None:
+            return self._magic_load(magic)
+        if magic.name == "page_output" and magic.body is None:
+            return self._magic_page_output(magic)
+        if magic.name == "rerun_affected" and magic.body is None:
+            return self._magic_rerun_affected(magic)
+        if magic.name == "kernel_stats" and magic.body is None:
+            return self._magic_kernel_stats(magic)
+        raise MagicError("unknown magic `%s`" % magic.name)
+
+    def _magic_standalone(self, magic):
+        """%%standalone runs the rest of the cell as a script in new interpreters, see
+        the standalone module
+        """
+        if magic.args.strip() or magic.body is None:
+            raise MagicError("usage: %%standalone")
+        from .standalone import analyze
+
+        if analyze(magic.body) is None:
+            raise MagicError(
+                "%%standalone cells have to be valid and complete to be run as a script"
+            )
+        return magic.body.rstrip()
+
+    def _magic_parallel_invoke(self, magic):
+        """%%parallel_invoke invokes an export with each line of the cell as its
+        arguments, split across replicas of the session, see the sweep module
+        """
+        if magic.body is None:
+            raise MagicError(
+                "usage: %%parallel_invoke [-j WORKERS] [$MODULE] EXPORT, followed by "
+                "a tuple of arguments per line"
+            )
+        if self._journal is None:
+            raise MagicError("%%parallel_invoke requires the journal")
+        return parallel_invoke_args(magic.args, magic.body)
+
+    async def _run_sweep(self, module, export, workers, tuples):
+        """Run a %%parallel_invoke sweep and send its results as a display"""
+        from .sweep import format_result, invoke_command, parse_result, run_sweep
+
+        journal = "\n".join(self._cached_command(code) for code in self._journal)
+
+        def spawn_replica():
+            wasmwrapper = spawn_wasm(
+                self._interpreter_path, self._prelude, self._memory_limit
+            )
+            if journal:
+                wasmwrapper.run_command(journal, timeout=None, framed=True)
+            return wasmwrapper
+
+        commands = [invoke_command(module, export, args) for args in tuples]
+        self._loop = asyncio.get_event_loop()
+        self._running = asyncio.ensure_future(
+            run_limited(
+                run_sweep(spawn_replica, commands, workers or os.cpu_count() or 1),
+                self._cell_timeout,
+            )
+        )
+        try:
+            outputs = await self._running
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # the session's interpreter wasn't used, so it's kept
+            self.send_response(
+                self.iopub_socket,
+                "error",
+                {
+                    "ename": "interrupt",
+                    "evalue": "",
+                    "traceback": ["Execution was aborted"],
+                },
+            )
+            return {"status": "abort", "execution_count": self.execution_count}
+        except LimitExceeded as e:
+            return self._error_reply("limit exceeded", "the cell exceeded %s" % e)
+        except Exception as e:
+            logger.exception("error while running a sweep")
+            return self._error_reply("sweep error", str(e))
+        finally:
+            self._running = None
+
+        results = []
+        lines = []
+        for args, output in zip(tuples, outputs):
+            result = parse_result(output)
+            lines.append("%s -> %s" % (args, format_result(result)))
+            results.append(dict(result, args=args))
+        if not self.silent:
+            self.send_response(
+                self.iopub_socket,
+                "display_data",
+                {
+                    "data": {
+                        "text/plain": "\n".join(lines) + "\n",
+                        "application/json": {
+                            "module": module,
+                            "export": export,
+                            "results": results,
+                        },
+                    },
+                    "metadata": {},
+                },
+            )
+        return self._ok_reply()
+
+    def _is_standalone(self, code):
+        """Whether a cell should be run as a standalone script without being marked
+        as one: it has to be self-contained, define only anonymous modules, and have at
+        least WASM_KERNEL_STANDALONE_MIN_FORMS forms
+        """
+        if self._standalone_min_forms <= 0:
+            return False
+        if self._standalone_checked[0] != code:
+            from .standalone import analyze
+
+            analysis = analyze(code)
+            self._standalone_checked = (
+                code,
+                analysis is not None
+                and analysis.self_contained
+                and not analysis.defines
+                and analysis.forms >= self._standalone_min_forms,
+            )
+        return self._standalone_checked[1]
+
+    def _magic_load(self, magic):
+        """%load_wat and %load_wast take paths or globs of files, which the interpreter
+        reads itself instead of their contents being sent through the pty
+        """
+        paths = expand_paths(magic.args, LOAD_EXTENSIONS[magic.name])
+        for path in paths:
+            if not path.endswith(".wasm"):
+                try:
+                    with open(path, errors="replace") as f:
+                        self._symbols.add_code(f.read())
+                except OSError:
+                    pass
+        return load_command(paths)
+
+    def _magic_page_output(self, magic):
+        """%page_output shows a page of a cell's output which went over the output
+        limit, via the frontend's pager
+        """
+        execution_count, first_line = page_output_args(magic.args)
+        if not self._saved_outputs:
+            raise MagicError("no cell's output has gone over the output limit")
+        if execution_count is None:
+            execution_count = next(reversed(self._saved_outputs))
+        path = self._saved_outputs.get(execution_count)
+        if path is None:
+            raise MagicError("the output of cell [%d] wasn't saved" % execution_count)
+        try:
+            text, next_line = read_page(path, first_line, self._output_limit)
+        except OSError as e:
+            raise MagicError(
+                "unable to read the output of cell [%d]: %s" % (execution_count, e)
+            )
+        if next_line is not None:
+            text += "[... run `%%page_output %d %d` for the next page ...]\n" % (
+                execution_count,
+                next_line,
+            )
+        return self._ok_reply(
+            [{"source": "page", "data": {"text/plain": text}, "start": 0}]
+        )
+
+    def _magic_rerun_affected(self, magic):
+        """%rerun_affected re-runs the forms which depend on the names defined by the
+        last cell (or on the given names), in a single submission
+        """
+        names, dry_run = rerun_affected_args(magic.args)
+        end = None
+        if not names:
+            change = self._dependencies.last_cell_change()
+            if change is None or not change[0]:
+                raise MagicError("the last cell didn't define any modules")
+            names, end = change
+        affected = self._dependencies.affected(names, end)
+        changed = ", ".join(sorted(names))
+        if not affected:
+            self._send_stdout("No cells depend on %s\n" % changed)
+            return self._ok_reply()
+        cells = sorted({form.cell for form in affected})
+        summary = "%d forms from cells %s depend on %s" % (
+            len(affected),
+            ", ".join("[%d]" % cell for cell in cells),
+            changed,
+        )
+        if dry_run:
+            lines = [summary + ":"]
+            for form in affected:
+                first_line = form.code.split("\n", 1)[0]
+                lines.append("  [%d] %s" % (form.cell, first_line))
+            self._send_stdout("\n".join(lines) + "\n")
+            return self._ok_reply()
+        self._send_status("Re-running %s\n" % summary)
+        return "\n".join(form.code for form in affected)
+
+    def _magic_kernel_stats(self, magic):
+        """%kernel_stats shows the time spent in each stage of executing cells, and the
+        memory and CPU use of the kernel and its interpreter
+        """
+        if magic.args.strip():
+            raise MagicError("usage: %kernel_stats")
+        if not self.silent:
+            self.send_response(
+                self.iopub_socket,
+                "display_data",
+                {
+                    "data": {
+                        "text/plain": self._stats.format_text(),
+                        "application/json": self._stats.summary(),
+                    },
+                    "metadata": {},
+                },
+            )
+        return self._ok_reply()
+
+    def _cancel_execution(self):
+        """Cancel the interpreter command of the cell which is executing, if any. The
+        cell then restarts the interpreter and replies with an abort.
+        """
+        running, loop = self._running, self._loop
+        if running is None:
+            return False
+        loop.call_soon_threadsafe(running.cancel)
+        return True
+
+    def _handle_sigint(self, signum, frame):
+        # Interrupts cancel the coroutine waiting on the interpreter, instead of
+        # raising KeyboardInterrupt wherever the event loop happens to be
+        if not self._cancel_execution():
+            raise KeyboardInterrupt
+
+    def schedule_dispatch(self, *args):
+        # ipykernel<6 queues control messages behind the shell message which is being
+        # handled, so while a cell waits on the interpreter they're dispatched straight
+        # away instead (newer versions of ipykernel handle them on their own thread)
+        if self._running is not None and self.dispatch_control in args:
+            control_args = args[args.index(self.dispatch_control) + 1 :]
+            self.io_loop.add_callback(self._dispatch_control_now, *control_args)
+            return None
+        return super().schedule_dispatch(*args)
+
+    def _dispatch_control_now(self, *args):
+        # the executing cell's output must still be sent with the cell's parent header
+        parent_ident, parent_header = self._parent_ident, self._parent_header
+        try:
+            self.dispatch_control(*args)
+        finally:
+            self._parent_ident, self._parent_header = parent_ident, parent_header
+
+    async def interrupt_request(self, stream, ident, parent):
+        """Handle interrupt messages (sent by ipykernel>=6 frontends when the kernel's
+        interrupt mode is "message") by cancelling the running cell directly.
+        """
+        if self._cancel_execution():
+            self.session.send(
+                stream, "interrupt_reply", {"status": "ok"}, parent, ident=ident
+            )
+            return
+        handler = getattr(super(), "interrupt_request", None)
+        if handler is not None:
+            await handler(stream, ident, parent)
+
+    def _forward_output(self, text):
+        self._symbols.add_output(text)
+        self._send_stdout(text)
+
+    def _send_stdout(self, text):
+        logger.debug("output from run_command: ```%s```", text)
+        if not self.silent:
+            self.send_response(
+                self.iopub_socket, "stream", {"name": "stdout", "text": text}
+            )
 
-    # TODO def is_complete_request by using `wasm -d` which just runs validation
+    def do_is_complete(self, code):
+        return self._completeness.check(code)
 
-    # TODO def do_complete(self, code, cursor_pos):
-    # https://github.com/wasmerio/vscode-wasm/blob/master/syntaxes/wat.json
-    # https://code.visualstudio.com/api/language-extensions/language-configuration-guide
+    def do_complete(self, code, cursor_pos):
+        return self._symbols.complete(code, cursor_pos)
@@ -0,0 +1,54 @@
+"""Limits on the time and memory which a cell's interpreter may use, so that a runaway
+cell can't tie up the kernel (and its host) until someone interrupts it.
+"""
+import asyncio
+
+from .metrics import process_stats
+
+
+#: How often (in seconds) the interpreter's CPU time is checked
+CPU_CHECK_INTERVAL = 0.1
+
+
+class LimitExceeded(Exception):
+    """Raised when a cell goes over one of its limits"""
+
+
+def set_memory_limit(limit):
+    """Limit the address space of the calling process to `limit` bytes. This is
+    called in the interpreter's process before it starts, see `spawn_wasm`.
+    """
+    import resource
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+async def run_limited(awaitable, timeout=None, cpu_limit=None, pid=None):
+    """Await `awaitable`, cancelling it and raising :exc:`LimitExceeded` if it takes
+    more than `timeout` seconds, or if process `pid` uses more than `cpu_limit`
+    seconds of CPU time meanwhile (checked every CPU_CHECK_INTERVAL seconds).
+    """
+    task = asyncio.ensure_future(awaitable)
+    start = process_stats(pid) if cpu_limit and pid is not None else None
+    if not timeout and start is None:
+        return await task
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout if timeout else None
+    try:
+        while True:
+            wait = CPU_CHECK_INTERVAL if start is not None else None
+            if deadline is not None:
+                remaining = max(deadline - loop.time(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            done, _ = await asyncio.wait({task}, timeout=wait)
+            if done:
+                return task.result()
+            if deadline is not None and loop.time() >= deadline:
+                raise LimitExceeded("its time limit of %gs" % timeout)
+            if start is not None:
+                stats = process_stats(pid)
+                if stats is not None and stats["cpu"] - start["cpu"] > cpu_limit:
+                    raise LimitExceeded("its CPU time limit of %gs" % cpu_limit)
+    finally:
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,148 @@
+"""Parsing of kernel magics, ie. cells which start with `%name` (line magics, which take
+up the whole cell) or `%%name` (cell magics, which apply to the rest of the cell).
+"""
+import glob
+import os
+import re
+import shlex
+from typing import NamedTuple, Optional
+
+from .startup import escape_wasm_string
+from .syntax import split_forms
+
+
+magic_pat = re.compile(r"(%%?)([A-Za-z_]\w*)[ \t]*(.*)")
+
+# The files which each of the load magics accepts
+LOAD_EXTENSIONS = {
+    "load_wat": (".wat", ".wasm"),
+    "load_wast": (".wast",),
+}
+
+
+class MagicError(Exception):
+    """Raised when a magic can't be run, eg. because its arguments are invalid"""
+
+
+class Magic(NamedTuple):
+    name: str
+    args: str
+    #: The rest of the cell for cell magics, None for line magics
+    body: Optional[str] = None
+
+
+def parse_magic(code):
+    """Return the :class:`Magic` at the start of a cell, or None if the cell doesn't
+    start with one
+    """
+    first_line, _, rest = code.partition("\n")
+    m = magic_pat.fullmatch(first_line.rstrip())
+    if m is None:
+        return None
+    prefix, name, args = m.groups()
+    if prefix == "%%":
+        return Magic(name, args, rest)
+    if rest.strip():
+        raise MagicError("%%%s must be the only line in its cell" % name)
+    return Magic(name, args)
+
+
+def expand_paths(args, extensions):
+    """Expand the (shell quoted) paths and globs in a magic's arguments into absolute
+    paths of files with one of `extensions`
+    """
+    try:
+        patterns = shlex.split(args)
+    except ValueError as e:
+        raise MagicError(str(e))
+    if not patterns:
+        raise MagicError("no files were given")
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        matches = [path for path in matches if path.endswith(extensions)]
+        if not matches:
+            raise MagicError("no %s files match `%s`" % ("/".join(extensions), pattern))
+        for path in matches:
+            if not os.path.isfile(path):
+                raise MagicError("`%s` isn't a file" % path)
+            paths.append(os.path.abspath(path))
+    return paths
+
+
+def load_command(paths):
+    """A command which has the interpreter read each of the files itself"""
+    return "\n".join('(input "%s")' % escape_wasm_string(path) for path in paths)
+
+
+def rerun_affected_args(args):
+    """Parse the arguments of %rerun_affected: an optional `-n` (only list the affected
+    forms), and the module names (`$A`) and registered names (`a`) which changed, or
+    none to use the names defined by the last cell
+    """
+    try:
+        words = shlex.split(args)
+    except ValueError as e:
+        raise MagicError(str(e))
+    dry_run = False
+    names = set()
+    for word in words:
+        if word in ("-n", "--dry-run"):
+            dry_run = True
+        elif word.startswith("-"):
+            raise MagicError("usage: %rerun_affected [-n] [NAME ...]")
+        else:
+            names.add(word if word.startswith("$") else '"%s"' % word)
+    return names, dry_run
+
+
+def page_output_args(args):
+    """Parse the arguments of %page_output: an optional execution count (the cell whose
+    output is paged, by default the last cell whose output was saved), and an optional
+    line to start from (by default the first line)
+    """
+    try:
+        numbers = [int(arg) for arg in args.split()]
+    except ValueError:
+        raise MagicError("usage: %page_output [EXECUTION_COUNT [FIRST_LINE]]")
+    if len(numbers) > 2 or any(number < 1 for number in numbers):
+        raise MagicError("usage: %page_output [EXECUTION_COUNT [FIRST_LINE]]")
+    numbers += [None] * (2 - len(numbers))
+    return numbers[0], numbers[1] or 1
+
+
+def parallel_invoke_args(args, body):
+    """Parse the arguments of %%parallel_invoke: an optional `-j N` (how many workers
+    to use), an optional module name and the export to invoke, and the tuples of
+    arguments to invoke it with, one per line of the cell's body
+    """
+    usage = "usage: %%parallel_invoke [-j WORKERS] [$MODULE] EXPORT"
+    try:
+        words = shlex.split(args)
+    except ValueError as e:
+        raise MagicError(str(e))
+    workers = None
+    if words and words[0] in ("-j", "--jobs"):
+        try:
+            workers = int(words[1])
+        except (IndexError, ValueError):
+            raise MagicError(usage)
+        if workers < 1:
+            raise MagicError(usage)
+        words = words[2:]
+    module = None
+    if len(words) == 2 and words[0].startswith("$"):
+        module = words.pop(0)
+    if len(words) != 1:
+        raise MagicError(usage)
+    tuples = []
+    for number, line in enumerate(body.split("\n"), 1):
+        forms = split_forms(line)
+        if forms is None:
+            raise MagicError("line %d isn't a complete tuple of arguments" % number)
+        if forms:
+            tuples.append(" ".join(forms))
+    if not tuples:
+        raise MagicError("no tuples of arguments were given, one per line")
+    return module, words[0], workers, tuples
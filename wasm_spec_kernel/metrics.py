@@ -0,0 +1,248 @@
+"""Timing and resource metrics for the cells which the kernel executes.
+
+Each cell's time is broken down into spans for the stages it goes through, which are
+recorded by the kernel and (on its hot path) by WasmREPLWrapper:
+
+* `magic` and `syntax_check`: handling a cell before it's sent to the interpreter
+* `pty_write`: writing the cell to the interpreter's pty
+* `pty_wait`: waiting for the interpreter's output, which is mostly the time the
+  interpreter itself spends on the cell
+* `pty_read` and `prompt_match`: reading the interpreter's output and finding its
+  prompts in it
+* `error_scan`: scanning the output for the interpreter's errors
+* `publish`: sending the output to the frontend over iopub
+* `results`: parsing the output into structured results (WASM_KERNEL_RESULTS)
+
+The interpreter's memory use and CPU time are sampled from /proc (on Linux) before
+and after each cell.
+"""
+import os
+import tempfile
+import time
+
+
+#: The upper bounds of the cell duration histogram's buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Spans:
+    """The time spent in each stage of a cell"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+    def timed(self, stage, fn):
+        """Wrap `fn` so that the time spent in it is added to `stage`"""
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        return wrapper
+
+
+def process_stats(pid):
+    """The resident memory (in bytes) and CPU time (user and system, in seconds) of a
+    process, or None if they can't be read (e.g. on platforms without /proc)
+    """
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        with open("/proc/%d/stat" % pid) as f:
+            # the command name may contain spaces, so fields are counted from after it
+            fields = f.read().rpartition(")")[2].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return {"rss": rss, "cpu": cpu}
+
+
+class KernelStats:
+    """Totals over all of the kernel's cells, which are reported by %kernel_stats and
+    written in Prometheus' text format to `metrics_dir` (e.g. for node_exporter's
+    textfile collector) after every cell
+    """
+
+    def __init__(self, metrics_dir=None):
+        self.cells = 0
+        self.errors = 0
+        self.restarts = 0
+        self.stage_totals = {}
+        self.duration_total = 0.0
+        self.duration_buckets = [0] * len(DURATION_BUCKETS)
+        self.interpreter = None
+        #: The metrics of the last cell, see :meth:`add_cell`
+        self.last_cell = None
+        self._path = None
+        if metrics_dir:
+            self._path = os.path.join(
+                metrics_dir, "wasm_spec_kernel_%d.prom" % os.getpid()
+            )
+
+    def add_cell(self, duration, spans, status, before=None, after=None):
+        """Record a cell which took `duration` seconds, with the interpreter's
+        :func:`process_stats` from before and after it ran
+        """
+        self.cells += 1
+        if status != "ok":
+            self.errors += 1
+        for stage, seconds in spans.totals.items():
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+        self.duration_total += duration
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.duration_buckets[i] += 1
+        cell = {"duration": duration, "spans": dict(spans.totals)}
+        if after is not None:
+            self.interpreter = after
+            cell["interpreter"] = {"rss": after["rss"]}
+            if before is not None and after["cpu"] >= before["cpu"]:
+                cell["interpreter"]["cpu"] = after["cpu"] - before["cpu"]
+        self.last_cell = cell
+        self.write()
+
+    def summary(self):
+        """The totals as a JSON-able dict"""
+        summary = {
+            "cells": self.cells,
+            "errors": self.errors,
+            "restarts": self.restarts,
+            "duration": self.duration_total,
+            "stages": dict(self.stage_totals),
+            "kernel": process_stats(os.getpid()),
+            "interpreter": self.interpreter,
+        }
+        if self.last_cell is not None:
+            summary["last_cell"] = self.last_cell
+        return summary
+
+    def format_text(self):
+        """The totals as a table, for %kernel_stats"""
+        lines = [
+            "cells: %d (%d errors), interpreter restarts: %d"
+            % (self.cells, self.errors, self.restarts),
+            "time in cells: %.3fs" % self.duration_total,
+        ]
+        if self.stage_totals:
+            lines.append("")
+            lines.append("%-14s %10s %10s" % ("stage", "total (s)", "per cell"))
+            for stage, seconds in sorted(
+                self.stage_totals.items(), key=lambda item: -item[1]
+            ):
+                lines.append(
+                    "%-14s %10.4f %10.4f" % (stage, seconds, seconds / self.cells)
+                )
+        for name, stats in (
+            ("kernel", process_stats(os.getpid())),
+            ("interpreter", self.interpreter),
+        ):
+            if stats is not None:
+                lines.append(
+                    "%s: %.1f MB resident, %.2fs CPU"
+                    % (name, stats["rss"] / 2 ** 20, stats["cpu"])
+                )
+        return "\n".join(lines) + "\n"
+
+    def format_prometheus(self):
+        labels = 'pid="%d"' % os.getpid()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, extra_labels, value in samples:
+                lines.append(
+                    "%s%s{%s} %s"
+                    % (name, suffix, ",".join([labels] + extra_labels), repr(value))
+                )
+
+        metric(
+            "wasm_kernel_cells_total",
+            "counter",
+            "Cells executed by the kernel.",
+            [("", [], self.cells)],
+        )
+        metric(
+            "wasm_kernel_cell_errors_total",
+            "counter",
+            "Cells which didn't complete successfully.",
+            [("", [], self.errors)],
+        )
+        metric(
+            "wasm_kernel_interpreter_restarts_total",
+            "counter",
+            "Times the interpreter was replaced after a crash or an interrupt.",
+            [("", [], self.restarts)],
+        )
+        metric(
+            "wasm_kernel_stage_seconds_total",
+            "counter",
+            "Time spent in each stage of executing cells.",
+            [
+                ("", ['stage="%s"' % stage], seconds)
+                for stage, seconds in sorted(self.stage_totals.items())
+            ],
+        )
+        metric(
+            "wasm_kernel_cell_duration_seconds",
+            "histogram",
+            "How long cells took to execute.",
+            [
+                ("_bucket", ['le="%s"' % bound], count)
+                for bound, count in zip(DURATION_BUCKETS, self.duration_buckets)
+            ]
+            + [
+                ("_bucket", ['le="+Inf"'], self.cells),
+                ("_sum", [], self.duration_total),
+                ("_count", [], self.cells),
+            ],
+        )
+        for name, stats in (
+            ("kernel", process_stats(os.getpid())),
+            ("interpreter", self.interpreter),
+        ):
+            if stats is None:
+                continue
+            metric(
+                "wasm_kernel_%s_resident_memory_bytes" % name,
+                "gauge",
+                "Resident memory of the %s process." % name,
+                [("", [], stats["rss"])],
+            )
+            metric(
+                "wasm_kernel_%s_cpu_seconds" % name,
+                "gauge",
+                "CPU time used by the %s process." % name,
+                [("", [], stats["cpu"])],
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Write the metrics file, if there is one. It's replaced atomically, so that
+        it's never scraped while half written.
+        """
+        if self._path is None:
+            return
+        directory = os.path.dirname(self._path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.format_prometheus())
+            os.replace(tmp_path, self._path)
+        except OSError:
+            pass
+
+    def remove(self):
+        """Remove the metrics file, once the kernel shuts down"""
+        if self._path is not None:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
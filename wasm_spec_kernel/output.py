@@ -0,0 +1,191 @@
+"""Forwarding of the Wasm interpreter's output to the Jupyter frontend."""
+import os
+import tempfile
+import time
+
+from .wasm_replwrap import error_pat
+
+
+class CoalescedStream:
+    """Collects output as it arrives from the interpreter and forwards it in batches,
+    so that a cell which prints a lot doesn't flood the frontend with tiny messages.
+    Pending output is flushed once it reaches `max_size` characters, or once it's
+    been held for `max_delay` seconds.
+
+    The first interpreter error in the output is recorded in `error` (as a match of
+    `error_pat`). Output is scanned line by line, so errors are found even if they're
+    split across writes. Errors are only matched at the start of a line, so only the
+    first `max_line` characters of a line which is split across writes are kept.
+
+    :param send: Function which forwards a batch of output to the frontend.
+    :param spans: A :class:`~.metrics.Spans` which the time spent scanning for errors
+      is added to, if given.
+    """
+
+    max_line = 64 * 1024
+
+    def __init__(self, send, max_size=64 * 1024, max_delay=0.1, spans=None):
+        self._send = send
+        self._spans = spans
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+        self._partial_line = ""
+        self.error = None
+
+    def write(self, text):
+        if text:
+            if self._spans is None:
+                self._scan(text)
+            else:
+                start = time.perf_counter()
+                self._scan(text)
+                self._spans.add("error_scan", time.perf_counter() - start)
+            self._pending.append(text)
+            self._pending_size += len(text)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+        if self._pending_size >= self._max_size or (
+            self._pending_since is not None
+            and time.monotonic() - self._pending_since >= self._max_delay
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._send("".join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+
+    def close(self):
+        """Flush any pending output and finish scanning for errors"""
+        self.flush()
+        if self._partial_line and self.error is None:
+            self.error = error_pat.search(self._partial_line)
+        self._partial_line = ""
+
+    def _scan(self, text):
+        if self.error is not None:
+            return
+        lines = text.split("\n")
+        room = self.max_line - len(self._partial_line)
+        if room > 0:
+            self._partial_line += lines[0][:room]
+        if len(lines) == 1:
+            return
+        lines[0] = self._partial_line
+        self._partial_line = lines.pop()[: self.max_line]
+        for line in lines:
+            self.error = error_pat.search(line.rstrip("\r"))
+            if self.error is not None:
+                self._partial_line = ""
+                break
+
+
+class OutputBudget:
+    """Forwards a cell's output to the frontend until `limit` characters have been
+    sent. Beyond that, output is written to a file in `spill_dir` instead (along with
+    what was already sent, so that the file holds the cell's full output), and only its
+    last `tail_size` characters are kept in memory, to be sent when the cell finishes.
+    The kernel's memory use is therefore bounded no matter how much a cell prints.
+
+    :param send: Function which forwards output to the frontend.
+    """
+
+    def __init__(self, send, limit, spill_dir, tail_size=None):
+        self._send = send
+        self._limit = limit
+        self._tail_size = limit // 4 if tail_size is None else tail_size
+        self._spill_dir = spill_dir
+        self._head = []
+        self._head_size = 0
+        self._head_lines = 0
+        self._head_ends_line = True
+        self._tail = ""
+        self._file = None
+        #: The file holding the full output, once it went over the limit
+        self.path = None
+        self.size = 0
+        self.lines = 0
+
+    def __call__(self, text):
+        self.size += len(text)
+        self.lines += text.count("\n")
+        if self._file is None:
+            head = text[: self._limit - self._head_size]
+            if head:
+                self._send(head)
+                self._head.append(head)
+                self._head_size += len(head)
+                self._head_lines += head.count("\n")
+                self._head_ends_line = head.endswith("\n")
+            if len(head) == len(text):
+                return
+            self._spill()
+            text = text[len(head) :]
+        self._file.write(text)
+        self._tail = (self._tail + text)[-self._tail_size :]
+
+    def _spill(self):
+        os.makedirs(self._spill_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(
+            dir=self._spill_dir, prefix="output_", suffix=".txt"
+        )
+        self._file = os.fdopen(fd, "w", encoding="utf-8", errors="replace")
+        self._file.writelines(self._head)
+        self._head = []
+
+    def close(self, hint=""):
+        """Finish the cell's output. If it went over the limit, a note of how much was
+        left out (followed by `hint`) and the output's last lines are sent. Returns the
+        path of the file holding the full output, or None.
+        """
+        self._head = []
+        if self._file is None:
+            return None
+        self._file.close()
+        self._file = None
+        tail, self._tail = self._tail, ""
+        # start the tail on a line boundary, unless that would leave nothing
+        if self.size - self._head_size > len(tail):
+            line_start = tail.find("\n") + 1
+            if 0 < line_start < len(tail):
+                tail = tail[line_start:]
+        omitted = self.size - self._head_size - len(tail)
+        if omitted > 0:
+            omitted_lines = self.lines - self._head_lines - tail.count("\n")
+            self._send(
+                "%s[... %d characters (%d lines) omitted, the full output was saved to "
+                "%s%s ...]\n"
+                % (
+                    "" if self._head_ends_line else "\n",
+                    omitted,
+                    omitted_lines,
+                    self.path,
+                    hint,
+                )
+            )
+        if tail:
+            self._send(tail)
+        return self.path
+
+
+def read_page(path, first_line, max_size):
+    """Read the lines of a saved output starting at `first_line` (counting from 1),
+    up to `max_size` characters. Returns the text and the number of the next line, or
+    None if the page reaches the end of the output.
+    """
+    lines = []
+    size = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for number, line in enumerate(f, 1):
+            if number < first_line:
+                continue
+            if lines and size + len(line) > max_size:
+                return "".join(lines), number
+            lines.append(line)
+            size += len(line)
+    return "".join(lines), None
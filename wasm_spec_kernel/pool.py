@@ -0,0 +1,624 @@
+"""A daemon which manages Wasm interpreters for many kernels over a Unix socket, and the
+client which kernels use to talk to it.
+
+Run the daemon with `python -m wasm_spec_kernel.pool --socket PATH`, and point kernels
+at it with WASM_KERNEL_POOL_SOCKET=PATH. Each kernel interpreter is a session in the
+daemon. Idle sessions have their interpreter reaped (their journal of successfully
+executed commands is saved to disk, and replayed into a new interpreter when the
+session is next used), the number of interpreters and their total memory use are
+capped, and sessions are handed interpreters which were started ahead of time.
+
+The protocol is one JSON object per line. Each request is sent on a new connection,
+and is answered by any number of `{"output": ...}` messages (for `run` requests)
+followed by a final message with `"ok": true`, `"eof": true` (if the interpreter
+exited) or an `"error"`.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+
+import pexpect  # type: ignore
+
+from .startup import find_interpreter, load_prelude, spawn_wasm
+from .wasm_replwrap import error_pat
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+# How long the journals of sessions which were never used again are kept
+STATE_TTL = 7 * 24 * 60 * 60
+# The longest line (ie. request or message) which is read from a connection
+LINE_LIMIT = 2 ** 24
+
+
+class PoolError(Exception):
+    """Raised by the client when the daemon can't fulfil a request"""
+
+
+class _Session:
+    def __init__(self, session_id, prelude=(), journal=()):
+        self.id = session_id
+        self.prelude = list(prelude)
+        self.journal = list(journal)
+        self.wasmwrapper = None
+        self.busy = False
+        self.last_used = time.monotonic()
+
+
+def _rss(pid):
+    """The resident memory of a process in bytes, or 0 if it can't be read"""
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _terminate(wasmwrapper):
+    try:
+        wasmwrapper.child.terminate(force=True)
+    except Exception:
+        logger.debug("error while terminating a wasm process", exc_info=True)
+
+
+class PoolDaemon:
+    """Manages interpreters for sessions, see the module's documentation.
+
+    :param interpreter_path: The interpreter which is spawned.
+    :param state_dir: Where the journals of reaped sessions are saved.
+    :param max_processes: The most interpreters which run at once (including the
+      pre-warmed ones).
+    :param max_memory: The most memory (in bytes) which the interpreters may use in
+      total before idle sessions are reaped, or None for no limit.
+    :param idle_timeout: How long (in seconds) a session may be idle before its
+      interpreter is reaped.
+    :param warm: How many pre-warmed interpreters to keep ready.
+    """
+
+    def __init__(
+        self,
+        interpreter_path,
+        state_dir,
+        max_processes=64,
+        max_memory=None,
+        idle_timeout=600,
+        warm=2,
+    ):
+        self.interpreter_path = interpreter_path
+        self.state_dir = state_dir
+        self.max_processes = max_processes
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.warm = warm
+        self._sessions = {}
+        self._warm = collections.deque()
+        self._warming = 0
+        self._reaper = None
+        os.makedirs(state_dir, exist_ok=True)
+
+    @property
+    def process_count(self):
+        active = sum(1 for s in self._sessions.values() if s.wasmwrapper is not None)
+        return active + len(self._warm) + self._warming
+
+    async def start(self, socket_path):
+        """Start listening on `socket_path`, returning the server. The daemon serves
+        requests while the event loop runs, until :meth:`stop` is called.
+        """
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # only the daemon's user may connect
+        old_umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(
+                self._handle, path=socket_path, limit=LINE_LIMIT
+            )
+        finally:
+            os.umask(old_umask)
+        logger.info("interpreter pool listening on %s", socket_path)
+        self._reaper = asyncio.ensure_future(self._reap_periodically())
+        self._fill_warm()
+        return server
+
+    async def stop(self, server):
+        """Stop serving, and save and terminate the sessions' interpreters"""
+        server.close()
+        await server.wait_closed()
+        self._reaper.cancel()
+        self.close()
+
+    def close(self):
+        for session in self._sessions.values():
+            if session.wasmwrapper is not None:
+                self._save(session)
+                _terminate(session.wasmwrapper)
+                session.wasmwrapper = None
+        while self._warm:
+            _terminate(self._warm.popleft())
+
+    async def _handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            op = request.get("op")
+            handler = getattr(self, "_op_" + str(op), None)
+            if handler is None:
+                raise PoolError("unknown request `%s`" % op)
+            reply = await handler(request, writer, reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        except ValueError as e:
+            reply = {"error": "ValueError", "message": str(e)}
+        except Exception as e:
+            logger.debug("error while handling a request", exc_info=True)
+            reply = {"error": type(e).__name__, "message": str(e)}
+        try:
+            await _send(writer, reply)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _op_attach(self, request, writer, reader):
+        session = self._sessions.get(request["session"])
+        if session is None:
+            session = self._load(request["session"]) or _Session(
+                request["session"], request.get("prelude", ())
+            )
+            self._sessions[session.id] = session
+        await self._activate(session)
+        return {"ok": True, "journal": len(session.journal)}
+
+    async def _op_run(self, request, writer, reader):
+        session = self._session(request["session"])
+        if session.busy:
+            raise PoolError("the session is already running a command")
+        session.busy = True
+        try:
+            await self._activate(session)
+            error_seen = False
+
+            def on_output(text):
+                nonlocal error_seen
+                if text:
+                    error_seen = error_seen or error_pat.search(text) is not None
+                    writer.write(json.dumps({"output": text}).encode("utf-8") + b"\n")
+
+            run = asyncio.ensure_future(
+                session.wasmwrapper.run_command_async(
+                    request["command"],
+                    timeout=request.get("timeout"),
+                    framed=request.get("framed", False),
+                    on_output=on_output,
+                )
+            )
+            # the client disconnects to cancel the command
+            disconnected = asyncio.ensure_future(reader.read())
+            done, _ = await asyncio.wait(
+                [run, disconnected], return_when=asyncio.FIRST_COMPLETED
+            )
+            if run not in done:
+                run.cancel()
+                logger.debug("session %s cancelled its command", session.id)
+                self._drop_interpreter(session)
+                raise ConnectionError("the client disconnected")
+            disconnected.cancel()
+            try:
+                run.result()
+            except pexpect.EOF:
+                before = session.wasmwrapper.before
+                self._drop_interpreter(session)
+                return {"eof": True, "before": before}
+            if not error_seen:
+                session.journal.append(request["command"])
+            return {"ok": True}
+        finally:
+            session.busy = False
+            session.last_used = time.monotonic()
+
+    async def _op_release(self, request, writer, reader):
+        path = self._state_path(request["session"])
+        session = self._sessions.pop(request["session"], None)
+        if session is not None and session.wasmwrapper is not None:
+            _terminate(session.wasmwrapper)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._fill_warm()
+        return {"ok": True}
+
+    async def _op_pid(self, request, writer, reader):
+        session = self._session(request["session"])
+        # a reaped session is restored, since its interpreter is about to be used
+        await self._activate(session)
+        return {"ok": True, "pid": session.wasmwrapper.child.pid}
+
+    async def _op_stats(self, request, writer, reader):
+        return {
+            "ok": True,
+            "sessions": len(self._sessions),
+            "active": sum(
+                1 for s in self._sessions.values() if s.wasmwrapper is not None
+            ),
+            "warm": len(self._warm),
+            "processes": self.process_count,
+            "memory": self._memory(),
+        }
+
+    def _session(self, session_id):
+        session = self._sessions.get(session_id) or self._load(session_id)
+        if session is None:
+            raise PoolError("unknown session `%s`" % session_id)
+        self._sessions[session.id] = session
+        return session
+
+    async def _activate(self, session):
+        """Give a session an interpreter (if it doesn't have one), and restore its
+        journal into it
+        """
+        session.last_used = time.monotonic()
+        if session.wasmwrapper is not None:
+            return
+        loop = asyncio.get_event_loop()
+        if self._warm:
+            wasmwrapper = self._warm.popleft()
+        else:
+            self._make_room()
+            self._warming += 1
+            try:
+                wasmwrapper = await loop.run_in_executor(
+                    None, spawn_wasm, self.interpreter_path
+                )
+            finally:
+                self._warming -= 1
+        if session.prelude:
+            await loop.run_in_executor(None, load_prelude, wasmwrapper, session.prelude)
+        if session.journal:
+            logger.debug(
+                "restoring %d commands into session %s",
+                len(session.journal),
+                session.id,
+            )
+            await wasmwrapper.run_command_async(
+                "\n".join(session.journal), timeout=None, framed=True
+            )
+        session.wasmwrapper = wasmwrapper
+        self._fill_warm()
+
+    def _drop_interpreter(self, session):
+        if session.wasmwrapper is not None:
+            _terminate(session.wasmwrapper)
+            session.wasmwrapper = None
+
+    def _make_room(self):
+        """Reap idle sessions until another interpreter can be started"""
+        while self.process_count >= self.max_processes:
+            if self._warm:
+                _terminate(self._warm.pop())
+            elif not self._reap_oldest():
+                raise PoolError(
+                    "the interpreter pool is full (%d processes)" % self.max_processes
+                )
+
+    def _reap_oldest(self):
+        idle = [
+            s
+            for s in self._sessions.values()
+            if s.wasmwrapper is not None and not s.busy
+        ]
+        if not idle:
+            return False
+        self._reap(min(idle, key=lambda s: s.last_used))
+        return True
+
+    def _reap(self, session):
+        logger.debug("reaping idle session %s", session.id)
+        self._save(session)
+        self._drop_interpreter(session)
+        # the session is restored from its saved journal when it's next used
+        del self._sessions[session.id]
+
+    def _memory(self):
+        wasmwrappers = [s.wasmwrapper for s in self._sessions.values()]
+        wasmwrappers += self._warm
+        return sum(_rss(w.child.pid) for w in wasmwrappers if w is not None)
+
+    async def _reap_periodically(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 2, 5))
+            self.reap()
+
+    def reap(self):
+        """Reap sessions which have been idle for too long, and then the least recently
+        used sessions while the interpreters use too much memory
+        """
+        now = time.monotonic()
+        for session in list(self._sessions.values()):
+            if (
+                session.wasmwrapper is not None
+                and not session.busy
+                and now - session.last_used >= self.idle_timeout
+            ):
+                self._reap(session)
+        if self.max_memory is not None:
+            while self._memory() > self.max_memory:
+                if self._warm:
+                    _terminate(self._warm.pop())
+                elif not self._reap_oldest():
+                    logger.warning("interpreters are over the memory limit")
+                    break
+        for entry in os.scandir(self.state_dir):
+            try:
+                if time.time() - entry.stat().st_mtime > STATE_TTL:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _fill_warm(self):
+        missing = min(
+            self.warm - len(self._warm) - self._warming,
+            self.max_processes - self.process_count,
+        )
+        for _ in range(max(missing, 0)):
+            self._warming += 1
+            asyncio.ensure_future(self._add_warm())
+
+    async def _add_warm(self):
+        try:
+            wasmwrapper = await asyncio.get_event_loop().run_in_executor(
+                None, spawn_wasm, self.interpreter_path
+            )
+        except Exception:
+            logger.exception("unable to start a pre-warmed wasm process")
+            return
+        finally:
+            self._warming -= 1
+        self._warm.append(wasmwrapper)
+
+    def _state_path(self, session_id):
+        # session ids come from clients, and mustn't reach outside of the state dir
+        if not (
+            isinstance(session_id, str)
+            and session_id
+            and all(c.isalnum() or c in "-_" for c in session_id)
+        ):
+            raise PoolError("invalid session id")
+        return os.path.join(self.state_dir, "%s.json" % session_id)
+
+    def _save(self, session):
+        path = self._state_path(session.id)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"prelude": session.prelude, "journal": session.journal}, f)
+        os.replace(path + ".tmp", path)
+
+    def _load(self, session_id):
+        path = self._state_path(session_id)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return _Session(session_id, state["prelude"], state["journal"])
+
+
+async def _send(writer, message):
+    writer.write(json.dumps(message).encode("utf-8") + b"\n")
+    await writer.drain()
+
+
+class _PooledChild:
+    """Stands in for the `pexpect.spawn` of a pooled interpreter, which the kernel only
+    checks, terminates, and looks up the pid of (for its CPU limit and metrics)
+    """
+
+    def __init__(self, repl):
+        self._repl = repl
+
+    @property
+    def pid(self):
+        """The pid of the session's interpreter in the daemon (which shares the
+        kernel's host, since they talk over a Unix socket), or None
+        """
+        if self._repl.released:
+            return None
+        try:
+            return _request(
+                self._repl.socket_path,
+                {"op": "pid", "session": self._repl.session_id},
+                timeout=None,
+            )["pid"]
+        except (OSError, PoolError, ValueError):
+            logger.debug("unable to look up a pooled interpreter's pid", exc_info=True)
+            return None
+
+    def isalive(self):
+        return not self._repl.released
+
+    def terminate(self, force=False):
+        self._repl.release()
+        return True
+
+
+class PooledREPL:
+    """A client for a session in the pool daemon, with the same interface as
+    :class:`WasmREPLWrapper`.
+
+    :param socket_path: The daemon's socket.
+    :param prelude: Files which are loaded into the session's interpreter.
+    """
+
+    def __init__(self, socket_path, prelude=(), session_id=None):
+        self.socket_path = socket_path
+        self.session_id = session_id or uuid.uuid4().hex
+        self.child = _PooledChild(self)
+        self.released = False
+        #: The output which preceded the interpreter exiting
+        self.before = ""
+        # attaching may restore a saved journal, which can take a while
+        self._request(
+            {"op": "attach", "session": self.session_id, "prelude": list(prelude)},
+            timeout=None,
+        )
+
+    def run_command(self, command, timeout=-1, framed=False, on_output=None):
+        """See :meth:`WasmREPLWrapper.run_command`"""
+        parts = []
+        self._request(
+            self._run_request(command, timeout, framed),
+            timeout,
+            on_output=on_output or parts.append,
+        )
+        return None if on_output is not None else "".join(parts)
+
+    async def run_command_async(
+        self, command, timeout=-1, framed=False, on_output=None
+    ):
+        """See :meth:`WasmREPLWrapper.run_command_async`. Cancelling the coroutine
+        disconnects from the daemon, which terminates the session's interpreter.
+        """
+        parts = []
+        send = on_output or parts.append
+        reader, writer = await asyncio.open_unix_connection(
+            self.socket_path, limit=LINE_LIMIT
+        )
+        try:
+            await _send(writer, self._run_request(command, timeout, framed))
+            while True:
+                message = self._check(await reader.readline())
+                if "output" not in message:
+                    break
+                send(message["output"])
+        finally:
+            writer.close()
+        return None if on_output is not None else "".join(parts)
+
+    def release(self):
+        """Give up the session, terminating its interpreter"""
+        if self.released:
+            return
+        self.released = True
+        try:
+            self._request({"op": "release", "session": self.session_id})
+        except (OSError, PoolError):
+            logger.debug("unable to release pooled session", exc_info=True)
+
+    def _run_request(self, command, timeout, framed):
+        return {
+            "op": "run",
+            "session": self.session_id,
+            "command": command,
+            "framed": framed,
+            "timeout": DEFAULT_TIMEOUT if timeout == -1 else timeout,
+        }
+
+    def _request(self, request, timeout=-1, on_output=None):
+        """Send a request, pass any output to `on_output`, and return the final reply"""
+        return _request(self.socket_path, request, timeout, on_output, self._check)
+
+    def _check(self, line):
+        """Parse a message, raising the error which it reports, if any"""
+        message = _parse_message(line)
+        if message.get("eof"):
+            self.before = message["before"]
+            raise pexpect.EOF("The Wasm REPL exited")
+        return message
+
+
+def _parse_message(line):
+    if not line:
+        raise PoolError("the interpreter pool closed the connection")
+    message = json.loads(line)
+    if "error" in message:
+        if message["error"] == "ValueError":
+            raise ValueError(message["message"])
+        raise PoolError(message["message"])
+    return message
+
+
+def _request(socket_path, request, timeout=-1, on_output=None, parse=_parse_message):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if timeout == -1:
+            timeout = DEFAULT_TIMEOUT
+        # the daemon enforces the timeout itself, this only guards against it hanging
+        sock.settimeout(None if timeout is None else timeout + 5)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            while True:
+                message = parse(f.readline(LINE_LIMIT))
+                if "output" not in message:
+                    return message
+                if on_output is not None:
+                    on_output(message["output"])
+    finally:
+        sock.close()
+
+
+def pool_stats(socket_path):
+    """The daemon's counts of sessions and interpreters, and the interpreters' memory"""
+    return _request(socket_path, {"op": "stats"})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Manage Wasm interpreters for many kernels"
+    )
+    parser.add_argument("--socket", required=True, help="the Unix socket to serve on")
+    parser.add_argument(
+        "--interpreter",
+        help="the interpreter to run (by default, found like the kernel finds it)",
+    )
+    parser.add_argument(
+        "--state-dir",
+        help="where the journals of idle sessions are saved",
+    )
+    parser.add_argument("--max-processes", type=int, default=64)
+    parser.add_argument(
+        "--max-memory", type=int, help="memory limit for all interpreters, in MB"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=600,
+        help="seconds before an idle session's interpreter is reaped",
+    )
+    parser.add_argument(
+        "--warm", type=int, default=2, help="how many interpreters to start ahead"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    daemon = PoolDaemon(
+        args.interpreter or find_interpreter(),
+        args.state_dir or args.socket + ".state",
+        max_processes=args.max_processes,
+        max_memory=args.max_memory * 2 ** 20 if args.max_memory else None,
+        idle_timeout=args.idle_timeout,
+        warm=args.warm,
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(daemon.start(args.socket))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(daemon.stop(server))
+        loop.close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Probing of a Wasm interpreter binary's version and supported proposals.
+
+Probing requires spawning the interpreter several times, so results are cached on disk
+(keyed by the binary's path, size and modification time) and shared between kernels.
+The install script probes the interpreter too, and passes its result on to kernels in
+WASM_KERNEL_PROBE, so that they don't have to probe it even if their cache is empty.
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+
+from .defs import ENV_CACHE_DIR, ENV_PROBE, KERNEL_IMPLEMENTATION_NAME
+
+
+logger = logging.getLogger(__name__)
+
+version_pat = re.compile(r"wasm (\d+(\.\d+)+)")
+
+PROBE_TIMEOUT = 10
+PROBE_CACHE_FILE = "probe.json"
+
+# A small script which only parses if the interpreter supports each proposal
+PROPOSAL_PROBES = {
+    "multi-value": "(module (func (result i32 i32) (i32.const 0) (i32.const 0)))",
+    "sign-extension-ops": "(module (func (result i32) (i32.extend8_s (i32.const 0))))",
+    "nontrapping-float-to-int-conversions": (
+        "(module (func (result i32) (i32.trunc_sat_f32_s (f32.const 0))))"
+    ),
+    "bulk-memory-operations": (
+        "(module (memory 1)"
+        " (func (memory.fill (i32.const 0) (i32.const 0) (i32.const 0))))"
+    ),
+    "reference-types": "(module (table 1 externref))",
+    "simd": "(module (func (result v128) (v128.const i32x4 0 0 0 0)))",
+    "tail-call": "(module (func (return_call 0)))",
+}
+
+
+def cache_dir():
+    """The directory which the kernel's on-disk caches are stored in"""
+    path = os.environ.get(ENV_CACHE_DIR)
+    if path is None:
+        path = os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            KERNEL_IMPLEMENTATION_NAME,
+        )
+    return path
+
+
+def interpreter_key(interpreter_path):
+    """Identifies a build of the interpreter, by its real path, size and mtime"""
+    interpreter_path = os.path.realpath(interpreter_path)
+    stat = os.stat(interpreter_path)
+    return "%s:%d:%d" % (interpreter_path, stat.st_size, stat.st_mtime_ns)
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(path, cache):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, since other kernels may be reading the
+        # cache at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.debug("unable to write the probe cache to %s", path, exc_info=True)
+
+
+def _supports(interpreter_path, script):
+    try:
+        result = subprocess.run(
+            [interpreter_path, "-e", script],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=PROBE_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+def run_probe(interpreter_path, on_banner=None):
+    """Spawn the interpreter to determine its banner, version, and which proposals
+    it supports. Since probing the proposals takes a while, `on_banner` is called with
+    the banner and version (as a result without "proposals") before they're probed.
+    """
+    banner = subprocess.check_output(
+        [interpreter_path, "-v", "-e", ""],
+        stdin=subprocess.DEVNULL,
+        timeout=PROBE_TIMEOUT,
+    ).decode("utf-8")
+    m = version_pat.search(banner)
+    result = {"banner": banner, "version": m.group(1) if m else None}
+    if on_banner is not None:
+        on_banner(dict(result))
+    result["proposals"] = sorted(
+        name
+        for name, script in PROPOSAL_PROBES.items()
+        if _supports(interpreter_path, script)
+    )
+    return result
+
+
+def install_seed(interpreter_path, result):
+    """The value of WASM_KERNEL_PROBE for a probe of the interpreter"""
+    return json.dumps(dict(result, key=interpreter_key(interpreter_path)))
+
+
+def _seed(key):
+    """The probe from WASM_KERNEL_PROBE, if it's for the build of the interpreter
+    identified by `key`
+    """
+    try:
+        seed = json.loads(os.environ.get(ENV_PROBE) or "null")
+    except ValueError:
+        return None
+    if not isinstance(seed, dict) or seed.pop("key", None) != key:
+        return None
+    return seed
+
+
+def probe_interpreter(interpreter_path, use_cache=True, on_banner=None):
+    """Retrieve the results of :func:`run_probe` for an interpreter, from the on-disk
+    cache if the binary hasn't changed since it was last probed (or from
+    WASM_KERNEL_PROBE, if it was probed when the kernel was installed)
+    """
+    if not use_cache:
+        return run_probe(interpreter_path, on_banner)
+    key = interpreter_key(interpreter_path)
+    path = os.path.join(cache_dir(), PROBE_CACHE_FILE)
+    cache = _read_cache(path)
+    if key in cache:
+        logger.debug("using cached probe for %s", key)
+        return cache[key]
+    result = _seed(key)
+    if result is not None:
+        logger.debug("using the install-time probe for %s", key)
+    else:
+        logger.debug("probing %s", key)
+        result = run_probe(interpreter_path, on_banner)
+    # drop stale entries for old builds at the same path
+    prefix = key.rsplit(":", 2)[0] + ":"
+    cache = {k: v for k, v in _read_cache(path).items() if not k.startswith(prefix)}
+    cache[key] = result
+    _write_cache(path, cache)
+    return result
@@ -0,0 +1,117 @@
+"""A cache of cells' results, so that re-running a notebook which hasn't changed (e.g.
+through nbconvert in CI) doesn't have to run it through the interpreter again.
+
+A cell's result depends on the interpreter, on every cell executed before it in the
+session, and on its own code. The session's history is summarized by a rolling hash,
+which starts from the interpreter's identity and the kernel's configuration, and is
+advanced by the code of each cell. Results are stored on disk as JSON files, which
+are shared by all kernels, and the least recently used ones are evicted once the
+cache grows beyond its size limit.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from .probe import interpreter_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def _sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Stores what executing a cell returned and the messages it sent, keyed by the
+    session's history and the cell's code.
+
+    :param directory: Where the results are stored.
+    :param max_size: How many bytes of results are kept.
+    """
+
+    def __init__(self, directory, max_size):
+        self._directory = directory
+        self._max_size = max_size
+
+    @staticmethod
+    def initial_history(interpreter_path, prelude=(), config=()):
+        """The history of a new session, given the interpreter, the files loaded into
+        it, and any of the kernel's options which affect cells' results
+        """
+        parts = [interpreter_key(interpreter_path)]
+        for path in prelude:
+            try:
+                with open(path, errors="replace") as f:
+                    parts.append(f.read())
+            except OSError:
+                parts.append("missing:" + path)
+        parts.extend(str(value) for value in config)
+        return _sha256(*parts)
+
+    @staticmethod
+    def advance(history, code):
+        """The history after a cell was executed"""
+        return _sha256(history, code)
+
+    @staticmethod
+    def key(history, code):
+        return _sha256("result", history, code)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def get(self, key):
+        """Return a cell's stored result, or None"""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            # the file's modification time orders evictions
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """Store a cell's result, evicting the least recently used results if the
+        cache has grown too large
+        """
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._path(key))
+        except (OSError, TypeError, ValueError):
+            logger.debug("unable to store a cell's result", exc_info=True)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self._directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+        except OSError:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,179 @@
+"""Parsing of the Wasm interpreter's output into structured results, which the kernel
+can send as an `application/json` display alongside the text output.
+"""
+import re
+
+from .syntax import split_forms
+from .wasm_replwrap import error_pat
+
+
+MAX_RESULTS = 1000
+
+# `module $Name :` (or `module :` for anonymous modules)
+module_pat = re.compile(r"module(?: (\$\S+))? :$")
+# `  export func "name" : [] -> [i32]` or `  import func "module" "name" : ...`
+extern_pat = re.compile(
+    r'  (export|import) (\w+) "((?:[^"\\]|\\.)*)"(?: "((?:[^"\\]|\\.)*)")? : (.*)$'
+)
+func_type_pat = re.compile(r"\[(.*)\] -> \[(.*)\]$")
+# `4 : i32`, or `[1 2] : [i32 i64]` for multiple values
+values_pat = re.compile(r"(.+) : (\[[^\]]*\]|[a-z][a-z0-9]*)$")
+# the lines before an assertion failure, e.g. `Result: 4 : i32`
+assertion_value_pat = re.compile(r"(Result|Expect): (.*)$")
+assertion_form_pat = re.compile(r"\(\s*assert_")
+
+
+def _split_list(text):
+    if text.startswith("[") and text.endswith("]"):
+        return text[1:-1].split()
+    return None
+
+
+def parse_values(values, types):
+    """Split a line of values and their types into a list of typed values. Values are
+    kept as the interpreter prints them, since i64s and NaN payloads don't survive a
+    round trip through JSON numbers.
+    """
+    type_list = _split_list(types)
+    if type_list is None:
+        return [{"type": types, "value": values}]
+    value_list = _split_list(values)
+    if value_list is None or len(value_list) != len(type_list):
+        # e.g. v128 values, which contain spaces themselves
+        return [{"type": types, "value": values}]
+    return [{"type": t, "value": v} for t, v in zip(type_list, value_list)]
+
+
+def assertion_count(code):
+    """The number of assertion commands in a cell"""
+    forms = split_forms(code) or []
+    return sum(1 for form in forms if assertion_form_pat.match(form))
+
+
+class ResultParser:
+    """Parses the interpreter's output line by line (in a single pass, as it arrives)
+    into a list of results:
+
+    * `{"kind": "module", "name": ..., "exports": [...], "imports": [...]}`, where
+      each export or import has a `kind`, `name` (and `module` for imports) and
+      `type`, plus `params` and `results` for functions
+    * `{"kind": "values", "values": [{"type": ..., "value": ...}, ...]}`
+    * `{"kind": "error", "location": ..., "type": ..., "message": ...}`, with the
+      `result` and `expect` values of failed assertions
+    * `{"kind": "output", "text": ...}` for any other line
+
+    At most MAX_RESULTS results are kept, after which `truncated` is set. Only the
+    first `max_line` characters of a line which is split across writes are kept.
+    """
+
+    max_line = 64 * 1024
+
+    def __init__(self):
+        self.results = []
+        self.truncated = False
+        #: How many results of each kind were parsed (including any beyond the limit)
+        self.counts = {"module": 0, "values": 0, "error": 0, "output": 0}
+        self.failed_assertions = 0
+        self._partial_line = ""
+        self._module = None
+        self._assertion_values = {}
+
+    def feed(self, text):
+        lines = text.split("\n")
+        room = self.max_line - len(self._partial_line)
+        if room > 0:
+            self._partial_line += lines[0][:room]
+        if len(lines) == 1:
+            return
+        lines[0] = self._partial_line
+        self._partial_line = lines.pop()[: self.max_line]
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        if self._partial_line:
+            self._parse_line(self._partial_line)
+            self._partial_line = ""
+
+    def _add(self, result):
+        self.counts[result["kind"]] += 1
+        if len(self.results) < MAX_RESULTS:
+            self.results.append(result)
+        else:
+            self.truncated = True
+
+    def _parse_line(self, line):
+        line = line.rstrip("\r")
+        if not line:
+            return
+        if self._module is not None:
+            m = extern_pat.match(line)
+            if m is not None:
+                direction, kind, name, second_name, extern_type = m.groups()
+                extern = {"kind": kind, "name": name, "type": extern_type}
+                if direction == "import":
+                    extern["module"], extern["name"] = name, second_name
+                func_type = func_type_pat.match(extern_type)
+                if kind == "func" and func_type is not None:
+                    extern["params"] = func_type.group(1).split()
+                    extern["results"] = func_type.group(2).split()
+                self._module[direction + "s"].append(extern)
+                return
+            self._module = None
+        m = module_pat.match(line)
+        if m is not None:
+            self._module = {
+                "kind": "module",
+                "name": m.group(1),
+                "exports": [],
+                "imports": [],
+            }
+            self._add(self._module)
+            return
+        m = error_pat.match(line)
+        if m is not None:
+            location, error_type, message = m.groups()
+            error = {
+                "kind": "error",
+                "location": location,
+                "type": error_type,
+                "message": message,
+            }
+            error.update(self._assertion_values)
+            self._assertion_values = {}
+            if error_type == "assertion failure":
+                self.failed_assertions += 1
+            self._add(error)
+            return
+        m = assertion_value_pat.match(line)
+        if m is not None:
+            values = values_pat.match(m.group(2))
+            self._assertion_values[m.group(1).lower()] = (
+                parse_values(*values.groups()) if values else m.group(2)
+            )
+            return
+        m = values_pat.match(line)
+        if m is not None:
+            self._add({"kind": "values", "values": parse_values(*m.groups())})
+            return
+        self._add({"kind": "output", "text": line})
+
+    def summary(self, assertions=0):
+        """The content of the display which is sent for a cell's results"""
+        content = {
+            "results": self.results,
+            "errors": self.counts["error"],
+            "assertions": {"total": assertions, "failed": self.failed_assertions},
+        }
+        if self.truncated:
+            content["truncated"] = True
+        text = (
+            "modules: %(module)d, values: %(values)d, errors: %(error)d" % self.counts
+        )
+        return {
+            "data": {
+                "application/json": content,
+                "text/plain": "[%s]" % text,
+            },
+            "metadata": {},
+        }
@@ -0,0 +1,403 @@
+"""Runs notebooks and .wast scripts without Jupyter, for checking them in CI.
+
+    python -m wasm_spec_kernel.run notebooks/*.ipynb tests/*.wast --junit report.xml
+
+Files are run in parallel by a pool of worker processes (`--jobs`, one per core by
+default), and each file gets an interpreter of its own, which is driven directly
+through a :class:`WasmREPLWrapper`. A notebook's code cells are run in order, like the
+kernel would run them (including %load_wat and %load_wast), and their outputs are
+written back into the notebook (or into a copy in `--output-dir`). A script is split
+into its top-level forms, which are run one at a time so that each one is reported
+separately.
+
+Errors are found in the output with the kernel's `error_pat`, and are summarized as
+JUnit XML (`--junit`) and JSON (`--json`), with each file as a test suite and each
+cell or form as a test case. The exit status is 1 if any cell or form failed.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import pexpect  # type: ignore
+
+from .magics import LOAD_EXTENSIONS, MagicError, expand_paths, load_command, parse_magic
+from .startup import find_interpreter, memory_limit, prelude_paths, spawn_wasm
+from .syntax import CompletenessChecker, split_forms
+from .wasm_replwrap import error_pat
+
+
+# Magics which only affect how the kernel presents a session, and which have nothing
+# to do when a notebook is run in a batch
+SKIPPED_MAGICS = ("page_output", "kernel_stats", "rerun_affected")
+
+
+class _Session:
+    """An interpreter and the journal of the commands which succeeded in it, so that
+    it can be replaced after it exits or times out
+    """
+
+    def __init__(self, interpreter_path, timeout):
+        self._interpreter_path = interpreter_path
+        self._timeout = timeout
+        self._journal = []
+        self.wasmwrapper = self._spawn()
+
+    def _spawn(self):
+        return spawn_wasm(self._interpreter_path, prelude_paths(), memory_limit())
+
+    def run(self, command):
+        """Run a command, returning a test case's `status`, `output` and `errors`"""
+        try:
+            output = self.wasmwrapper.run_command(
+                command, timeout=self._timeout, framed=True
+            )
+        except (pexpect.EOF, pexpect.TIMEOUT) as e:
+            output = self.wasmwrapper.before or ""
+            if isinstance(e, pexpect.EOF):
+                message = "the interpreter exited"
+            else:
+                message = "the command took longer than %gs" % self._timeout
+            self._restart()
+            return {
+                "status": "error",
+                "output": output,
+                "errors": [{"type": "crash", "details": message}],
+            }
+        errors = [
+            {
+                "location": m.group(1),
+                "type": m.group(2),
+                "details": m.group(3),
+                "message": m.group(0),
+            }
+            for m in error_pat.finditer(output)
+        ]
+        if errors:
+            return {"status": "failure", "output": output, "errors": errors}
+        self._journal.append(command)
+        return {"status": "ok", "output": output, "errors": []}
+
+    def _restart(self):
+        """Replace the interpreter, and restore the commands which succeeded"""
+        self.close()
+        self.wasmwrapper = self._spawn()
+        if self._journal:
+            self.wasmwrapper.run_command(
+                "\n".join(self._journal), timeout=None, framed=True
+            )
+
+    def close(self):
+        self.wasmwrapper.child.terminate(force=True)
+
+
+def _run_code(session, checker, code):
+    """Run a cell's code, handling magics and incomplete input as the kernel does"""
+    try:
+        magic = parse_magic(code)
+        if magic is not None:
+            if magic.name in LOAD_EXTENSIONS and magic.body is None:
+                code = load_command(
+                    expand_paths(magic.args, LOAD_EXTENSIONS[magic.name])
+                )
+            elif magic.name in SKIPPED_MAGICS and magic.body is None:
+                return {"status": "skipped", "output": "", "errors": []}
+            else:
+                raise MagicError("unknown magic `%s`" % magic.name)
+    except MagicError as e:
+        return {
+            "status": "failure",
+            "output": "",
+            "errors": [{"type": "magic error", "details": str(e)}],
+        }
+    if checker.scan(code).open:
+        return {
+            "status": "failure",
+            "output": "",
+            "errors": [
+                {
+                    "type": "incomplete input",
+                    "details": "a form or block comment isn't closed",
+                }
+            ],
+        }
+    return session.run(code)
+
+
+def _cell_outputs(case):
+    """A notebook cell's outputs for a test case, like those the kernel sends"""
+    outputs = []
+    if case["output"]:
+        outputs.append(
+            {"output_type": "stream", "name": "stdout", "text": case["output"]}
+        )
+    for error in case["errors"][:1]:
+        outputs.append(
+            {
+                "output_type": "error",
+                "ename": error["type"],
+                "evalue": error["details"],
+                "traceback": [
+                    error.get("message") or "%s: %s" % (error["type"], error["details"])
+                ],
+            }
+        )
+    return outputs
+
+
+def run_notebook(session, path, output_path):
+    with open(path, encoding="utf-8") as f:
+        notebook = json.load(f)
+    checker = CompletenessChecker()
+    cases = []
+    execution_count = 0
+    for index, cell in enumerate(notebook.get("cells", [])):
+        if cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", "")
+        code = ("".join(source) if isinstance(source, list) else source).rstrip()
+        cell["outputs"] = []
+        if not code:
+            cell["execution_count"] = None
+            continue
+        execution_count += 1
+        start = time.perf_counter()
+        case = _run_code(session, checker, code)
+        case.update(name="cell %d" % (index + 1), time=time.perf_counter() - start)
+        cases.append(case)
+        cell["execution_count"] = execution_count
+        cell["outputs"] = _cell_outputs(case)
+    if output_path is not None:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(notebook, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+    return cases
+
+
+def run_script(session, path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        contents = f.read()
+    forms = split_forms(contents)
+    if forms is None:
+        return [
+            {
+                "name": "script",
+                "status": "failure",
+                "output": "",
+                "errors": [
+                    {
+                        "type": "incomplete input",
+                        "details": "the script isn't a sequence of complete forms",
+                    }
+                ],
+                "time": 0.0,
+            }
+        ]
+    cases = []
+    offset = 0
+    for form in forms:
+        offset = contents.find(form, offset)
+        line = contents.count("\n", 0, offset) + 1
+        offset += len(form)
+        start = time.perf_counter()
+        case = session.run(form)
+        case.update(name="line %d" % line, time=time.perf_counter() - start)
+        cases.append(case)
+    return cases
+
+
+def run_file(path, interpreter_path, timeout=None, output_path=None):
+    """Run a notebook or script (given by its absolute path) in a new interpreter,
+    returning its summary. This runs in the pool's worker processes.
+    """
+    start = time.perf_counter()
+    result = {"path": path, "cases": [], "error": None}
+    # notebooks' relative paths (eg. in %load_wat) are relative to the notebook, like
+    # they are when Jupyter starts the kernel
+    os.chdir(os.path.dirname(path))
+    try:
+        session = _Session(interpreter_path, timeout)
+    except Exception as e:
+        result["error"] = "unable to start the interpreter: %s" % e
+        return result
+    try:
+        if path.endswith(".ipynb"):
+            result["cases"] = run_notebook(session, path, output_path)
+        else:
+            result["cases"] = run_script(session, path)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        session.close()
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+def write_junit(results, path):
+    suites = ET.Element("testsuites")
+    for result in results:
+        cases = result["cases"]
+        suite = ET.SubElement(
+            suites,
+            "testsuite",
+            name=result["path"],
+            tests=str(len(cases)),
+            failures=str(sum(case["status"] == "failure" for case in cases)),
+            errors=str(
+                sum(case["status"] == "error" for case in cases)
+                + (result["error"] is not None)
+            ),
+            skipped=str(sum(case["status"] == "skipped" for case in cases)),
+            time="%.3f" % result.get("time", 0.0),
+        )
+        if result["error"] is not None:
+            ET.SubElement(suite, "error", message=result["error"])
+        for case in cases:
+            element = ET.SubElement(
+                suite,
+                "testcase",
+                classname=result["path"],
+                name=case["name"],
+                time="%.3f" % case["time"],
+            )
+            if case["status"] == "skipped":
+                ET.SubElement(element, "skipped")
+            elif case["status"] != "ok":
+                error = case["errors"][0]
+                ET.SubElement(
+                    element,
+                    case["status"],
+                    message="%s: %s" % (error["type"], error["details"]),
+                    type=error["type"],
+                ).text = case["output"]
+    ET.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def summarize(results):
+    """The JSON summary of the files' results (without their cases' output)"""
+    files = []
+    for result in results:
+        files.append(
+            {
+                "path": result["path"],
+                "error": result["error"],
+                "time": result.get("time"),
+                "cases": [
+                    {key: value for key, value in case.items() if key != "output"}
+                    for case in result["cases"]
+                ],
+            }
+        )
+    cases = [case for result in results for case in result["cases"]]
+    return {
+        "files": files,
+        "totals": {
+            "files": len(results),
+            "cases": len(cases),
+            "failed": sum(case["status"] in ("failure", "error") for case in cases)
+            + sum(result["error"] is not None for result in results),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run notebooks and .wast scripts through the Wasm interpreter"
+    )
+    parser.add_argument("paths", nargs="+", help=".ipynb, .wat and .wast files")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="how many files to run at once (default: one per core)",
+    )
+    parser.add_argument(
+        "--interpreter",
+        help="the interpreter to run (by default, found like the kernel finds it)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, help="the longest a cell or form may run, in seconds"
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="write executed notebooks here instead of updating them in place",
+    )
+    parser.add_argument(
+        "--no-write", action="store_true", help="don't write executed notebooks"
+    )
+    parser.add_argument("--junit", help="write a JUnit XML report to this file")
+    parser.add_argument("--json", help="write a JSON summary to this file")
+    args = parser.parse_args(argv)
+
+    interpreter_path = os.path.abspath(args.interpreter or find_interpreter())
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    def output_path(path):
+        if args.no_write or not path.endswith(".ipynb"):
+            return None
+        if args.output_dir:
+            return os.path.abspath(
+                os.path.join(args.output_dir, os.path.basename(path))
+            )
+        return os.path.abspath(path)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            executor.submit(
+                run_file,
+                os.path.abspath(path),
+                interpreter_path,
+                args.timeout,
+                output_path(path),
+            )
+            for path in args.paths
+        ]
+        results = []
+        for path, future in zip(args.paths, futures):
+            result = future.result()
+            result["path"] = path
+            results.append(result)
+            failed = [
+                case
+                for case in result["cases"]
+                if case["status"] not in ("ok", "skipped")
+            ]
+            status = "error" if result["error"] else "FAIL" if failed else "ok"
+            print(
+                "%-4s %s (%d cases, %.2fs)"
+                % (
+                    status,
+                    result["path"],
+                    len(result["cases"]),
+                    result.get("time", 0.0),
+                )
+            )
+            if result["error"]:
+                print("  " + result["error"])
+            for case in failed:
+                for error in case["errors"]:
+                    print(
+                        "  %s: %s"
+                        % (
+                            case["name"],
+                            error.get("message")
+                            or "%s: %s" % (error["type"], error["details"]),
+                        )
+                    )
+
+    summary = summarize(results)
+    if args.junit:
+        write_junit(results, args.junit)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["totals"]["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
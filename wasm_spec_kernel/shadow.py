@@ -0,0 +1,95 @@
+"""A hot-standby Wasm interpreter which mirrors a kernel's session in the background."""
+import logging
+import queue
+import threading
+
+from .wasm_replwrap import error_pat
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShadowInterpreter:
+    """Runs a second Wasm interpreter on a background thread, which is sent every cell
+    that executed successfully in the primary interpreter. Since cells are only sent
+    once they've finished in the primary interpreter, the shadow stays (at most) one
+    cell behind it and can replace it immediately when the primary is interrupted or
+    crashes.
+
+    :param spawn: Function which starts a new interpreter and returns its
+      :class:`WasmREPLWrapper`. It's called from the background thread.
+    :param history: Cells which have already been executed in the primary
+      interpreter, which are replayed into the shadow before any new cells.
+    """
+
+    def __init__(self, spawn, history=()):
+        self._queue = queue.Queue()
+        self._wasmwrapper = None
+        self._diverged = False
+        self._thread = threading.Thread(
+            target=self._run, args=(spawn, list(history)), daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, code):
+        """Queue a cell which executed successfully in the primary interpreter"""
+        self._queue.put(code)
+
+    def promote(self, timeout=None):
+        """Wait for the shadow to catch up with all submitted cells and return its
+        :class:`WasmREPLWrapper`, or None if the shadow couldn't mirror the session (in
+        which case it's shut down). The shadow can't be used after this is called.
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive() or self._diverged or self._wasmwrapper is None:
+            logger.debug("shadow interpreter isn't usable, discarding it")
+            self.close()
+            return None
+        wasmwrapper, self._wasmwrapper = self._wasmwrapper, None
+        return wasmwrapper
+
+    def close(self):
+        """Stop the shadow and terminate its interpreter"""
+        self._diverged = True
+        self._queue.put(None)
+        wasmwrapper, self._wasmwrapper = self._wasmwrapper, None
+        if wasmwrapper is not None:
+            try:
+                wasmwrapper.child.terminate(force=True)
+            except Exception:
+                logger.debug(
+                    "error while terminating shadow interpreter", exc_info=True
+                )
+
+    def _run(self, spawn, history):
+        try:
+            wasmwrapper = spawn()
+            if self._diverged:
+                # closed while starting up
+                wasmwrapper.child.terminate(force=True)
+                return
+            self._wasmwrapper = wasmwrapper
+            if history:
+                self._execute("\n".join(history))
+            while not self._diverged:
+                code = self._queue.get()
+                if code is None:
+                    return
+                self._execute(code)
+        except Exception:
+            logger.debug("shadow interpreter failed", exc_info=True)
+            self._diverged = True
+
+    def _execute(self, code):
+        wasmwrapper = self._wasmwrapper
+        if wasmwrapper is None:
+            # closed while starting up
+            self._diverged = True
+            return
+        output = wasmwrapper.run_command(code, timeout=None, framed=True)
+        if error_pat.search(output):
+            # The cell succeeded in the primary interpreter, so the two sessions no
+            # longer match
+            logger.debug("shadow interpreter diverged: ```%s```", output)
+            self._diverged = True
@@ -0,0 +1,204 @@
+"""Running self-contained cells as one-shot scripts, outside of the kernel's interactive
+interpreter (see %%standalone and WASM_KERNEL_STANDALONE_MIN_FORMS), so that big cells
+of assertions don't hold up the session.
+
+A cell is split into segments at each module definition. The forms after a module
+definition usually only use that module, but if a segment references a name defined
+by an earlier segment, the segments from the one which defines it on are kept
+together. The groups of segments which are independent of each other are run by
+separate interpreter processes at once, and their output is passed on in the order of
+the cell's forms. Each process starts from a new interpreter (with the prelude
+loaded), so nothing which a standalone cell defines is kept in the session.
+
+Unlike the interpreter's REPL, which carries on with the next form after an error, a
+script stops at its first error, so the forms after an error in the same group aren't
+run. This is pointed out after the error.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+from typing import FrozenSet, List, NamedTuple, Tuple
+
+from .defs import LESS_THAN_OCAML_MAX_INT
+from .dependencies import DependencyGraph, head_pat
+from .startup import child_preexec
+from .syntax import split_forms
+from .wasm_replwrap import error_pat
+
+
+# Registered names which the interpreter provides itself
+BUILTIN_NAMES = frozenset(['"spectest"'])
+# What the scripts are called in the interpreter's output, e.g. in error locations
+SCRIPT_NAME = "standalone.wast"
+# A module which is defined after the prelude, so that the prelude's output (its
+# modules' signatures) can be told apart from the script's
+PRELUDE_MARKER = "$__wasm_spec_kernel_prelude__"
+
+
+class Analysis(NamedTuple):
+    #: The groups of forms which can be run independently, as (line, code) pairs
+    segments: List[List[Tuple[int, str]]]
+    #: Whether the cell doesn't reference anything defined outside of it
+    self_contained: bool
+    #: The module and registered names which the cell defines (anonymous modules
+    #: aren't included)
+    defines: FrozenSet[str]
+    forms: int
+
+
+def analyze(code):
+    """Split a cell into segments which can be run independently, and find whether it
+    depends on the session. Returns None if the cell isn't valid and complete.
+    """
+    if split_forms(code) is None:
+        return None
+    graph = DependencyGraph()
+    graph.add(code, 0)
+    groups = []
+    defined_in = {}
+    external = set()
+    defines = set()
+    offset = 0
+    for index, form in enumerate(graph.forms):
+        offset = code.find(form.code, offset)
+        line = code.count("\n", 0, offset) + 1
+        offset += len(form.code)
+        m = head_pat.match(form.code)
+        head = m.group(1) if m else None
+        if not groups or head == "module":
+            groups.append([])
+            if index == 0 and head not in ("module", "input"):
+                # commands without a module name refer to the session's last module
+                external.add(None)
+        for name in form.references:
+            first = defined_in.get(name)
+            if first is None:
+                if name not in BUILTIN_NAMES:
+                    external.add(name)
+            elif first < len(groups) - 1:
+                groups[first:] = [[item for group in groups[first:] for item in group]]
+                for other, group in defined_in.items():
+                    defined_in[other] = min(group, first)
+        groups[-1].append((line, form.code))
+        for name in form.defines:
+            defined_in[name] = len(groups) - 1
+            if not name.startswith("module:"):
+                defines.add(name)
+    return Analysis(groups, not external, frozenset(defines), len(graph.forms))
+
+
+def _batches(segments, count):
+    """Join consecutive segments into at most `count` batches of about the same number
+    of forms
+    """
+    target = sum(len(segment) for segment in segments) / count
+    batches = []
+    batch = []
+    for segment in segments:
+        batch.extend(segment)
+        if len(batch) >= target and len(batches) < count - 1:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _script(forms):
+    """A script of forms, which are kept on their lines in the cell so that the
+    interpreter's error locations match the cell's
+    """
+    lines = []
+    for line, code in forms:
+        lines.extend([""] * (line - 1 - len(lines)))
+        lines.extend(code.split("\n"))
+    return "\n".join(lines) + "\n"
+
+
+def _skipped_note(forms, output):
+    """A note on the forms of a script which weren't run because the interpreter
+    stopped at an error in `output`, or None if there weren't any
+    """
+    m = error_pat.search(output)
+    if m is None or not m.group(0).startswith(SCRIPT_NAME + ":"):
+        return None
+    line = int(m.group(1).split(".", 1)[0])
+    skipped = sum(1 for start, _ in forms if start > line)
+    if not skipped:
+        return None
+    return (
+        "[%d form%s after line %d weren't run: a script stops at its first error]\n"
+        % (
+            skipped,
+            "" if skipped == 1 else "s",
+            line,
+        )
+    )
+
+
+async def _run_script(args, processes, memory_limit):
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        preexec_fn=child_preexec(memory_limit),
+    )
+    processes.append(process)
+    output, _ = await process.communicate()
+    return output.decode("utf-8", "replace"), process.returncode
+
+
+async def run_standalone(
+    interpreter_path, prelude, segments, on_output, workers=None, memory_limit=None
+):
+    """Run the segments of a cell (see :func:`analyze`) as scripts in up to `workers`
+    interpreter processes at once, passing the output of each to `on_output` in order.
+    The processes are killed if this is cancelled.
+
+    Module signatures are printed (with `-s`) like they are in the REPL, except for
+    the prelude's.
+
+    :param memory_limit: The interpreters' address space limit, in bytes.
+    """
+    workers = workers or os.cpu_count() or 1
+    directory = tempfile.mkdtemp(prefix="wasm_standalone_")
+    processes = []
+    tasks = []
+    try:
+        for index, forms in enumerate(_batches(segments, workers)):
+            path = os.path.join(directory, str(index), SCRIPT_NAME)
+            os.mkdir(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(_script(forms))
+            args = [interpreter_path, "-w", LESS_THAN_OCAML_MAX_INT, "-s"]
+            if prelude:
+                args.extend(prelude)
+                args.extend(["-e", "(module %s)" % PRELUDE_MARKER])
+            args.append(path)
+            tasks.append(
+                (
+                    path,
+                    forms,
+                    asyncio.ensure_future(_run_script(args, processes, memory_limit)),
+                )
+            )
+        for path, forms, task in tasks:
+            output, returncode = await task
+            marker = "module %s :\n" % PRELUDE_MARKER
+            if prelude and marker in output:
+                output = output[output.index(marker) + len(marker) :]
+            output = output.replace(path, SCRIPT_NAME)
+            on_output(output)
+            if returncode != 0:
+                note = _skipped_note(forms, output)
+                if note is not None:
+                    on_output(note)
+    finally:
+        for _, _, task in tasks:
+            task.cancel()
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+        shutil.rmtree(directory, ignore_errors=True)
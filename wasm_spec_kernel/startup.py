@@ -0,0 +1,201 @@
+"""Starting Wasm interpreters in the background, so that the kernel doesn't have to wait
+for them (e.g. while it's starting up itself).
+"""
+import logging
+import os
+import shutil
+import signal
+import threading
+
+import pexpect  # type: ignore
+
+from .defs import (
+    ENV_MEMORY_LIMIT,
+    ENV_POOL_SOCKET,
+    ENV_PRELUDE,
+    ENV_RESULT_CACHE,
+    ENV_WASM_INTERPRETER,
+    LESS_THAN_OCAML_MAX_INT,
+)
+from .limits import set_memory_limit
+from .wasm_replwrap import WasmREPLWrapper, error_pat
+
+
+logger = logging.getLogger(__name__)
+
+
+def find_interpreter():
+    """Resolve the path of the Wasm interpreter which the kernel should use"""
+    env_interpreter = os.environ.get(ENV_WASM_INTERPRETER, "wasm")
+    interpreter_path = shutil.which(env_interpreter)
+    if interpreter_path is None:
+        raise Exception(
+            "Unable to find a `%s` executable in $PATH: %s"
+            % (env_interpreter, os.environ.get("PATH"))
+        )
+    return interpreter_path
+
+
+def prelude_paths():
+    """The files which should be loaded into every interpreter before it's used"""
+    return [
+        os.path.abspath(path)
+        for path in os.environ.get(ENV_PRELUDE, "").split(os.pathsep)
+        if path
+    ]
+
+
+def memory_limit():
+    """The address space limit (in bytes) of the kernel's interpreters, or None"""
+    megabytes = int(os.environ.get(ENV_MEMORY_LIMIT, "0"))
+    return megabytes * 2 ** 20 if megabytes > 0 else None
+
+
+def escape_wasm_string(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _reset_sigint():
+    # Signal handlers are inherited by forked processes. Since kernelapp ignores
+    # SIGINT except in message handlers, we need to reset the SIGINT handler in the
+    # child (between fork and exec) so that wasm is interruptible.
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+
+def child_preexec(memory_limit=None):
+    """The `preexec_fn` for the kernel's interpreter processes, which makes them
+    interruptible and applies their address space limit (in bytes)
+    """
+
+    def preexec():
+        _reset_sigint()
+        if memory_limit is not None:
+            set_memory_limit(memory_limit)
+
+    return preexec
+
+
+def spawn_wasm(interpreter_path, prelude=(), memory_limit=None):
+    """Start a new wasm interpreter, load the prelude into it and wait until it's
+    ready for input. This is safe to call from background threads.
+
+    :param memory_limit: The interpreter's address space limit, in bytes.
+    """
+    logger.info("using wasm interpreter at `%s`" % interpreter_path)
+    # Set the output width (`-w`) from 80 to the largest the interpreter accepts, so
+    # that text wrapping is handled by the jupyter frontend instead of the interpreter
+    child = pexpect.spawn(
+        interpreter_path,
+        ["-w", LESS_THAN_OCAML_MAX_INT],
+        echo=False,
+        encoding="utf-8",
+        codec_errors="replace",
+        preexec_fn=child_preexec(memory_limit),
+    )
+    # pexpect sleeps for 50ms before every send by default, in case the child hasn't
+    # turned off echo yet, which isn't needed since echo is off from the start
+    child.delaybeforesend = None
+    wasmwrapper = WasmREPLWrapper(child)
+    load_prelude(wasmwrapper, prelude)
+    return wasmwrapper
+
+
+def load_prelude(wasmwrapper, prelude):
+    """Have an interpreter read each of the prelude's files"""
+    for path in prelude:
+        output = wasmwrapper.run_command(
+            '(input "%s")' % escape_wasm_string(path), timeout=None, framed=True
+        )
+        if error_pat.search(output):
+            logger.warning("error loading prelude `%s`: %s", path, output)
+
+
+def start_interpreter(interpreter_path, prelude=(), memory_limit=None):
+    """Start an interpreter for the kernel, which is either spawned by the kernel, or
+    handed out by the interpreter pool daemon if WASM_KERNEL_POOL_SOCKET is set (in
+    which case the pool's own limits apply instead of `memory_limit`)
+    """
+    socket_path = os.environ.get(ENV_POOL_SOCKET)
+    if socket_path:
+        from .pool import PooledREPL
+
+        return PooledREPL(socket_path, prelude)
+    return spawn_wasm(interpreter_path, prelude, memory_limit)
+
+
+class StartingInterpreter:
+    """Starts an interpreter on a background thread.
+
+    :param spawn: Function which starts a new interpreter and returns its
+      :class:`WasmREPLWrapper`.
+    """
+
+    def __init__(self, spawn):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._wasmwrapper = None
+        self._error = None
+        self._discarded = False
+        threading.Thread(target=self._run, args=(spawn,), daemon=True).start()
+
+    def result(self, timeout=None):
+        """Wait for the interpreter to be ready and return its :class:`WasmREPLWrapper`,
+        re-raising any error which prevented it from starting
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("the wasm interpreter hasn't started yet")
+        if self._error is not None:
+            raise self._error
+        return self._wasmwrapper
+
+    def discard(self):
+        """Terminate the interpreter once it has started (or straight away if it has)"""
+        with self._lock:
+            self._discarded = True
+            wasmwrapper, self._wasmwrapper = self._wasmwrapper, None
+        if wasmwrapper is not None:
+            wasmwrapper.child.terminate(force=True)
+
+    def _run(self, spawn):
+        try:
+            wasmwrapper = spawn()
+        except Exception as e:
+            logger.debug("unable to start a wasm process", exc_info=True)
+            self._error = e
+            self._done.set()
+            return
+        with self._lock:
+            if not self._discarded:
+                self._wasmwrapper = wasmwrapper
+                wasmwrapper = None
+        if wasmwrapper is not None:
+            wasmwrapper.child.terminate(force=True)
+        self._done.set()
+
+
+_prestarted = None
+
+
+def prestart():
+    """Start the kernel's first interpreter before the kernel itself is created, so
+    that it starts concurrently with ipykernel's imports and socket setup
+    """
+    global _prestarted
+    if os.environ.get(ENV_RESULT_CACHE, "0") != "0":
+        # the interpreter is only started once a cell misses the result cache
+        return
+    try:
+        interpreter_path = find_interpreter()
+    except Exception:
+        # the kernel reports this once it's able to
+        return
+    _prestarted = StartingInterpreter(
+        lambda: start_interpreter(interpreter_path, prelude_paths(), memory_limit())
+    )
+
+
+def take_prestarted():
+    """Return the interpreter started by :func:`prestart`, if there is one"""
+    global _prestarted
+    starting, _prestarted = _prestarted, None
+    return starting
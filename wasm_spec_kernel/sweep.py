@@ -0,0 +1,127 @@
+"""Sweeping an exported function over many arguments with several interpreters at once
+(see %%parallel_invoke).
+
+Each worker interpreter is a replica of the session, which is made by replaying the
+journal into a new interpreter. The argument tuples are split into contiguous shards,
+one per worker, and each worker invokes the function with its shard's arguments one at
+a time, so that every invocation's output (and so its result) is known. A worker whose
+interpreter exits is replaced by a new replica, which retries the invocation once. The
+workers' invocations don't change the session, but they do see the effects of the
+invocations which their worker ran before them (e.g. on a module's globals).
+"""
+import asyncio
+import logging
+
+import pexpect  # type: ignore
+
+from .results import parse_values, values_pat
+from .startup import escape_wasm_string
+from .wasm_replwrap import error_pat
+
+
+logger = logging.getLogger(__name__)
+
+# How many times an invocation is retried in a new replica if the interpreter exits
+RETRIES = 1
+
+
+def invoke_command(module, export, args):
+    """The command which invokes an export with a tuple of arguments"""
+    parts = ["invoke"]
+    if module is not None:
+        parts.append(module)
+    parts.append('"%s"' % escape_wasm_string(export))
+    if args:
+        parts.append(args)
+    return "(%s)" % " ".join(parts)
+
+
+def parse_result(output):
+    """The result of an invocation from its output: `{"values": [...]}` with typed
+    values (see :func:`parse_values`), or `{"error": {"type": ..., "details": ...}}`
+    """
+    if output is None:
+        return {"error": {"type": "crash", "details": "the interpreter exited"}}
+    m = error_pat.search(output)
+    if m is not None:
+        return {"error": {"type": m.group(2), "details": m.group(3)}}
+    for line in reversed(output.splitlines()):
+        m = values_pat.match(line.strip())
+        if m is not None:
+            return {"values": parse_values(m.group(1), m.group(2))}
+    return {"values": []}
+
+
+def format_result(result):
+    if "error" in result:
+        return "%s: %s" % (result["error"]["type"], result["error"]["details"])
+    values = result["values"]
+    if not values:
+        return "[]"
+    if len(values) == 1:
+        return "%s : %s" % (values[0]["value"], values[0]["type"])
+    return "[%s] : [%s]" % (
+        " ".join(value["value"] for value in values),
+        " ".join(value["type"] for value in values),
+    )
+
+
+def _terminate(wasmwrapper):
+    try:
+        wasmwrapper.child.terminate(force=True)
+    except Exception:
+        logger.debug("error while terminating a wasm process", exc_info=True)
+
+
+async def run_sweep(spawn_replica, commands, workers):
+    """Run each of `commands` in one of `workers` replicas, which are started by
+    `spawn_replica` (on a background thread), returning each command's output in
+    order, or None for commands which the interpreter exited on every time they ran.
+    The replicas are terminated once the sweep is done or cancelled.
+    """
+    if not commands:
+        return []
+    loop = asyncio.get_event_loop()
+    outputs = [None] * len(commands)
+    replicas = []
+    closed = False
+
+    def spawn():
+        wasmwrapper = spawn_replica()
+        replicas.append(wasmwrapper)
+        if closed:
+            _terminate(wasmwrapper)
+            raise asyncio.CancelledError()
+        return wasmwrapper
+
+    async def work(start, end):
+        wasmwrapper = None
+        for index in range(start, end):
+            for _ in range(RETRIES + 1):
+                if wasmwrapper is None:
+                    wasmwrapper = await loop.run_in_executor(None, spawn)
+                try:
+                    outputs[index] = await wasmwrapper.run_command_async(
+                        commands[index], timeout=None
+                    )
+                    break
+                except pexpect.EOF:
+                    logger.debug("a replica exited, replacing it")
+                    _terminate(wasmwrapper)
+                    wasmwrapper = None
+
+    workers = max(min(workers, len(commands)), 1)
+    shard_size = -(-len(commands) // workers)
+    tasks = [
+        asyncio.ensure_future(work(start, min(start + shard_size, len(commands))))
+        for start in range(0, len(commands), shard_size)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        closed = True
+        for task in tasks:
+            task.cancel()
+        for wasmwrapper in replicas:
+            _terminate(wasmwrapper)
+    return outputs
@@ -0,0 +1,160 @@
+"""Incremental scanning of WebAssembly text (WAT/WAST) input, which determines whether
+input is a complete block of top-level forms without involving the interpreter.
+"""
+import re
+from typing import List, NamedTuple
+
+
+# Tokens outside of block comments. Strings can't span lines, so a string which isn't
+# closed by the end of its line is unterminated (group 1 is None).
+_token_pat = re.compile(r'\(;|;;|"(?:[^"\\]|\\.)*(")?|[()]|[^\s()";]+|;')
+_block_comment_pat = re.compile(r"\(;|;\)")
+
+
+class ScanState(NamedTuple):
+    """The scanner's state at the end of a line of input.
+
+    :param depth: How many forms are open.
+    :param comment_depth: How many (nested) block comments are open.
+    :param invalid: Whether the input so far can't be valid, ie. it has an
+      unterminated string, closes a form which was never opened, or has something
+      other than a form at the top level. The interpreter reports an error for such
+      input as soon as it reads the offending line, and discards the rest of the
+      line along with any forms which were open, so scanning continues from the
+      top level on the next line.
+    """
+
+    depth: int = 0
+    comment_depth: int = 0
+    invalid: bool = False
+
+    @property
+    def open(self):
+        """Whether a form or block comment is left open, in which case the
+        interpreter waits for more input
+        """
+        return self.depth > 0 or self.comment_depth > 0
+
+    @property
+    def status(self):
+        """The status of the input for an is_complete_request"""
+        if self.invalid:
+            return "invalid"
+        if self.open:
+            return "incomplete"
+        return "complete"
+
+    @property
+    def indent(self):
+        """Indentation for the next line of incomplete input"""
+        return "  " * self.depth
+
+
+def scan_line(line, state=ScanState(), form_spans=None):
+    """Scan a single line of input, starting in `state`, and return the state at the
+    end of the line. If a `form_spans` list is given, the (start, end) offsets within
+    the line of the parentheses which open and close top-level forms are appended to
+    it (the start is None for forms which were opened on an earlier line).
+    """
+    depth, comment_depth, invalid = state
+    pos, n = 0, len(line)
+    while pos < n:
+        if comment_depth > 0:
+            m = _block_comment_pat.search(line, pos)
+            if m is None:
+                break
+            comment_depth += 1 if m.group() == "(;" else -1
+            pos = m.end()
+            continue
+        m = _token_pat.search(line, pos)
+        if m is None:
+            break
+        pos = m.end()
+        token = m.group()
+        if token == "(":
+            if depth == 0 and form_spans is not None:
+                form_spans.append((m.start(), None))
+            depth += 1
+        elif token == ")":
+            if depth == 0:
+                return ScanState(invalid=True)
+            depth -= 1
+            if depth == 0 and form_spans is not None:
+                if form_spans and form_spans[-1][1] is None:
+                    form_spans[-1] = (form_spans[-1][0], pos)
+                else:
+                    form_spans.append((None, pos))
+        elif token == "(;":
+            comment_depth = 1
+        elif token == ";;":
+            break
+        elif token[0] == '"':
+            if m.group(1) is None:
+                return ScanState(invalid=True)
+        elif depth == 0:
+            return ScanState(invalid=True)
+    return ScanState(depth, comment_depth, invalid)
+
+
+def scan_lines(lines, state=ScanState()):
+    """Scan lines of input, returning the state at the end of each line"""
+    states = []
+    for line in lines:
+        state = scan_line(line, state)
+        states.append(state)
+    return states
+
+
+def split_forms(code):
+    """Split valid and complete input into the text of its top-level forms (without
+    any comments between them), or return None if the input isn't valid and complete
+    """
+    forms = []
+    state = ScanState()
+    form_start = None
+    offset = 0
+    for line in code.split("\n"):
+        spans = []
+        state = scan_line(line, state, spans)
+        if state.invalid:
+            return None
+        for start, end in spans:
+            if start is not None:
+                form_start = offset + start
+            if end is not None:
+                forms.append(code[form_start : offset + end])
+        offset += len(line) + 1
+    if state.open:
+        return None
+    return forms
+
+
+class CompletenessChecker:
+    """Checks whether cells are complete. The scanner's state is kept for every line
+    of the last cell which was checked, so that checking a cell which extends it (as
+    frontends do while it's being typed) only scans the lines which changed.
+    """
+
+    def __init__(self):
+        self._lines: List[str] = []
+        self._states: List[ScanState] = []
+
+    def scan(self, code):
+        """Return the state at the end of `code`"""
+        lines = code.split("\n")
+        unchanged = 0
+        for old, new in zip(self._lines, lines):
+            if old != new:
+                break
+            unchanged += 1
+        state = self._states[unchanged - 1] if unchanged > 0 else ScanState()
+        self._states[unchanged:] = scan_lines(lines[unchanged:], state)
+        self._lines = lines
+        return self._states[-1]
+
+    def check(self, code):
+        """Return the content of an is_complete_reply for `code`"""
+        state = self.scan(code)
+        if state.status == "incomplete":
+            return {"status": "incomplete", "indent": state.indent}
+        return {"status": state.status}
@@ -1,5 +1,222 @@
 """Wrapper for the Wasm reference interpreter's read-eval-print-loop."""
+import asyncio
+import errno
+import os
+import pexpect  # type: ignore
 from pexpect.replwrap import REPLWrapper  # type: ignore
+import re
+import select
+import time
+import uuid
+
+from .syntax import scan_lines
+
+
+# Errors are located in "stdin", or in a file which the interpreter was asked to read.
+# They're always printed at the start of a line, and anchoring the pattern there keeps
+# searching long lines of output linear.
+error_pat = re.compile(
+    r"^(?:stdin|[^\r\n:]+\.(?:wat|wast|wasm)):(\d+.\d+-\d+.\d+): (.+?): (.+)",
+    re.MULTILINE,
+)  # 1=location, 2=type, 3=details
+
+
+def _toplevel_chunks(cmdlines, states, chunk_size):
+    """Group input lines into chunks of roughly `chunk_size` characters, where every
+    chunk ends on a line which closes all of its top-level forms. `states` are the
+    lines' :class:`ScanState`s.
+
+    Returns None if the lines aren't a balanced block of valid input, since it can't
+    be known where the interpreter would consider such input to end.
+    """
+    if states[-1].status != "complete":
+        return None
+    chunks = []
+    chunk = []
+    size = 0
+    for line, state in zip(cmdlines, states):
+        chunk.append(line)
+        size += len(line) + 1
+        if state.depth == 0 and state.comment_depth == 0 and size >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# The kinds of prompt which _ReplReader can wait for (besides sentinels, which are
+# given as the bytes of their token)
+PROMPT = "prompt"
+CONTINUATION_PROMPT = "continuation prompt"
+
+
+def _decode(data):
+    """Decode the REPL's output, normalizing the pty's line endings"""
+    return bytes(data).replace(b"\r\n", b"\n").decode("utf-8", "replace")
+
+
+class _ReplReader:
+    """Reads the REPL's output straight from its pty, in large chunks, and finds its
+    prompts with plain byte searches.
+
+    This replaces pexpect's `expect`, which decodes everything it reads and searches
+    the whole buffer with a regex every time more output arrives (which is quadratic
+    for large outputs). Instead, only the bytes which arrived since the last search
+    (plus a few bytes of overlap) are searched for the next prompt, and output is
+    decoded once, when it's taken from the buffer.
+
+    Prompts are matched with the same semantics as the regexes which
+    WasmREPLWrapper used with pexpect:
+
+    * PROMPT matches `(^|\r\n)> `
+    * CONTINUATION_PROMPT matches `^  `
+    * a sentinel token matches `(^|\r\n)[^\r\n]*TOKEN[^\r\n]*\r\n> `
+
+    where `^` is the start of the unread output. The earliest match wins, with ties
+    going to the pattern which was listed first.
+    """
+
+    read_size = 64 * 1024
+    #: Lines longer than this are streamed before they're complete
+    max_line = 4 * read_size
+    _prompt = b"\r\n> "
+
+    def __init__(self, child):
+        self.child = child
+        self.buffer = bytearray()
+        # output which pexpect already read, if any
+        if child.buffer:
+            self.buffer += child.buffer.encode("utf-8")
+            child.buffer = child.buffer_type().getvalue()
+        self._searched = 0
+        #: The output before the last match (or before EOF)
+        self.before = ""
+        #: A :class:`~.metrics.Spans` which reads and searches are timed in, if set
+        self.spans = None
+
+    def search(self, patterns):
+        """Return the index of the earliest pattern which matches the unread output,
+        and consume the output up to the end of the match, or return None
+        """
+        spans = self.spans
+        if spans is None:
+            return self._search(patterns)
+        start = time.perf_counter()
+        try:
+            return self._search(patterns)
+        finally:
+            spans.add("prompt_match", time.perf_counter() - start)
+
+    def _search(self, patterns):
+        buf = self.buffer
+        best = None  # (start, index, end)
+        for index, pattern in enumerate(patterns):
+            if pattern is PROMPT and buf.startswith(b"> "):
+                best = min(best or (0, index, 2), (0, index, 2))
+            elif pattern is CONTINUATION_PROMPT and buf.startswith(b"  "):
+                best = min(best or (0, index, 2), (0, index, 2))
+        if best is None:
+            pos = buf.find(self._prompt, max(self._searched - len(self._prompt), 0))
+            while pos != -1:
+                end = pos + len(self._prompt)
+                line_start = max(buf.rfind(b"\r\n", 0, pos), 0)
+                for index, pattern in enumerate(patterns):
+                    if pattern is PROMPT:
+                        match = (pos, index, end)
+                    elif (
+                        isinstance(pattern, bytes)
+                        and buf.find(pattern, line_start, pos) != -1
+                    ):
+                        match = (line_start, index, end)
+                    else:
+                        continue
+                    best = match if best is None else min(best, match)
+                if best is not None:
+                    break
+                pos = buf.find(self._prompt, pos + 1)
+            if best is None:
+                self._searched = len(buf)
+                return None
+        start, index, end = best
+        self.before = _decode(buf[:start])
+        del buf[:end]
+        self._searched = 0
+        return index
+
+    def fill(self, timeout):
+        """Read the output which is available, waiting up to `timeout` seconds (or
+        indefinitely if it's None) for some to arrive. Returns False if none did.
+        """
+        fd = self.child.child_fd
+        spans = self.spans
+        if spans is not None:
+            start = time.perf_counter()
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if spans is not None:
+            read_start = time.perf_counter()
+            spans.add("pty_wait", read_start - start)
+        if not readable:
+            return False
+        try:
+            data = os.read(fd, self.read_size)
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            # Linux raises EIO once the REPL closes its end of the pty
+            if e.errno != errno.EIO:
+                raise
+            data = b""
+        if spans is not None:
+            spans.add("pty_read", time.perf_counter() - read_start)
+        if not data:
+            self.before = _decode(self.buffer)
+            self.buffer.clear()
+            self._searched = 0
+            raise pexpect.EOF("The Wasm REPL exited")
+        self.buffer += data
+        return True
+
+    def expect(self, patterns, timeout):
+        """Wait until one of `patterns` matches and return its index"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            index = self.search(patterns)
+            if index is not None:
+                return index
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self.fill(wait) and wait is not None and wait <= 0:
+                raise pexpect.TIMEOUT(
+                    "Timeout exceeded while waiting for the Wasm REPL"
+                )
+
+    def take_lines(self):
+        """Take the complete lines of output which have arrived so far, except for the
+        last one. That line, and the line break before it, are left in the buffer so
+        that a sentinel can still match it, and so that a prompt pattern (which is
+        anchored on a line break or the start of the output) can't match the start of
+        a line which was only part of the output.
+        """
+        buf = self.buffer
+        last = buf.rfind(b"\r\n")
+        cut = buf.rfind(b"\r\n", 0, max(last, 0))
+        # lines this long can't be a sentinel's, so they're taken as well, to keep the
+        # buffer bounded
+        if len(buf) - last > self.max_line:
+            # keep the last two bytes of an incomplete line, which may be the start of
+            # a line break, and don't split a UTF-8 sequence
+            cut = len(buf) - 2
+            while cut > 0 and buf[cut] & 0xC0 == 0x80:
+                cut -= 1
+        elif last - max(cut, 0) > self.max_line:
+            cut = last
+        if cut <= 0:
+            return ""
+        text = _decode(buf[:cut])
+        del buf[:cut]
+        self._searched = 0
+        return text
 
 
 class WasmREPLWrapper(REPLWrapper):
@@ -7,11 +224,11 @@ class WasmREPLWrapper(REPLWrapper):
     pexpect.replwrap.REPLWrapper with the following changes:
 
     * appropriate orig_prompt and continuation_prompt values.
-    * modified _expect_prompt to use regex (via pexpect.expect) instead of plain
-      string matching (via pexpect.expect_exact), so that the Wasm REPL's prompt
-      can be properly identified (since it can occur at the start of buffered
-      input, ie. matching "^> ", or in the middle of buffered input after a
-      newline, ie. matching "\r\n> ").
+    * output is read and matched by a :class:`_ReplReader` instead of pexpect's
+      `expect`, which identifies the Wasm REPL's prompt whether it occurs at the
+      start of buffered input ("^> ") or in the middle of buffered input after a
+      newline ("\r\n> "), without rescanning output which was already searched.
+      Output is returned with "\n" line endings instead of the pty's "\r\n".
     * modified run_command which looks for a final prompt, not a continuation
       prompt, since the Wasm continuation prompt "  " is indistinguishable from
       the indentation the REPL uses normally when returning results, such as
@@ -19,6 +236,10 @@ class WasmREPLWrapper(REPLWrapper):
     * modified run_command to merge all response lines with newline characters,
       instead of simply concatenating them, since the prompt is defined as having
       newlines in it and therefore will cause them to be stripped out.
+    * a framed mode for run_command, which writes the command to the REPL in a
+      few large writes instead of waiting for a prompt between every line. Each
+      write is followed by a sentinel command whose output marks the end of the
+      write's response (see `_framed_steps`).
 
     :param cmd_or_spawn: This can either be an instance of :class:`pexpect.spawn`
       in which a REPL has already been started, or a str command to start a new
@@ -32,6 +253,8 @@ class WasmREPLWrapper(REPLWrapper):
         cmd_or_spawn,
         extra_init_cmd=None,
     ):
+        # input which is waiting to be written to the REPL (see `_queue`)
+        self._pending = bytearray()
         REPLWrapper.__init__(
             self,
             cmd_or_spawn,
@@ -44,21 +267,157 @@ class WasmREPLWrapper(REPLWrapper):
     def set_prompt(self, orig_prompt, prompt_change):
         raise TypeError("The Wasm REPL's prompt can't be changed")
 
+    _reader = None
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = _ReplReader(self.child)
+        return self._reader
+
+    @property
+    def before(self):
+        """The output which preceded the last prompt (or the end of the output, if
+        the REPL exited)
+        """
+        return self.reader.before
+
     def _expect_prompt(self, timeout=-1, async_=False):
-        return self.child.expect(
-            [self.prompt, self.continuation_prompt], timeout=timeout, async_=async_
+        return self.reader.expect(
+            (PROMPT, CONTINUATION_PROMPT), self._resolve_timeout(timeout)
         )
 
-    def run_command(self, command, timeout=-1):
+    def _resolve_timeout(self, timeout):
+        return self.child.timeout if timeout == -1 else timeout
+
+    #: A :class:`~.metrics.Spans` which the time spent writing to the REPL, waiting
+    #: for and reading its output, and scanning the output is added to, if set
+    spans = None
+
+    def _send(self, data):
+        if self.spans is None:
+            self.child.send(data)
+            return
+        start = time.perf_counter()
+        self.child.send(data)
+        self.spans.add("pty_write", time.perf_counter() - start)
+
+    def _queue(self, data):
+        """Queue input to be written to the REPL while waiting for its output.
+
+        The pty only buffers a few KB in each direction, so the REPL blocks on its
+        output while a large write is in progress, and writing a chunk of framed input
+        in one blocking write would deadlock once the REPL's output to it didn't fit
+        in the pty's buffer. Instead, the pty is written to without blocking whenever
+        it can take more input, in between reading the REPL's output.
+        """
+        self._pending[:] = data.encode("utf-8")
+        os.set_blocking(self.child.child_fd, False)
+
+    def _write_pending(self):
+        """Write as much of the queued input as the pty will take without blocking"""
+        fd = self.child.child_fd
+        start = time.perf_counter()
+        try:
+            while self._pending:
+                del self._pending[: os.write(fd, self._pending[: self.write_size])]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # Linux raises EIO once the REPL closes its end of the pty, which the
+            # reader will find
+            if e.errno != errno.EIO:
+                raise
+            self._pending.clear()
+        if self.spans is not None:
+            self.spans.add("pty_write", time.perf_counter() - start)
+        if not self._pending:
+            os.set_blocking(fd, True)
+
+    def _fill(self, timeout):
+        """Like the reader's `fill`, but writes queued input as the pty takes it while
+        waiting for output
+        """
+        if not self._pending:
+            return self.reader.fill(timeout)
+        fd = self.child.child_fd
+        start = time.perf_counter()
+        readable, writable, _ = select.select([fd], [fd], [], timeout)
+        if self.spans is not None:
+            self.spans.add("pty_wait", time.perf_counter() - start)
+        if writable:
+            self._write_pending()
+        return bool(readable) and self.reader.fill(0) or bool(writable)
+
+    #: Approximate number of characters written to the REPL at once in framed mode
+    framed_chunk_size = 4096
+    #: The most bytes of queued input written to the REPL at once
+    write_size = 4096
+    #: How often (in seconds) output is passed to run_command's `on_output` callback
+    #: while waiting for a prompt
+    stream_interval = 0.05
+
+    def run_command(self, command, timeout=-1, framed=False, on_output=None):
         """Send a command to the REPL, wait for and return output.
 
         :param str command: The command to send. Trailing newlines are not needed.
           This should be a complete block of input that will trigger execution;
-          if a continuation prompt is found after sending input, :exc:`ValueError`
-          will be raised (TODO: raising this exception is wip).
+          if it leaves a form, block comment or string open, :exc:`ValueError` is
+          raised before anything is sent.
         :param int timeout: How long to wait for the next prompt. -1 means the
           default from the :class:`pexpect.spawn` object (default 30 seconds).
           None means to wait indefinitely.
+        :param bool framed: Write the command in as few writes as possible, instead
+          of line by line, and stop writing once the REPL reports an error. Commands
+          which don't form a balanced block of input (eg. an unclosed form) are
+          always run line by line. Errors are only noticed between chunks of about
+          `framed_chunk_size` characters, so the forms after an error in the same
+          chunk still run, but the later chunks don't, whereas line by line every
+          form runs. Which forms after a failing one (eg. an `assert_return`) have
+          run therefore depends on the mode.
+        :param on_output: If given, output is passed to this function as it arrives
+          (in complete lines, where possible) instead of being returned, and None is
+          returned. It's also periodically called with an empty string while the REPL
+          is busy, so that callers which buffer output get a chance to flush it.
+        """
+        self.reader.spans = self.spans
+        output = _MergedOutput(on_output, self.spans)
+        steps = self._command_steps(command, framed, output)
+        try:
+            patterns = next(steps)
+            while True:
+                patterns = steps.send(self._expect_list(patterns, timeout, output))
+        except StopIteration:
+            pass
+        return output.finish()
+
+    async def run_command_async(
+        self, command, timeout=-1, framed=False, on_output=None
+    ):
+        """Coroutine version of run_command, which waits for the REPL's output using
+        the running event loop instead of blocking it. Cancelling the coroutine stops
+        waiting for output, but leaves the REPL in an unknown state (it may still be
+        working on the command), so it should be restarted afterwards.
+        """
+        self.reader.spans = self.spans
+        output = _MergedOutput(on_output, self.spans)
+        steps = self._command_steps(command, framed, output)
+        try:
+            patterns = next(steps)
+            while True:
+                patterns = steps.send(
+                    await self._expect_list_async(patterns, timeout, output)
+                )
+        except StopIteration:
+            pass
+        return output.finish()
+
+    def _command_steps(self, command, framed, output):
+        """Sends the command to the REPL and collects its response into `output`.
+        This is a generator which yields a tuple of patterns (see :class:`_ReplReader`)
+        each time it needs to wait for output, and expects to be sent the index of the
+        pattern which matched, so that it can be driven by both run_command and
+        run_command_async.
         """
         # # Split up multiline commands and feed them in bit-by-bit
         cmdlines = command.splitlines()
@@ -67,23 +426,213 @@ class WasmREPLWrapper(REPLWrapper):
             cmdlines.append("")
         if not cmdlines:
             raise ValueError("No command was given")
+        if self._pending:
+            # left over from a command which was cancelled
+            self._pending.clear()
+            os.set_blocking(self.child.child_fd, True)
+        states = scan_lines(cmdlines)
+        if states[-1].open:
+            raise ValueError("The command is incomplete: %r" % command)
 
-        res = []
-        self.child.sendline(cmdlines[0])
+        if framed:
+            chunks = _toplevel_chunks(cmdlines, states, self.framed_chunk_size)
+            if chunks is not None:
+                yield from self._framed_steps(chunks, output)
+                return
+
+        prompts = (PROMPT, CONTINUATION_PROMPT)
+        linesep = self.child.linesep
+        self._send(cmdlines[0] + linesep)
         for line in cmdlines[1:]:
-            self._expect_prompt(timeout=timeout)
-            if len(self.child.before) > 0:
-                res.append(self.child.before)
-            self.child.sendline(line)
-
-        # Command was fully submitted, now wait for the next prompt
-        # TODO: if the next prompt is a continuation prompt will this hang until
-        # the timeout? Should we send a guaranteed newline at the end of every command
-        # to ensure that a new prompt is always shown (the Wasm REPL will allow you to
-        # end a continuation prompt by sending a blank line of input)?
-        # TODO maybe we should test first to see if the response is ONLY continuation
-        # prompt, with nothing else printed, and then we'll know if a continuation was
-        # expected and can throw and appropriate error.
-        self.child.expect(self.prompt, timeout=timeout)
-
-        return u"\n".join(res + [self.child.before])
+            yield prompts
+            output.write(self.reader.before)
+            output.end_segment()
+            self._send(line + linesep)
+
+        # Command was fully submitted, now wait for the next prompt (incomplete
+        # commands were rejected above, so this isn't a continuation prompt)
+        yield (PROMPT,)
+        output.write(self.reader.before)
+        output.end_segment()
+
+    def _framed_steps(self, chunks, output):
+        """Write each chunk of lines to the REPL, followed by a sentinel command,
+        while collecting the response.
+
+        The REPL prints one prompt for every line it reads, so expecting a prompt
+        once per line yields exactly the same `before` segments that run_command
+        would see when waiting for a prompt between every line, just without a pty
+        round-trip per line. The sentinel is an `input` command for a file which
+        doesn't exist, so the REPL echoes its unique file name back in an i/o error
+        once it's done with the chunk. Matching on that error guarantees that the
+        whole response to the chunk was consumed, even if the REPL printed more or
+        fewer prompts than expected.
+
+        Chunks always end at a top-level form boundary, so if a chunk's response
+        contains an error then the remaining chunks are never sent. A chunk is
+        written as the pty takes it while its response is read (see `_queue`), since
+        a single form can be much larger than the pty's buffer.
+        """
+        token = "__wasm_spec_kernel_%s__" % uuid.uuid4().hex
+        sentinel_cmd = '(input "%s.wast")' % token
+        patterns = (PROMPT, CONTINUATION_PROMPT, token.encode("ascii"))
+        linesep = self.child.linesep
+
+        for chunk in chunks:
+            self._queue(linesep.join(chunk + [sentinel_cmd]) + linesep)
+            while True:
+                index = yield patterns
+                output.write(self.reader.before)
+                # a sentinel shouldn't be preceded by anything other than prompts,
+                # but in case it is (eg. the REPL lost track of lines), keep it
+                if index != 2 or len(self.reader.before) > 0:
+                    output.end_segment()
+                if index == 2:
+                    break
+            if output.error_seen:
+                break
+
+    def _expect_list(self, patterns, timeout, output):
+        """Wait for one of `patterns` and return its index. When output is being
+        streamed, complete lines which arrive while waiting are passed to `output`
+        (periodically, or as soon as the buffer grows large) instead of being kept for
+        `before`.
+        """
+        timeout = self._resolve_timeout(timeout)
+        if not output.streaming and not self._pending:
+            return self.reader.expect(patterns, timeout)
+        reader = self.reader
+        deadline = None if timeout is None else time.monotonic() + timeout
+        next_flush = time.monotonic() + self.stream_interval
+        while True:
+            index = reader.search(patterns)
+            if index is not None:
+                return index
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise pexpect.TIMEOUT(
+                    "Timeout exceeded while waiting for the Wasm REPL"
+                )
+            wait = None
+            if output.streaming:
+                # output is passed on periodically, or as soon as there's a lot of
+                # it, so that the buffer stays bounded
+                if now >= next_flush or len(reader.buffer) > reader.max_line:
+                    output.write(reader.take_lines())
+                    next_flush = now + self.stream_interval
+                wait = next_flush - now
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            self._fill(None if wait is None else max(wait, 0))
+
+    async def _expect_list_async(self, patterns, timeout, output):
+        """Coroutine version of _expect_list, which waits for the child's fd to become
+        readable (or writable, while there's queued input) on the event loop and then
+        reads from (or writes to) it without blocking.
+        """
+        loop = asyncio.get_event_loop()
+        timeout = self._resolve_timeout(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        reader = self.reader
+        fd = self.child.child_fd
+        ready = asyncio.Event()
+        loop.add_reader(fd, ready.set)
+        writing = False
+        try:
+            while True:
+                ready.clear()
+                if self._pending:
+                    self._write_pending()
+                if bool(self._pending) != writing:
+                    writing = not writing
+                    if writing:
+                        loop.add_writer(fd, ready.set)
+                    else:
+                        loop.remove_writer(fd)
+                index = reader.search(patterns)
+                if index is not None:
+                    return index
+                if reader.fill(0):
+                    if output.streaming and len(reader.buffer) > reader.max_line:
+                        output.write(reader.take_lines())
+                    continue
+                if output.streaming:
+                    output.write(reader.take_lines())
+                    wait = self.stream_interval
+                else:
+                    wait = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise pexpect.TIMEOUT(
+                            "Timeout exceeded while waiting for the Wasm REPL"
+                        )
+                    wait = remaining if wait is None else min(wait, remaining)
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if reader.spans is not None:
+                    reader.spans.add("pty_wait", time.perf_counter() - start)
+        finally:
+            loop.remove_reader(fd)
+            if writing:
+                loop.remove_writer(fd)
+
+
+class _MergedOutput:
+    """Merges the segments of output between the REPL's prompts in the same way as
+    run_command always has: with newlines between them, skipping empty segments
+    (other than the last one). Segments are either collected and returned by `finish`,
+    or passed to `on_output` as they're written.
+    """
+
+    def __init__(self, on_output=None, spans=None):
+        self._on_output = on_output
+        self._spans = spans
+        self._parts = []
+        self._started = False
+        self._segment_written = False
+        self._last_segment_empty = True
+        self.error_seen = False
+
+    @property
+    def streaming(self):
+        return self._on_output is not None
+
+    def write(self, text):
+        """Add text to the current segment"""
+        if len(text) == 0:
+            if self._on_output is not None:
+                self._on_output(text)
+            return
+        if not self._segment_written:
+            if self._started:
+                self._emit(u"\n")
+            self._started = self._segment_written = True
+        if not self.error_seen:
+            start = time.perf_counter()
+            self.error_seen = error_pat.search(text) is not None
+            if self._spans is not None:
+                self._spans.add("error_scan", time.perf_counter() - start)
+        self._emit(text)
+
+    def end_segment(self):
+        self._last_segment_empty = not self._segment_written
+        self._segment_written = False
+
+    def finish(self):
+        """Returns the merged output, or None if it was passed to `on_output`"""
+        # the last segment is always included, even if it's empty
+        if self._started and self._last_segment_empty:
+            self._emit(u"\n")
+        if self._on_output is not None:
+            return None
+        return u"".join(self._parts)
+
+    def _emit(self, text):
+        if self._on_output is not None:
+            self._on_output(text)
+        else:
+            self._parts.append(text)